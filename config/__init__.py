@@ -5,3 +5,4 @@ from .oauth import *
 from .scheduler import *
 from .logging import *
 from .cluster import *
+from .files import *
@@ -5,6 +5,9 @@ import os
 # Command to use when submitting to cluster.
 SUBMIT_COMMAND = os.environ.get("DASHBOARD_QSUBMIT_CMD") or "sbatch"
 
+# Command used to check on submitted jobs. Must accept sacct's options.
+STATUS_COMMAND = os.environ.get("DASHBOARD_QSTATUS_CMD") or "sacct"
+
 # Options to always set during submission (e.g. QOS)
 SUBMIT_OPTIONS = os.environ.get("DASHBOARD_QSUBMIT_OPTIONS") or "--chdir=/tmp/"
 
@@ -17,3 +20,10 @@ SUBMIT_SCRIPTS = (
         '../dashboard/queue_jobs'
         )
     )
+
+# The max number of sessions to include in a single array job.
+SUBMIT_ARRAY_SIZE = int(os.environ.get("DASHBOARD_QSUBMIT_ARRAY_SIZE") or 200)
+
+# The max number of tasks from one array job that may run at once. Leave
+# unset to let the cluster decide.
+SUBMIT_ARRAY_LIMIT = os.environ.get("DASHBOARD_QSUBMIT_ARRAY_LIMIT")
@@ -27,3 +27,10 @@ TZ_OFFSET = os.environ.get('TIMEZONE') or -240
 
 # Not needed and uses more memory. Just disable it.
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Scan and gold standard JSON headers longer than this many characters are
+# stored zlib compressed. This saves space on very large headers, but
+# compressed headers can't be searched. Leave unset to store all headers as
+# JSONB (which Postgres compresses on its own).
+HEADER_BLOB_COMPRESS_SIZE = int(
+    os.environ.get('DASHBOARD_HEADER_COMPRESS_SIZE') or 0) or None
@@ -43,6 +43,31 @@ SENDER = DASH_SUPPORT or MAIL_USERNAME or "no-reply@kimellab.ca"
 # is configured. For gmail it must be true for email to be forwarded.
 MAIL_USE_SSL = read_boolean("DASHBOARD_MAIL_SSL", default=True)
 
+# Whether this instance should send the mail waiting in the outbox table.
+# Defaults to on for the scheduler server and off everywhere else.
+MAIL_OUTBOX_DRAIN = read_boolean("DASHBOARD_MAIL_DRAIN",
+                                 default=read_boolean("DASHBOARD_SCHEDULER"))
+
+# How often (in seconds) to check the outbox for mail added by other
+# processes.
+MAIL_POLL_SECONDS = int(os.environ.get("DASHBOARD_MAIL_POLL") or 30)
+
+# The max number of messages to claim from the outbox at once
+MAIL_BATCH_SIZE = int(os.environ.get("DASHBOARD_MAIL_BATCH_SIZE") or 50)
+
+# Days to keep sent messages in the outbox before deleting them
+MAIL_OUTBOX_KEEP_DAYS = int(os.environ.get("DASHBOARD_MAIL_KEEP_DAYS") or 30)
+
+# Seconds without any mail to send before the SMTP connection is closed
+MAIL_IDLE_TIMEOUT = int(os.environ.get("DASHBOARD_MAIL_IDLE") or 60)
+
+# Seconds to wait before retrying a failed message the first time. The delay
+# doubles with each failure, up to MAIL_MAX_DELAY seconds, until the message
+# has failed MAIL_MAX_ATTEMPTS times.
+MAIL_RETRY = int(os.environ.get("DASHBOARD_MAIL_RETRY") or 30)
+MAIL_MAX_DELAY = int(os.environ.get("DASHBOARD_MAIL_MAX_DELAY") or 3600)
+MAIL_MAX_ATTEMPTS = int(os.environ.get("DASHBOARD_MAIL_MAX_ATTEMPTS") or 8)
+
 
 # Server to send outgoing log emails to. Set to 'disabled' to turn off
 # emailed logs completely.
@@ -0,0 +1,57 @@
+"""Settings for sending data files (e.g. NIfTIs) to the browser
+"""
+import os
+
+from .utils import read_pairs
+
+# How long (in seconds) browsers may reuse a data file they've downloaded
+# before checking whether it has changed. Files are marked private, so shared
+# caches will never store them.
+DATA_FILE_MAX_AGE = int(os.environ.get("DASHBOARD_DATA_FILE_MAX_AGE") or 3600)
+
+# Lets the web server send the contents of data files once the dashboard has
+# checked the user's permissions, instead of streaming them through a worker.
+# Set to 'x-accel-redirect' for nginx or 'x-sendfile' for uwsgi / apache.
+# Leave unset to send files from the dashboard itself.
+DATA_FILE_OFFLOAD = (os.environ.get("DASHBOARD_DATA_FILE_OFFLOAD") or
+                     "").lower() or None
+
+# For 'x-accel-redirect' only. Maps folders on the file system to the nginx
+# 'internal' location each is served from, as comma separated
+# 'folder=location' pairs (e.g. '/archive=/protected/archive'). Files outside
+# of all of these folders are sent by the dashboard.
+DATA_FILE_ACCEL_ROOTS = read_pairs("DASHBOARD_DATA_FILE_ACCEL_ROOTS")
+
+# The width and height (in pixels) of each slice in a scan's preview mosaic
+# and thumbnail.
+PREVIEW_SIZE = int(os.environ.get("DASHBOARD_PREVIEW_SIZE") or 128)
+PREVIEW_THUMB_SIZE = int(os.environ.get("DASHBOARD_PREVIEW_THUMB_SIZE") or 64)
+
+# The number of slices from each orientation to show in a preview mosaic.
+PREVIEW_SLICES = int(os.environ.get("DASHBOARD_PREVIEW_SLICES") or 6)
+
+# The most scans to check for missing previews each time previews are swept.
+PREVIEW_SWEEP_LIMIT = int(os.environ.get("DASHBOARD_PREVIEW_SWEEP_LIMIT") or
+                          200)
+
+# The width (in voxels) of the cubic chunks that multi-resolution volumes are
+# served in.
+VOLUME_CHUNK_SIZE = int(os.environ.get("DASHBOARD_VOLUME_CHUNK") or 64)
+
+# The most disk space (in bytes) that multi-resolution volumes may take up
+# across all studies before the least recently used are deleted.
+VOLUME_MAX_BYTES = int(os.environ.get("DASHBOARD_VOLUME_MAX_BYTES") or
+                       50 * 1024**3)
+
+# How long (in days) a multi-resolution volume is kept after it was last
+# used.
+VOLUME_MAX_DAYS = int(os.environ.get("DASHBOARD_VOLUME_MAX_DAYS") or 30)
+
+# How long (in seconds) the token issued with a timepoint's static QC page
+# lets the user load the page's images without their access being checked
+# again. Tokens stop working sooner if the user's access is reduced.
+QC_IMAGE_TOKEN_SECONDS = int(os.environ.get("DASHBOARD_QC_IMAGE_TOKEN") or
+                             3600)
+
+# How long (in seconds) browsers may cache images from static QC pages.
+QC_IMAGE_MAX_AGE = int(os.environ.get("DASHBOARD_QC_IMAGE_MAX_AGE") or 86400)
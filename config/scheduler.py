@@ -5,8 +5,9 @@ import os
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from flask_apscheduler.auth import HTTPBasicAuth
 
-from dashboard.task_scheduler import ContextThreadExecutor
-from .utils import read_boolean
+from dashboard.task_scheduler import (ContextThreadExecutor,
+                                      ContextProcessExecutor)
+from .utils import read_boolean, read_sizes
 from .database import SQLALCHEMY_DATABASE_URI
 
 SCHEDULER_JOBSTORES = {
@@ -18,15 +19,171 @@ SCHEDULER_JOB_DEFAULTS = {
     'misfire_grace_time': 3600
 }
 
+# The number of workers in each executor 'lane'. Jobs are routed to a lane by
+# SCHEDULER_JOB_LANES so that, for example, a slow cluster submission can't
+# delay a session monitor. Set as comma separated 'lane=size' pairs, any
+# lanes not mentioned keep their default size and new lane names may be
+# added.
+SCHEDULER_LANES = read_sizes(
+    "DASHBOARD_SCHEDULER_LANES",
+    default="default=2,monitor=2,cluster=2,deletion=1,preview=1,"
+            "headers=2")
+
+# Lanes (comma separated) that should run jobs in forked worker processes
+# instead of threads. Only worth it for lanes with CPU heavy jobs.
+SCHEDULER_PROCESS_LANES = [
+    lane.strip()
+    for lane in (os.environ.get("DASHBOARD_SCHEDULER_PROCESS_LANES") or
+                 "headers").split(",")
+    if lane.strip()
+]
+
 SCHEDULER_EXECUTORS = {
-    'default': ContextThreadExecutor(2)
+    lane: (ContextProcessExecutor(size) if lane in SCHEDULER_PROCESS_LANES
+           else ContextThreadExecutor(size))
+    for lane, size in SCHEDULER_LANES.items()
+}
+
+# The lane each job function runs in, keyed by either a full function
+# reference or a module (a full reference takes precedence). Jobs that match
+# nothing here use the 'default' lane.
+SCHEDULER_JOB_LANES = {
+    'dashboard.monitors': 'monitor',
+    'dashboard.blueprints.redcap.monitors': 'monitor',
+    'dashboard.blueprints.redcap.monitors:sweep_scan_downloads': 'cluster',
+    'dashboard.blueprints.redcap.monitors:download_session': 'cluster',
+    'dashboard.queue': 'cluster',
+    'dashboard.deletions': 'deletion',
+    'dashboard.previews': 'preview',
+    'dashboard.volumes': 'preview',
+    'dashboard.header_diffs': 'headers',
+    # Only queues jobs, so it runs in the server process where new jobs are
+    # picked up right away
+    'dashboard.header_diffs:sweep_gold_standards': 'default',
 }
 
 # Indicates whether to start the scheduler server. Should only be set if
 # the dashboard is being run through a webserver (i.e. not just imported)
 SCHEDULER_ENABLED = read_boolean("DASHBOARD_SCHEDULER")
 
+# How often (in minutes) to sweep the session monitors for sessions that need
+# to be checked on.
+MONITOR_SWEEP_MINUTES = int(os.environ.get("DASHBOARD_MONITOR_SWEEP") or 60)
+
+# How often (in minutes) to send QCers a digest of newly added timepoints.
+QC_DIGEST_MINUTES = int(os.environ.get("DASHBOARD_QC_DIGEST") or 60)
+
+# How often (in minutes) to check the state of jobs submitted to the cluster.
+CLUSTER_POLL_MINUTES = int(os.environ.get("DASHBOARD_CLUSTER_POLL") or 5)
+
+# How often (in minutes) to look for raw data deletion jobs that were never
+# started or have stalled.
+DELETION_SWEEP_MINUTES = int(os.environ.get("DASHBOARD_DELETION_SWEEP") or 10)
+
+# How often (in minutes) to build previews for scans that don't have them.
+PREVIEW_SWEEP_MINUTES = int(os.environ.get("DASHBOARD_PREVIEW_SWEEP") or 30)
+
+# How often (in minutes) to delete multi-resolution volumes that are over
+# their disk space budget.
+VOLUME_SWEEP_MINUTES = int(os.environ.get("DASHBOARD_VOLUME_SWEEP") or 360)
+
+# How often (in minutes) to compare scans to newly added gold standards.
+HEADER_DIFF_SWEEP_MINUTES = int(
+    os.environ.get("DASHBOARD_HEADER_DIFF_SWEEP") or 15)
+
+# How many times comparing scans to a new gold standard may fail before the
+# sweep stops retrying it.
+HEADER_DIFF_MAX_ATTEMPTS = int(
+    os.environ.get("DASHBOARD_HEADER_DIFF_ATTEMPTS") or 3)
+
+# The number of paths a deletion job may delete at once.
+DELETION_WORKERS = int(os.environ.get("DASHBOARD_DELETION_WORKERS") or 8)
+
+# How often (in seconds) a running deletion job saves its progress.
+DELETION_PROGRESS_SECONDS = int(
+    os.environ.get("DASHBOARD_DELETION_PROGRESS") or 5)
+
+# How often (in seconds) a running deletion job records that it's still
+# alive, even when no entry has finished.
+DELETION_HEARTBEAT_SECONDS = int(
+    os.environ.get("DASHBOARD_DELETION_HEARTBEAT") or 30)
+
+# How long (in minutes) a running deletion job may go without a heartbeat
+# before it's assumed lost and put back in the queue. This should be many
+# times the heartbeat interval.
+DELETION_STALL_MINUTES = int(
+    os.environ.get("DASHBOARD_DELETION_STALL") or 60)
+
 if SCHEDULER_ENABLED:
+    # Periodic jobs that should always be scheduled on the server. These
+    # replace any saved copies of themselves in the job store on start up.
+    SCHEDULER_JOBS = [
+        {
+            'id': 'sweep_redcap_imports',
+            'func': 'dashboard.monitors:sweep_redcap_imports',
+            'trigger': 'interval',
+            'minutes': MONITOR_SWEEP_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'sweep_scan_imports',
+            'func': 'dashboard.blueprints.redcap.monitors:sweep_scan_imports',
+            'trigger': 'interval',
+            'minutes': MONITOR_SWEEP_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'sweep_scan_downloads',
+            'func': 'dashboard.blueprints.redcap.monitors:'
+                    'sweep_scan_downloads',
+            'trigger': 'interval',
+            'minutes': MONITOR_SWEEP_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'sweep_qc_notifications',
+            'func': 'dashboard.monitors:sweep_qc_notifications',
+            'trigger': 'interval',
+            'minutes': QC_DIGEST_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'poll_cluster_jobs',
+            'func': 'dashboard.queue:poll_jobs',
+            'trigger': 'interval',
+            'minutes': CLUSTER_POLL_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'sweep_deletion_jobs',
+            'func': 'dashboard.deletions:sweep_deletion_jobs',
+            'trigger': 'interval',
+            'minutes': DELETION_SWEEP_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'sweep_previews',
+            'func': 'dashboard.previews:sweep_previews',
+            'trigger': 'interval',
+            'minutes': PREVIEW_SWEEP_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'sweep_volumes',
+            'func': 'dashboard.volumes:sweep_volumes',
+            'trigger': 'interval',
+            'minutes': VOLUME_SWEEP_MINUTES,
+            'replace_existing': True
+        },
+        {
+            'id': 'sweep_gold_standards',
+            'func': 'dashboard.header_diffs:sweep_gold_standards',
+            'trigger': 'interval',
+            'minutes': HEADER_DIFF_SWEEP_MINUTES,
+            'replace_existing': True
+        },
+    ]
+
     # Controls whether to allow remote job submission (over HTTP)
     SCHEDULER_API_ENABLED = read_boolean("DASHBOARD_SCHEDULER_API")
 
@@ -48,3 +205,35 @@ SCHEDULER_PASS = os.environ.get('DASHBOARD_SCHEDULER_PASS')
 
 # The server URL to send scheduled jobs to. (Client/imported instances only)
 SCHEDULER_SERVER_URL = os.environ.get("DASHBOARD_URL")
+
+# The max number of jobs to send to the server in a single request when
+# a client is submitting jobs in a batch. (Client/imported instances only)
+SCHEDULER_BATCH_SIZE = int(os.environ.get("DASHBOARD_SCHEDULER_BATCH") or 100)
+
+# The number of connections to the server to keep open for reuse.
+# (Client/imported instances only)
+SCHEDULER_POOL_SIZE = int(os.environ.get("DASHBOARD_SCHEDULER_POOL") or 4)
+
+# How long (in seconds) to wait to connect to the server, and then for it to
+# reply, before giving up on a request. (Client/imported instances only)
+SCHEDULER_CONNECT_TIMEOUT = float(
+    os.environ.get("DASHBOARD_SCHEDULER_CONNECT_TIMEOUT") or 5)
+SCHEDULER_READ_TIMEOUT = float(
+    os.environ.get("DASHBOARD_SCHEDULER_READ_TIMEOUT") or 30)
+
+# The full path to an SQLite file to queue jobs in before they're sent to the
+# server. When set, jobs are added instantly and sent by a background thread
+# that retries until the server accepts them. If unset, jobs are sent as
+# they're added. (Client/imported instances only)
+SCHEDULER_SPOOL = os.environ.get("DASHBOARD_SCHEDULER_SPOOL")
+
+# Seconds to wait before retrying spooled jobs the first time. The delay
+# doubles with each failure, up to SCHEDULER_SPOOL_MAX_DELAY seconds.
+SCHEDULER_SPOOL_RETRY = int(os.environ.get("DASHBOARD_SPOOL_RETRY") or 5)
+SCHEDULER_SPOOL_MAX_DELAY = int(
+    os.environ.get("DASHBOARD_SPOOL_MAX_DELAY") or 600)
+
+# The number of times the server may reject a spooled job before it stops
+# being retried.
+SCHEDULER_SPOOL_MAX_ATTEMPTS = int(
+    os.environ.get("DASHBOARD_SPOOL_MAX_ATTEMPTS") or 10)
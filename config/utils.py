@@ -27,3 +27,41 @@ def read_boolean(var_name, default=False):
     if result == 'true' or result == 'on':
         return True
     return False
+
+
+def read_pairs(var_name, default=""):
+    """Reads a list of 'name=value' pairs from an environment variable.
+
+    Pairs should be comma separated (e.g. 'monitor=2,cluster=4'). Any names in
+    the default that aren't in the environment variable keep their default
+    value.
+
+    Args:
+        var_name (str): An environment variable to check
+        default (str, optional): Pairs to use when var_name doesn't set them
+
+    Returns:
+        dict: A dictionary mapping each name to its (string) value.
+    """
+    pairs = {}
+    for setting in (default, os.environ.get(var_name) or ""):
+        for pair in setting.split(","):
+            if not pair.strip():
+                continue
+            name, _, value = pair.partition("=")
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+def read_sizes(var_name, default=""):
+    """Reads a list of 'name=number' pairs from an environment variable.
+
+    See :py:func:`read_pairs` for the format.
+
+    Returns:
+        dict: A dictionary mapping each name to an int.
+    """
+    return {
+        name: int(size)
+        for name, size in read_pairs(var_name, default=default).items()
+    }
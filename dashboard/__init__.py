@@ -14,8 +14,10 @@ from werkzeug.routing import BaseConverter
 from config import (SCHEDULER_ENABLED, SCHEDULER_API_ENABLED, SCHEDULER_USER,
                     SCHEDULER_PASS, TZ_OFFSET, LOGGING_CONFIG)
 
+from .mailer import MailWorker
+
 if SCHEDULER_ENABLED:
-    from flask_apscheduler import APScheduler as Scheduler
+    from .task_scheduler import DashboardScheduler as Scheduler
 else:
     from .task_scheduler import RemoteScheduler as Scheduler
 
@@ -27,6 +29,7 @@ lm = LoginManager()
 lm.login_view = 'users.login'
 lm.refresh_view = 'users.refresh_login'
 mail = Mail()
+outbox = MailWorker(mail)
 scheduler = Scheduler()
 
 if SCHEDULER_API_ENABLED:
@@ -122,8 +125,8 @@ def create_app(config=None):
     migrate.init_app(app, db)
     lm.init_app(app)
     mail.init_app(app)
+    outbox.init_app(app)
     scheduler.init_app(app)
-    scheduler.start()
     try:
         scheduler._scheduler.app = app
     except AttributeError:
@@ -153,4 +156,8 @@ def create_app(config=None):
         # Never run this on a production server!
         setup_devel_ext(app)
 
+    # Started last so jobs (and any process lane workers forked at start
+    # up) see the finished app
+    scheduler.start()
+
     return app
@@ -7,17 +7,21 @@ import logging
 from flask import session as flask_session
 from flask import (current_app, render_template, flash, url_for, redirect,
                    request, jsonify, make_response, send_file,
-                   send_from_directory)
+                   send_from_directory, safe_join, abort)
 from flask_login import current_user, login_required
 
 from dashboard import db
 from . import main_bp as main
 from ...queries import (query_metric_values_byid, query_metric_types,
                         query_metric_values_byname, find_subjects,
-                        find_sessions, find_scans)
-from ...models import Study, Site, Timepoint, Analysis
-from ...forms import (SelectMetricsForm, StudyOverviewForm, AnalysisForm)
-from ...utils import get_timepoint
+                        find_sessions, find_scans, find_scans_by_header,
+                        find_problem_scans, parse_header_predicate)
+from ...models import Study, Site, Timepoint, Analysis, DeletionJob
+from ...forms import (SelectMetricsForm, StudyOverviewForm, AnalysisForm,
+                      HeaderSearchForm)
+from ...utils import (study_admin_required, get_static_page, send_data_file,
+                      report_form_errors, stream_csv, issue_qc_token,
+                      check_qc_token)
 from ...datman_utils import get_study_path
 
 logger = logging.getLogger(__name__)
@@ -154,6 +158,88 @@ def study(study_id=None, active_tab=None):
                            display_metrics=display_metrics)
 
 
+@main.route('/study/<string:study_id>/header_search', methods=['GET', 'POST'])
+@login_required
+def header_search(study_id):
+    """Find a study's scans by the fields of their JSON headers.
+
+    Matches are sent as a CSV file. Searches can be made with the form, or
+    from scripts by giving each test as a 'where' argument (e.g.
+    ?where=RepetitionTime!=2.0&site=CMH&tag=T1).
+    """
+    if not current_user.has_study_access(study_id):
+        flash('Not authorised')
+        return redirect(url_for('main.index'))
+
+    study = Study.query.get(study_id)
+    sites = [
+        site for site in sorted(study.sites)
+        if current_user.has_study_access(study_id, site)
+    ]
+    form = HeaderSearchForm()
+    form.site.choices = [('', 'All sites')] + [(site, site) for site in sites]
+    form.tag.choices = [('', 'All scan types')] + [
+        (scantype.tag, scantype.tag) for scantype in study.scantypes
+    ]
+
+    if request.method == 'GET' and request.args.get('where'):
+        try:
+            predicates = [
+                parse_header_predicate(item)
+                for item in request.args.getlist('where')
+            ]
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        site = request.args.get('site')
+        tag = request.args.get('tag')
+    elif form.validate_on_submit():
+        predicates = form.parsed
+        site = form.site.data
+        tag = form.tag.data
+    else:
+        report_form_errors(form)
+        return render_template('header_search.html', study=study, form=form)
+
+    if site and site not in sites:
+        abort(403)
+    try:
+        query = find_scans_by_header(study_id,
+                                     predicates,
+                                     sites=[site] if site else sites,
+                                     tag=tag or None)
+    except ValueError as e:
+        if request.method == 'GET':
+            return jsonify({'error': str(e)}), 400
+        flash('ERROR - {}'.format(e))
+        return render_template('header_search.html', study=study, form=form)
+
+    result = db.session.execute(query.execution_options(stream_results=True))
+    return stream_csv(result, '{}_scan_headers.csv'.format(study_id))
+
+
+@main.route('/study/<string:study_id>/problem_scans')
+@login_required
+def problem_scans(study_id):
+    """List the study's scans that have header diffs or conversion errors.
+    """
+    if not current_user.has_study_access(study_id):
+        return jsonify({'error': 'Not authorised'}), 403
+
+    study = Study.query.get(study_id)
+    sites = [
+        site for site in study.sites
+        if current_user.has_study_access(study_id, site)
+    ]
+    scans = []
+    for row in find_problem_scans(study_id, sites=sites):
+        scan = dict(row.items())
+        scan['url'] = url_for('scans.scan',
+                              study_id=study_id,
+                              scan_id=row['id'])
+        scans.append(scan)
+    return jsonify({'study': study_id, 'scans': scans})
+
+
 @main.route('/metricData', methods=['GET', 'POST'])
 @login_required
 def metricData():
@@ -423,6 +509,19 @@ def analysis(analysis_id=None):
     return render_template('analyses.html', analyses=analyses, form=form)
 
 
+@main.route('/study/<string:study_id>/deletion/<int:job_id>')
+@study_admin_required
+@login_required
+def deletion_job(study_id, job_id):
+    """Report the progress of a raw data deletion job.
+    """
+    job = DeletionJob.query.get(job_id)
+    if not job or job.study != study_id:
+        error = 'Deletion job {} not found'.format(job_id)
+        return jsonify({'error': error}), 404
+    return jsonify(job.to_dict())
+
+
 # These functions serve up static files from the local filesystem
 @main.route('/study/<string:study_id>/data/RESOURCES/<path:tech_notes_path>')
 @main.route('/study/<string:study_id>/qc/<string:timepoint_id>/index.html')
@@ -436,8 +535,31 @@ def static_qc_page(study_id,
     if tech_notes_path:
         resources = get_study_path(study_id, 'resources')
         return send_from_directory(resources, tech_notes_path)
-    timepoint = get_timepoint(study_id, timepoint_id, current_user)
+
     if image:
-        qc_dir, _ = os.path.split(timepoint.static_page)
-        return send_from_directory(qc_dir, image)
-    return send_file(timepoint.static_page)
+        # Images are sent (or offloaded to the web server) straight away
+        # when the page's token is still good
+        qc_dir = check_qc_token(study_id, timepoint_id)
+        if not qc_dir:
+            static_page = get_static_page(study_id, timepoint_id)
+            if not static_page:
+                abort(404)
+            qc_dir = os.path.dirname(static_page)
+        try:
+            return send_data_file(
+                safe_join(qc_dir, image),
+                mimetype='image/png',
+                max_age=current_app.config.get('QC_IMAGE_MAX_AGE', 86400))
+        except IOError:
+            abort(404)
+
+    static_page = get_static_page(study_id, timepoint_id)
+    if not static_page:
+        abort(404)
+    try:
+        response = send_data_file(static_page, mimetype='text/html')
+    except IOError:
+        abort(404)
+    issue_qc_token(response, study_id, timepoint_id,
+                   os.path.dirname(static_page))
+    return response
@@ -5,9 +5,27 @@ from dashboard.emails import send_email
 
 
 def missing_session_data(session, study=None, dest_emails=None):
-    subject = "No data received for '{}'".format(session)
+    """Notify that sessions with a scan completed survey have no scan data.
+
+    Args:
+        session (str or :obj:`list` of str): A session ID or a list of
+            session IDs.
+        study (str, optional): The study that the session(s) belong to.
+        dest_emails (str or :obj:`list` of str, optional): Email address(es) to
+            relay the notification to.
+    """
+    if isinstance(session, list) and len(session) == 1:
+        session = session[0]
+    if isinstance(session, list):
+        subject = "No data received for {} sessions".format(len(session))
+        body = "It has been 48hrs since a redcap scan completed survey was " \
+               "received for the following sessions but no scan data has " \
+               "been found:\n\n{}".format("\n".join(session))
+    else:
+        subject = "No data received for '{}'".format(session)
+        body = "It has been 48hrs since a redcap scan completed survey was " \
+               "received for {} but no scan data has been found.".format(
+                   session)
     if study:
         subject = study + "- " + subject
-    body = "It has been 48hrs since a redcap scan completed survey was " \
-           "received for {} but no scan data has been found.".format(session)
     send_email(subject, body, recipient=dest_emails)
@@ -4,20 +4,30 @@ Any scheduler jobs that the redcap blueprint needs will require a monitor
 function and a check function here. See dashboard.monitors for more information
 on monitors and check functions.
 """
-from datetime import datetime, timedelta
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import and_, exists
 
 from .emails import missing_session_data
-from dashboard.monitors import add_monitor, get_emails
-from dashboard.models import Session, User
+from dashboard import db
+from dashboard.monitors import get_emails, group_notifications
+from dashboard.models import (Session, User, Scan, EmptySession, Timepoint,
+                              StudySite, SessionMonitor, ClusterJob,
+                              ClusterJobTask)
 from dashboard.exceptions import MonitorException
-from dashboard.queue import submit_job
+from dashboard.queue import start_array_job
+
+logger = logging.getLogger(__name__)
 
 
 def monitor_scan_import(session, users=None):
-    """Add a scheduler job to track whether a session's data is imported.
+    """Track whether a session's data is imported.
 
-    This creates a scheduler job that will run :obj:`check_scans` two days
-    after job submission.
+    This adds the session to the scan import monitors.
+    :py:func:`sweep_scan_imports` will check on it two days after it is added.
 
     Args:
         session (:obj:`dashboard.models.Session`): The session to track
@@ -30,8 +40,8 @@ def monitor_scan_import(session, users=None):
             :obj:`dashboard.models.Session` object is not given, or users
             can't be found to send the notification to, or none of the found
             users have an email defined.
-        :obj:`dashboard.exceptions.SchedulerException`: if the job can't be
-            added to the server.
+        :obj:`dashboard.exceptions.InvalidDataException`: if the monitor
+            can't be saved to the database.
     """
     if not isinstance(session, Session):
         raise MonitorException("Must provide an instance of "
@@ -58,15 +68,56 @@ def monitor_scan_import(session, users=None):
                                "import notifications for {} have an email "
                                "address configured.".format(users, session))
 
-    args = [session.name, session.num]
-    kwargs = {'recipients': recipients}
+    SessionMonitor.add(session.name,
+                       session.num,
+                       SessionMonitor.SCAN_IMPORT,
+                       datetime.now(timezone.utc) + timedelta(days=2),
+                       study=session.get_study().id,
+                       recipients=recipients)
+
+
+def sweep_scan_imports():
+    """Notify users about all overdue sessions that still have no scan data.
+
+    This runs periodically on the server. Sessions that have received data
+    (or have been marked as never expecting any) are marked resolved, the
+    rest are batched into one email per study.
+    """
+    has_scans = exists().where(and_(Scan.timepoint == SessionMonitor.name,
+                                    Scan.repeat == SessionMonitor.num))
+    is_empty = exists().where(and_(EmptySession.name == SessionMonitor.name,
+                                   EmptySession.num == SessionMonitor.num))
+    found = SessionMonitor.pending(SessionMonitor.SCAN_IMPORT) \
+        .add_columns(has_scans.label('has_scans'),
+                     is_empty.label('is_empty')) \
+        .all()
+
+    if not found:
+        return
+
+    missing = []
+    for monitor, scans_found, empty in found:
+        if scans_found or empty:
+            monitor.mark_handled('resolved')
+            continue
+        monitor.mark_handled('notified')
+        missing.append(monitor)
+
+    for (study, _), sessions in group_notifications(missing).items():
+        # dest emails are not set until we decide we're ok with RAs receiving
+        # emails about scans not being imported in time.
+        missing_session_data(sessions, study=study, dest_emails=None)
 
-    add_monitor(check_scans, args, input_kwargs=kwargs, days=2)
+    db.session.commit()
 
 
 def check_scans(name, num, recipients=None):
     """Sends an email if the given session does not have data.
 
+    .. note:: New scan import monitors are handled by
+        :py:func:`sweep_scan_imports`. This is kept so jobs that were
+        scheduled before the switch can still run.
+
     Args:
         name (:obj:`str`): The session name
         num (int): The repeat number
@@ -93,7 +144,12 @@ def check_scans(name, num, recipients=None):
 
 
 def monitor_scan_download(session, end_time=None):
-    """Add a job to download a session.
+    """Download a session and keep retrying until data is found.
+
+    The first download attempt is made immediately. The session is then added
+    to the scan download monitors so :py:func:`sweep_scan_downloads` will
+    retry the download on each sweep until either data arrives or end_time
+    has passed.
 
     Note: This one directly downloads a subject while monitor_scan_import
     just notifies users if download doesnt occur within a time window.
@@ -109,8 +165,8 @@ def monitor_scan_download(session, end_time=None):
             :obj:`dashboard.models.Session` object is not given for session or
             a :obj:`datetime.datetime` object is not given for end_time, if
             end_time is provided.
-        :obj:`dashboard.exceptions.SchedulerException`: if a job to retry
-            download can't be added to the scheduler server.
+        :obj:`dashboard.exceptions.InvalidDataException`: if the monitor
+            can't be saved to the database.
     """
     if not isinstance(session, Session):
         raise MonitorException("Must provide an instance of "
@@ -123,44 +179,117 @@ def monitor_scan_download(session, end_time=None):
                                "Received type {}".format(type(end_time)))
 
     study = session.get_study()
+    settings = study.sites[session.site.name]
 
     if not session.missing_scans():
-        settings = study.sites[session.site.name]
         if settings.post_download_script:
-            submit_job(
-                settings.post_download_script,
-                [study.id, str(session)]
-            )
+            start_array_job(settings.post_download_script,
+                            [(session.name, session.num)], study.id)
         return
 
+    now = datetime.now(timezone.utc)
     if not end_time:
-        end_time = datetime.now() + timedelta(days=2)
-        download_session(session.name, session.num, str(end_time.timestamp()))
-        return
+        end_time = now + timedelta(days=2)
+    elif not end_time.tzinfo:
+        end_time = end_time.astimezone(timezone.utc)
 
-    if datetime.now() >= end_time:
+    if now >= end_time:
         # Download failed + out of time
         return
 
-    add_monitor(
-        download_session,
-        # .timestamp needed for py3.5
-        [str(session.name), str(session.num), str(end_time.timestamp())],
-        hours=1
-    )
+    start_array_job(settings.download_script, [(session.name, session.num)],
+                    study.id)
+
+    SessionMonitor.add(session.name,
+                       session.num,
+                       SessionMonitor.SCAN_DOWNLOAD,
+                       now + timedelta(hours=1),
+                       study=study.id,
+                       expires=end_time)
+
+
+def sweep_scan_downloads():
+    """Retry the download of all sessions still waiting on data.
+
+    This runs periodically on the server. Sessions that now have data will
+    have their post download script run (if one is configured), sessions
+    that have run out of time are given up on, and the rest have their
+    download script re-submitted. Sessions that need the same script for the
+    same study are submitted together as one array job. Sessions that still
+    have a download queued or running on the cluster are left for the next
+    sweep.
+    """
+    now = datetime.now(timezone.utc)
+    has_scans = exists().where(and_(Scan.timepoint == SessionMonitor.name,
+                                    Scan.repeat == SessionMonitor.num))
+    is_empty = exists().where(and_(EmptySession.name == SessionMonitor.name,
+                                   EmptySession.num == SessionMonitor.num))
+    in_progress = exists().where(and_(
+        ClusterJobTask.name == SessionMonitor.name,
+        ClusterJobTask.num == SessionMonitor.num,
+        ClusterJobTask.state.notin_(ClusterJob.FINAL_STATES)))
+    found = SessionMonitor.pending(SessionMonitor.SCAN_DOWNLOAD, now=now) \
+        .join(Timepoint, Timepoint.name == SessionMonitor.name) \
+        .join(StudySite, and_(StudySite.study_id == SessionMonitor.study,
+                              StudySite.site_id == Timepoint.site_id)) \
+        .add_columns(has_scans.label('has_scans'),
+                     is_empty.label('is_empty'),
+                     in_progress.label('in_progress'),
+                     StudySite.download_script,
+                     StudySite.post_download_script) \
+        .all()
+
+    # Sessions to submit, keyed by (script, study)
+    jobs = defaultdict(list)
+    for monitor, scans_found, empty, running, script, post_script in found:
+        if running:
+            continue
+
+        if scans_found or empty:
+            monitor.mark_handled('resolved')
+            if scans_found and post_script:
+                jobs[(post_script, monitor.study)].append(monitor)
+            continue
+
+        if not script or (monitor.expires and now >= monitor.expires):
+            # Download failed + out of time
+            monitor.mark_handled('expired')
+            continue
+
+        jobs[(script, monitor.study)].append(monitor)
+
+    for (script, study), monitors in jobs.items():
+        _submit_array(script, study, monitors)
+
+    db.session.commit()
+
+
+def _submit_array(script, study, monitors):
+    """Start array jobs to run a script for many sessions of a study.
+    """
+    size = current_app.config["SUBMIT_ARRAY_SIZE"]
+    for start in range(0, len(monitors), size):
+        sessions = [(monitor.name, monitor.num)
+                    for monitor in monitors[start:start + size]]
+        try:
+            start_array_job(script, sessions, study)
+        except Exception as e:
+            logger.error("Failed to submit array job '{}' for {} sessions "
+                         "from {}. Reason: {}".format(
+                             script, len(sessions), study, e))
 
 
 def download_session(name, num, end_time):
+    """Attempt to download a session.
+
+    .. note:: New scan download monitors are handled by
+        :py:func:`sweep_scan_downloads`. This is kept so jobs that were
+        scheduled before the switch can still run.
+    """
     session = Session.query.get((name, num))
     if not session:
         raise MonitorException(
             "Monitored session {}_{} is no longer in database, aborting "
             "download attempt.".format(name, str(num).zfill(2)))
 
-    study = session.get_study()
-    site_settings = study.sites[session.site.name]
-
-    args = [study.id, str(session)]
-
-    submit_job(site_settings.download_script, args)
     monitor_scan_download(session, datetime.fromtimestamp(float(end_time)))
@@ -1,19 +1,7 @@
 import os
 import json
 
-from ...datman_utils import get_study_path
-
-
-def get_nifti_path(scan):
-    study = scan.get_study().id
-    nii_folder = get_study_path(study, folder='nii')
-    fname = "_".join([scan.name, scan.description + ".nii.gz"])
-
-    full_path = os.path.join(nii_folder, scan.timepoint, fname)
-    if not os.path.exists(full_path):
-        full_path = full_path.replace(".nii.gz", ".nii")
-
-    return full_path
+from ...datman_utils import get_study_path, get_nifti_path  # noqa: F401
 
 
 def update_json(scan, contents):
@@ -1,14 +1,18 @@
 import os
 import logging
 
-from flask import render_template, flash, url_for, redirect, send_file, abort
+from flask import (current_app, render_template, flash, url_for, redirect,
+                   abort, jsonify, request)
 from flask_login import current_user, login_required
 
 from . import utils
 from . import scan_bp
 from .forms import ScanChecklistForm, SliceTimingForm
-from ...utils import report_form_errors, get_scan, prev_url
-from ...datman_utils import update_header_diffs
+from ...utils import (report_form_errors, get_scan, prev_url,
+                      send_data_file)
+from ...datman_utils import update_header_diffs, get_preview_path
+from ... import volumes
+from ...previews import PREVIEW_KINDS, needs_previews, queue_previews
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +47,86 @@ def papaya(study_id, scan_id):
                            nifti_name=name)
 
 
+@scan_bp.route('/preview/<string:kind>', methods=['GET'])
+@login_required
+def preview(study_id, scan_id, kind):
+    """Sends a preview image of the scan.
+
+    If the scan's previews haven't been built yet (or are out of date) they're
+    queued for every scan in the session, since reviewers usually go through
+    a whole session at once, and a 202 is returned so the page can check
+    back shortly. A 404 means no preview can be made for the scan.
+    """
+    if kind not in PREVIEW_KINDS:
+        abort(404)
+    scan = get_scan(scan_id, study_id, current_user, fail_url=prev_url())
+    path = get_preview_path(scan, kind)
+    if not path:
+        abort(404)
+    if needs_previews(scan):
+        if not queue_previews([item.id for item in scan.session.scans],
+                              job_id='previews_{}'.format(scan.session)):
+            abort(404)
+        response = jsonify({'building': True})
+        response.status_code = 202
+        response.headers['Retry-After'] = 5
+        return response
+    try:
+        result = send_data_file(path, mimetype="image/png")
+    except IOError:
+        abort(404)
+    return result
+
+
+@scan_bp.route('/volume', methods=['GET'])
+@login_required
+def volume_manifest(study_id, scan_id):
+    """Describes the scan's multi-resolution volume (see dashboard.volumes).
+
+    No dashboard page uses this yet, it's only the server side of a tiled
+    viewer. If the volume hasn't been built yet it's queued and a 202 is
+    returned, so the caller can check back shortly.
+    """
+    scan = get_scan(scan_id, study_id, current_user, fail_url=prev_url())
+    manifest = volumes.get_manifest(scan)
+    if manifest is None:
+        volumes.queue_volumes([scan.id], job_id='volumes_{}'.format(scan.id))
+        return jsonify({'building': True}), 202
+    # Chunks are served beneath this URL (see volume_chunk)
+    manifest['chunk_url'] = url_for('scans.volume_manifest',
+                                    study_id=study_id,
+                                    scan_id=scan_id) + \
+        '/{level}/{volume}/{z}/{y}/{x}'
+    return jsonify(manifest)
+
+
+@scan_bp.route('/volume/<int:level>/<int:volume>/<int:z>/<int:y>/<int:x>',
+               methods=['GET'])
+@login_required
+def volume_chunk(study_id, scan_id, level, volume, z, y, x):
+    """Sends one chunk of the scan's multi-resolution volume.
+
+    The body is the raw (z, y, x) array in C order. Its shape and dtype are
+    given by the 'X-Chunk-Shape' and 'X-Chunk-Dtype' headers.
+    """
+    scan = get_scan(scan_id, study_id, current_user, fail_url=prev_url())
+    try:
+        chunk, manifest = volumes.read_chunk(scan, level, volume, z, y, x)
+    except (IOError, IndexError):
+        abort(404)
+
+    response = current_app.response_class(chunk.tobytes(),
+                                          mimetype='application/octet-stream')
+    response.headers['X-Chunk-Shape'] = ','.join(str(i) for i in chunk.shape)
+    response.headers['X-Chunk-Dtype'] = manifest['dtype']
+    response.set_etag('{}-{}-{}-{}-{}-{}'.format(
+        manifest['source_mtime'], level, volume, z, y, x))
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config.get(
+        'DATA_FILE_MAX_AGE', 3600)
+    return response.make_conditional(request)
+
+
 @scan_bp.route('/slice-timing', methods=['POST'])
 @scan_bp.route('/slice-timing/auto/<auto>', methods=['GET'])
 @scan_bp.route('/slice-timing/delete/<delete>')
@@ -144,10 +228,9 @@ def load_scan(study_id, scan_id, file_name):
     scan = get_scan(scan_id, study_id, current_user, fail_url=prev_url())
     full_path = utils.get_nifti_path(scan)
     try:
-        result = send_file(full_path,
-                           as_attachment=True,
-                           attachment_filename=file_name,
-                           mimetype="application/gzip")
+        result = send_data_file(full_path,
+                                attachment_filename=file_name,
+                                mimetype="application/gzip")
     except IOError:
         logger.error("Couldnt find file {} to load scan view for user "
                      "{}".format(full_path, current_user))
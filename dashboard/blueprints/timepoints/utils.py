@@ -1,8 +1,10 @@
 import logging
 
 from github import Github
-from flask import current_app, flash
+from flask import current_app, flash, url_for
+from flask_login import current_user
 from ...models import Study
+from ...deletions import queue_deletion as queue_job
 
 logger = logging.getLogger(__name__)
 
@@ -75,3 +77,11 @@ def get_issues_repo(token):
     except Exception as e:
         raise Exception("Can't retrieve github issues repo. {}".format(e))
     return repo
+
+
+def queue_deletion(study_id, target, plan):
+    job = queue_job(study_id, str(target), plan, user=current_user)
+    flash("Files for {} are being deleted in the background. Progress can be "
+          "checked at {}".format(target, url_for('main.deletion_job',
+                                                 study_id=study_id,
+                                                 job_id=job.id)))
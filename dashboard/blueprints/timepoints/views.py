@@ -142,7 +142,8 @@ def delete_timepoint(study_id, timepoint_id):
                                 timepoint_id=timepoint_id))
 
     if form.raw_data.data:
-        dm_utils.delete_timepoint(timepoint)
+        utils.queue_deletion(study_id, timepoint,
+                             dm_utils.plan_timepoint(timepoint))
 
     if form.database_records.data:
         timepoint.delete()
@@ -168,9 +169,10 @@ def delete_session(study_id, timepoint_id, session_num):
 
     if form.raw_data.data:
         if len(timepoint.sessions) == 1:
-            dm_utils.delete_timepoint(timepoint)
+            plan = dm_utils.plan_timepoint(timepoint)
         else:
-            dm_utils.delete_session(session)
+            plan = dm_utils.plan_session(session)
+        utils.queue_deletion(study_id, session, plan)
 
     if form.database_records.data:
         session.delete()
@@ -197,7 +199,7 @@ def delete_scan(study_id, timepoint_id, scan_id):
         return redirect(dest_URL)
 
     if form.raw_data.data:
-        dm_utils.delete_scan(scan)
+        utils.queue_deletion(study_id, scan, dm_utils.plan_scan(scan))
 
     if form.database_records.data:
         scan.delete()
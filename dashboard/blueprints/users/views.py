@@ -34,6 +34,7 @@ def login():
 @user_bp.route('/logout')
 def logout():
     logout_user()
+    flask_session.pop('qc_auth', None)
     flash('You have been logged out.')
     return redirect(url_for('users.login'))
 
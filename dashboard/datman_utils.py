@@ -17,66 +17,212 @@ import os
 import shutil
 import glob
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from sqlalchemy.orm import object_session
 
 import datman.config
 import datman.scanid
 
 logger = logging.getLogger(__name__)
 
+_configs = {}
+_configs_lock = threading.Lock()
 
-def delete_timepoint(timepoint):
-    config = datman.config.config(study=timepoint.get_study().id)
+
+class CachedConfig(object):
+    """A datman config for one study that remembers its lookups.
+
+    Results (and exceptions) from get_path, get_key and get_tags are stored
+    so repeated lookups don't have to search the parsed YAML again. Any other
+    attribute is read from the wrapped datman config. Values returned are
+    shared between callers and must not be modified.
+    """
+
+    def __init__(self, study=None):
+        self.study = study
+        self.config = datman.config.config(study=study)
+        self.files = _config_files(self.config)
+        self.mtimes = _get_mtimes(self.files)
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def is_stale(self):
+        return _get_mtimes(self.files) != self.mtimes
+
+    def get_path(self, *args, **kwargs):
+        return self._lookup('get_path', args, kwargs)
+
+    def get_key(self, *args, **kwargs):
+        return self._lookup('get_key', args, kwargs)
+
+    def get_tags(self, *args, **kwargs):
+        return self._lookup('get_tags', args, kwargs)
+
+    def _lookup(self, method, args, kwargs):
+        key = (method, args, tuple(sorted(kwargs.items())))
+        try:
+            found, result = self._results[key]
+        except KeyError:
+            with self._lock:
+                try:
+                    result = getattr(self.config, method)(*args, **kwargs)
+                    found = True
+                except Exception as e:
+                    result = e
+                    found = False
+                self._results[key] = (found, result)
+        if not found:
+            raise result
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.config, name)
+
+    def __repr__(self):
+        return "<CachedConfig {}>".format(self.study)
+
+
+def get_config(study=None):
+    """Get a datman config for a study, reusing one from an earlier call.
+
+    Configs are kept for the life of the process and rebuilt if the site or
+    study config file is modified.
+
+    Args:
+        study (str, optional): The ID of the study to load the config for.
+            If not given, only the site config is loaded.
+
+    Raises:
+        Any exception datman.config raises when the config can't be read.
+
+    Returns:
+        :obj:`CachedConfig`: The study's config.
+    """
+    config = _configs.get(study)
+    if config is not None and not config.is_stale():
+        return config
+
+    with _configs_lock:
+        config = _configs.get(study)
+        if config is None or config.is_stale():
+            config = CachedConfig(study)
+            _configs[study] = config
+    return config
+
+
+def clear_config_cache():
+    """Discard all cached datman configs.
+    """
+    with _configs_lock:
+        _configs.clear()
+
+
+def _config_files(config):
+    files = [getattr(config, 'site_config_path', None),
+             getattr(config, 'study_config_file', None)]
+    return [item for item in files if item]
+
+
+def _get_mtimes(files):
+    mtimes = []
+    for item in files:
+        try:
+            mtimes.append(os.stat(item).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def plan_timepoint(timepoint):
+    """List everything on disk that belongs to a timepoint.
+
+    Returns:
+        list: A deletion plan for :py:func:`run_deletion`.
+    """
+    config = get_config(timepoint.get_study().id)
+    plan = []
 
     for path_key in ['dcm', 'nii', 'mnc', 'nrrd', 'jsons', 'qc']:
-        delete(config, path_key, folder=str(timepoint))
+        _plan(plan, config, path_key, folder=str(timepoint))
 
     for num in timepoint.sessions:
-        delete(config,
-               'dicom',
-               files=['{}.zip'.format(str(timepoint.sessions[num]))])
-        delete(config, 'resources', folder=str(timepoint.sessions[num]))
-        delete(config,
-               'std',
-               files=[scan.name for scan in timepoint.sessions[num].scans])
-
-    if not timepoint.bids_name:
-        return
+        _plan(plan,
+              config,
+              'dicom',
+              files=['{}.zip'.format(str(timepoint.sessions[num]))])
+        _plan(plan, config, 'resources', folder=str(timepoint.sessions[num]))
+        _plan(plan,
+              config,
+              'std',
+              files=[scan.name for scan in timepoint.sessions[num].scans])
 
-    delete_bids(config, timepoint.bids_name, timepoint.bids_session)
+    if timepoint.bids_name:
+        _plan_bids(plan, config, timepoint.bids_name, timepoint.bids_session)
 
+    return plan
 
-def delete_session(session):
-    config = datman.config.config(study=session.get_study().id)
+
+def plan_session(session):
+    """List everything on disk that belongs to a session.
+
+    Returns:
+        list: A deletion plan for :py:func:`run_deletion`.
+    """
+    config = get_config(session.get_study().id)
+    plan = []
 
     files = [scan.name for scan in session.scans]
     for path_key in ['dcm', 'nii', 'mnc', 'nrrd', 'jsons']:
-        delete(config, path_key, folder=str(session.timepoint), files=files)
+        _plan(plan, config, path_key, folder=str(session.timepoint),
+              files=files)
 
-    delete(config, 'dicom', files=['{}.zip'.format(str(session))])
-    delete(config, 'resources', folder=str(session))
-    delete(config, 'std', files=files)
+    _plan(plan, config, 'dicom', files=['{}.zip'.format(str(session))])
+    _plan(plan, config, 'resources', folder=str(session))
+    _plan(plan, config, 'std', files=files)
 
     timepoint = session.timepoint
-    if not timepoint.bids_name:
-        return
+    if timepoint.bids_name:
+        _plan_bids(plan, config, timepoint.bids_name, timepoint.bids_session,
+                   [scan.bids_name for scan in session.scans])
 
-    for scan in session.scans:
-        delete_bids(config, timepoint.bids_name, timepoint.bids_session, scan)
+    return plan
 
 
-def delete_scan(scan):
-    config = datman.config.config(study=scan.get_study().id)
+def plan_scan(scan):
+    """List everything on disk that belongs to a scan.
+
+    Returns:
+        list: A deletion plan for :py:func:`run_deletion`.
+    """
+    config = get_config(scan.get_study().id)
+    plan = []
 
     for path_key in ['dcm', 'nii', 'mnc', 'nrrd', 'jsons']:
-        delete(config, path_key, folder=str(scan.timepoint), files=[scan.name])
+        _plan(plan, config, path_key, folder=str(scan.timepoint),
+              files=[scan.name])
 
-    delete(config, 'std', files=[scan.name])
+    _plan(plan, config, 'std', files=[scan.name])
 
-    if not scan.bids_name:
-        return
+    if scan.bids_name:
+        timepoint = scan.session.timepoint
+        _plan_bids(plan, config, timepoint.bids_name, timepoint.bids_session,
+                   [scan.bids_name])
 
-    timepoint = scan.session.timepoint
-    delete_bids(config, timepoint.bids_name, timepoint.bids_session, scan)
+    return plan
+
+
+def delete_timepoint(timepoint):
+    run_deletion(plan_timepoint(timepoint))
+
+
+def delete_session(session):
+    run_deletion(plan_session(session))
+
+
+def delete_scan(scan):
+    run_deletion(plan_scan(scan))
 
 
 def get_study_path(study, folder=None):
@@ -86,10 +232,9 @@ def get_study_path(study, folder=None):
     If folder is supplied and is defined in study config
     then path to the folder is returned instead.
     """
-    cfg = datman.config.config()
     if folder:
         try:
-            path = cfg.get_path(folder, study)
+            path = get_config(study).get_path(folder)
         except Exception as e:
             logger.error("Failed to find folder {} for study {}. Reason: {}"
                          "".format(folder, study, e))
@@ -97,17 +242,100 @@ def get_study_path(study, folder=None):
         return path
 
     try:
-        path = cfg.get_study_base(study=study)
+        path = get_config(study).get_study_base()
     except Exception as e:
         logger.error("Failed to find path for {}. Reason: {}".format(study, e))
         path = None
     return path
 
 
-def delete(config, key, folder=None, files=None):
-    if files and not isinstance(files, list):
-        files = [files]
+def get_nifti_path(scan):
+    """Get the full path to a scan's NIfTI file.
+    """
+    study = scan.get_study().id
+    nii_folder = get_study_path(study, folder='nii')
+    fname = "_".join([scan.name, scan.description + ".nii.gz"])
+
+    full_path = os.path.join(nii_folder, scan.timepoint, fname)
+    if not os.path.exists(full_path):
+        full_path = full_path.replace(".nii.gz", ".nii")
+
+    return full_path
+
+
+def get_preview_path(scan, kind):
+    """Get the full path to one of a scan's preview images.
+
+    Previews are kept in a 'previews' folder beside the scan's QC outputs.
+
+    Args:
+        scan (:obj:`dashboard.models.Scan`): The scan to find a preview for.
+        kind (str): The type of preview (e.g. 'mosaic' or 'thumb').
 
+    Returns:
+        str: The path, or None if the study has no QC folder.
+    """
+    qc_folder = get_study_path(scan.get_study().id, folder='qc')
+    if not qc_folder:
+        return None
+    return os.path.join(qc_folder, scan.timepoint, 'previews',
+                        '{}_{}.png'.format(scan.name, kind))
+
+
+def get_volume_folder(scan):
+    """Get the folder that holds a scan's multi-resolution volume.
+
+    See :py:mod:`dashboard.volumes`. The folder is kept beside the scan's QC
+    outputs.
+
+    Returns:
+        str: The path, or None if the study has no QC folder.
+    """
+    qc_folder = get_study_path(scan.get_study().id, folder='qc')
+    if not qc_folder:
+        return None
+    return os.path.join(qc_folder, scan.timepoint, 'volumes', scan.name)
+
+
+def run_deletion(plan, workers=1, callback=None):
+    """Delete everything in a deletion plan.
+
+    Plans are JSON serializable lists, so they can be made while the
+    database records still exist and run later (e.g. by
+    :py:func:`dashboard.deletions.run_deletion_job`). Entries are
+    independent of each other and are deleted in parallel when more than one
+    worker is used.
+
+    Args:
+        plan (list): A plan made by :py:func:`plan_timepoint`,
+            :py:func:`plan_session` or :py:func:`plan_scan`.
+        workers (int, optional): The number of entries to delete at once.
+        callback (function, optional): Called (in the caller's thread) with
+            the result of each entry as it finishes. If it raises, entries
+            that haven't started yet are skipped and the exception is
+            re-raised.
+
+    Returns:
+        list: A dictionary for each entry with the 'path' deleted, the number
+        of files and folders 'removed' and any 'error' encountered.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = [pool.submit(_delete_entry, entry) for entry in plan]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if callback:
+                    callback(result)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+def _plan(plan, config, key, folder=None, files=None):
     try:
         path = config.get_path(key)
     except Exception:
@@ -116,65 +344,158 @@ def delete(config, key, folder=None, files=None):
     if folder:
         path = os.path.join(path, folder)
 
-    if not os.path.exists(path):
+    plan.append({'path': path, 'files': files})
+
+
+def _plan_bids(plan, config, subject, session, files=None):
+    try:
+        bids = config.get_path('bids')
+    except Exception:
         return
 
+    if files is not None:
+        files = [item for item in files if item]
+        if not files:
+            return
+
+    plan.append({
+        'bids': bids,
+        'subject': subject,
+        'session': session,
+        'files': files
+    })
+
+
+def get_deletion_path(entry):
+    """Get the path that an entry of a deletion plan deletes from.
+    """
+    if 'bids' in entry:
+        return os.path.join(entry['bids'], 'sub-{}'.format(entry['subject']),
+                            'ses-{}'.format(entry['session']))
+    return entry['path']
+
+
+def _delete_entry(entry):
+    path = get_deletion_path(entry)
+    delete_func = _delete_bids if 'bids' in entry else _delete_path
+
+    result = {'path': path, 'removed': 0, 'error': None}
+    try:
+        result['removed'] = delete_func(path, entry['files'])
+    except Exception as e:
+        logger.error("Failed to delete {}. Reason: {}".format(path, e))
+        result['error'] = str(e)
+    return result
+
+
+def _delete_path(path, files=None):
+    if not os.path.exists(path):
+        return 0
+
     if files is None:
         shutil.rmtree(path)
-        return
+        return 1
 
+    removed = 0
     for item in files:
         matches = glob.glob(os.path.join(path, item + "*"))
         for match in matches:
             os.remove(match)
+            removed += 1
 
     if not os.listdir(path):
         os.rmdir(path)
+    return removed
 
 
-def delete_bids(config, subject, session, scan=None):
-    try:
-        bids = config.get_path('bids')
-    except Exception:
-        return
-
-    subject_folder = os.path.join(bids, 'sub-{}'.format(subject))
-    session_folder = os.path.join(subject_folder, 'ses-{}'.format(session))
-
-    if not scan:
-        if os.path.exists(session_folder):
-            shutil.rmtree(session_folder)
-            if not os.listdir(subject_folder):
-                os.rmdir(subject_folder)
-        return
-
-    if not scan.bids_name:
-        return
+def _delete_bids(session_folder, files=None):
+    subject_folder = os.path.dirname(session_folder)
 
-    bids_file = datman.scanid.parse_bids_filename(scan.bids_name)
-    sub_dirs = []
+    if files is None:
+        if not os.path.exists(session_folder):
+            return 0
+        shutil.rmtree(session_folder)
+        if not os.listdir(subject_folder):
+            os.rmdir(subject_folder)
+        return 1
+
+    matches, sub_dirs = find_bids_files(session_folder, files)
+    for path in matches:
+        os.remove(path)
+
+    # Clean up any folders that may now be empty, deepest first
     sub_dirs.append(subject_folder)
-    sub_dirs.append(session_folder)
-    for path, dirs, files in os.walk(session_folder):
-        for sub_dir in dirs:
-            sub_dirs.append(os.path.join(path, sub_dir))
-
-        for item in files:
-            if bids_file == item:
-                full_path = os.path.join(path, item)
-                os.remove(full_path)
-
-    # Clean up any folders that may now be empty
-    for sub_dir in reversed(sub_dirs):
+    for sub_dir in sub_dirs:
         try:
             os.rmdir(sub_dir)
         except OSError:
             pass
+    return len(matches)
 
 
-def update_header_diffs(scan):
-    site = scan.session.timepoint.site_id
-    config = datman.config.config(study=scan.get_study().id)
+def find_bids_files(session_folder, bids_names):
+    """Find the files for a list of BIDS scans in a single pass.
+
+    The session folder is read once. Each file found is indexed by its BIDS
+    entities and matched against every requested scan at the same time.
+
+    Args:
+        session_folder (str): The full path to a BIDS session folder.
+        bids_names (list): The BIDS names of the scans to find.
+
+    Returns:
+        tuple: A list of the full path to every matching file and a list of
+        every folder in the session, ordered so that sub-folders come before
+        their parents.
+    """
+    targets = {}
+    for name in bids_names:
+        bids_file = datman.scanid.parse_bids_filename(name)
+        targets.setdefault(_bids_key(bids_file), []).append(bids_file)
+
+    matches = []
+    found_dirs = []
+    pending = [session_folder]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError:
+            continue
+        found_dirs.append(current)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+                continue
+            try:
+                key = _bids_key(datman.scanid.parse_bids_filename(entry.name))
+            except Exception:
+                continue
+            if any(item == entry.name for item in targets.get(key, [])):
+                matches.append(entry.path)
+
+    # Folders are found parents first, so reversing puts children first
+    return matches, list(reversed(found_dirs))
+
+
+def _bids_key(bids_file):
+    return tuple(getattr(bids_file, attr, None)
+                 for attr in ('subject', 'session', 'run', 'suffix'))
+
+
+def get_diff_settings(study, site, tag):
+    """Get the settings used to compare a type of scan to its gold standard.
+
+    Args:
+        study (str): The study ID.
+        site (str): The site ID.
+        tag (str): The scan tag.
+
+    Returns:
+        tuple: The header fields to ignore, the tolerance for each field and
+        whether bval files should also be compared.
+    """
+    config = get_config(study)
 
     try:
         tolerance = config.get_key("HeaderFieldTolerance", site=site)
@@ -187,12 +508,59 @@ def update_header_diffs(scan):
 
     tags = config.get_tags(site=site)
     try:
-        qc_type = tags.get(scan.tag, "qc_type")
+        qc_type = tags.get(tag, "qc_type")
     except KeyError:
         check_bvals = False
     else:
         check_bvals = qc_type == 'dti'
 
-    scan.update_header_diffs(ignore=ignore,
-                             tolerance=tolerance,
-                             bvals=check_bvals)
+    return ignore, tolerance, check_bvals
+
+
+def update_header_diffs(scan, commit=True, force=False):
+    site = scan.session.timepoint.site_id
+    ignore, tolerance, check_bvals = get_diff_settings(scan.get_study().id,
+                                                       site, scan.tag)
+    return scan.update_header_diffs(ignore=ignore,
+                                    tolerance=tolerance,
+                                    bvals=check_bvals,
+                                    commit=commit,
+                                    force=force)
+
+
+def add_session_jsons(session, json_files, timestamps=None, workers=8):
+    """Add JSON sidecars for a session's scans and update their header diffs.
+
+    All of the files are read and saved at once (see
+    :py:meth:`dashboard.models.Session.add_jsons`) and then the header diffs
+    for every updated scan are saved in a single commit.
+
+    Args:
+        session (:obj:`dashboard.models.Session`): The session the scans
+            belong to.
+        json_files (dict or list): Scan names mapped to JSON file paths, or
+            a list of paths.
+        timestamps (dict, optional): Creation times to record, keyed by scan
+            name.
+        workers (int, optional): The number of files to read at a time.
+
+    Returns:
+        list: The scans that were updated.
+    """
+    scans = session.add_jsons(json_files, timestamps=timestamps,
+                              workers=workers)
+    db_session = object_session(session)
+    session.prefetch_gold_standards()
+    for scan in scans:
+        try:
+            update_header_diffs(scan, commit=False)
+        except Exception as e:
+            # Usually just means there's no gold standard for the scan yet
+            logger.info("Header diffs not updated for {}. Reason: {}".format(
+                scan, e))
+    try:
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    return scans
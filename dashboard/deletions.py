@@ -0,0 +1,203 @@
+"""Delete raw data from the file system in the background.
+
+Deleting a timepoint's files can take longer than a request is allowed to
+run, especially on network storage. Instead, views record what needs to be
+removed as a :py:class:`dashboard.models.DeletionJob` with
+:py:func:`queue_deletion` and the server deletes it with
+:py:func:`run_deletion_job`. The job's progress and results are saved as it
+runs, so they can be polled for and kept as an audit record.
+
+:py:func:`sweep_deletion_jobs` runs periodically on the server to schedule
+jobs that are still waiting and to requeue running jobs that have stalled.
+A running job is owned by the run that claimed it. The run records a
+heartbeat while it works and checks that it still owns the job before
+saving anything, so a requeued job is never written to by two runs.
+"""
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+
+from dashboard import scheduler, db
+from .exceptions import ClaimLostException
+from .models import DeletionJob
+from .datman_utils import run_deletion, get_deletion_path
+
+logger = logging.getLogger(__name__)
+
+
+def queue_deletion(study, target, plan, user=None):
+    """Record files to delete and start deleting them in the background.
+
+    The job is committed immediately, so database records may be deleted as
+    soon as this returns.
+
+    Args:
+        study (str): The ID of the study the files belong to.
+        target (str): The name of the timepoint, session or scan being
+            deleted.
+        plan (list): A deletion plan from one of the 'plan' functions in
+            :py:mod:`dashboard.datman_utils`.
+        user (:obj:`dashboard.models.User`, optional): The user that asked
+            for the deletion.
+
+    Returns:
+        :obj:`dashboard.models.DeletionJob`: The new job.
+    """
+    job = DeletionJob(study, target, plan,
+                      user_id=user.id if user else None)
+    db.session.add(job)
+    db.session.commit()
+
+    schedule_deletion_job(job)
+    return job
+
+
+def schedule_deletion_job(job):
+    """Schedule a queued deletion job to run in the 'deletion' lane.
+
+    A job that is already waiting to run is replaced, so this is safe to
+    call more than once for the same job.
+    """
+    try:
+        scheduler.add_job('deletion_{}'.format(job.id),
+                          run_deletion_job,
+                          trigger='date',
+                          run_date=datetime.now(),
+                          args=[job.id],
+                          replace_existing=True)
+    except Exception as e:
+        # The job is still in the queue, so the next sweep will retry
+        logger.error("Failed to schedule deletion job {} for {}. Reason - "
+                     "{}".format(job.id, job.target, e))
+
+
+def run_deletion_job(job_id):
+    """Delete the files recorded in a queued deletion job.
+
+    Entries in the job's plan are deleted in parallel by up to
+    'DELETION_WORKERS' threads and progress is saved every
+    'DELETION_PROGRESS_SECONDS'. Entries that a requeued job already deleted
+    are skipped. Nothing happens if the job has already been started
+    elsewhere. If the job is taken away from this run (i.e. it was requeued
+    by :py:func:`sweep_deletion_jobs`) the run stops without saving.
+
+    Args:
+        job_id (int): The ID of a :py:class:`dashboard.models.DeletionJob`.
+    """
+    job = DeletionJob.claim(job_id)
+    if not job:
+        db.session.rollback()
+        return
+    token = uuid.uuid4().hex
+    job.start(token)
+    db.session.commit()
+
+    deleted = set(item['path'] for item in job.results or [])
+    plan = [entry for entry in job.plan
+            if get_deletion_path(entry) not in deleted]
+
+    interval = current_app.config.get('DELETION_PROGRESS_SECONDS', 5)
+    pending = []
+    last_save = time.time()
+
+    stop = threading.Event()
+    lost = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat,
+        args=(db.engine, job.id, token,
+              current_app.config.get('DELETION_HEARTBEAT_SECONDS', 30),
+              stop, lost),
+        daemon=True)
+    heartbeat.start()
+
+    def save(finish=False):
+        if lost.is_set() or not job.is_owner(token):
+            db.session.rollback()
+            raise ClaimLostException(
+                "Deletion job {} was taken over by another run".format(
+                    job.id))
+        job.add_results(pending)
+        if finish:
+            job.finish()
+        db.session.commit()
+        pending.clear()
+
+    def save_progress(result):
+        nonlocal last_save
+        pending.append(result)
+        if time.time() - last_save < interval:
+            return
+        save()
+        last_save = time.time()
+
+    try:
+        run_deletion(plan,
+                     workers=current_app.config.get('DELETION_WORKERS', 8),
+                     callback=save_progress)
+        save(finish=True)
+    except ClaimLostException as e:
+        logger.error("{}. Stopping without saving {} results.".format(
+            e, len(pending)))
+        return
+    except Exception:
+        # Record what was finished before the failure
+        db.session.rollback()
+        save(finish=True)
+        raise
+    finally:
+        stop.set()
+
+    if job.state == job.FAILED:
+        logger.error("Deletion job {} for {} finished with errors.".format(
+            job.id, job.target))
+
+
+def _heartbeat(engine, job_id, token, interval, stop, lost):
+    """Keep a running deletion job's 'updated' time current.
+
+    This runs in its own thread (with its own connection) for as long as a
+    run owns the job, so that slow deletions aren't mistaken for lost ones.
+    'lost' is set and the thread exits if the job stops belonging to the
+    run.
+    """
+    table = DeletionJob.__table__
+    while not stop.wait(interval):
+        query = table.update() \
+                     .where(table.c.id == job_id) \
+                     .where(table.c.claimed_by == token) \
+                     .values(updated=datetime.now(timezone.utc))
+        try:
+            with engine.begin() as conn:
+                result = conn.execute(query)
+        except Exception as e:
+            logger.error("Failed to record heartbeat for deletion job {}. "
+                         "Reason - {}".format(job_id, e))
+            continue
+        if not result.rowcount:
+            lost.set()
+            return
+
+
+def sweep_deletion_jobs():
+    """Schedule any deletion jobs that are waiting or have stalled.
+
+    This runs periodically on the server to pick up jobs that couldn't be
+    scheduled when they were queued or that were lost to a restart. Running
+    jobs that haven't had a heartbeat in 'DELETION_STALL_MINUTES' belonged
+    to a run that died, so they're put back in the queue. Each job is
+    scheduled separately in the 'deletion' lane.
+    """
+    minutes = current_app.config.get('DELETION_STALL_MINUTES', 60)
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+    for job in DeletionJob.stalled(cutoff).all():
+        logger.warning("Requeueing deletion job {} for {}, no heartbeat "
+                       "since {}".format(job.id, job.target, job.updated))
+        job.requeue()
+    db.session.commit()
+
+    for job in DeletionJob.queued().all():
+        schedule_deletion_job(job)
@@ -1,9 +1,8 @@
 """Functions for sending email notifications.
 
-If an email message **must** be sent from the server side, and it isn't used
-exclusively by view functions (which only run on the server), then it needs to
-be given to the scheduler. That means it needs a monitor and a check function.
-To learn more about monitor/check functions see :py:mod:`dashboard.monitors`
+All messages are added to the email outbox table and delivered by the server
+(see :py:mod:`dashboard.mailer`), so email functions can be called directly
+from views, scheduler jobs or imported (client side) code.
 
 Any email notifications that might be submitted to the scheduler must only
 receive arguments that are JSON serializable.
@@ -12,42 +11,21 @@ for info on serializable types).
 """
 
 import logging
-from threading import Thread
-from functools import wraps
 
 from flask import current_app
 from flask_mail import Message
 
-from dashboard import mail
+from dashboard import outbox
 
 logger = logging.getLogger(__name__)
 
 
-def async_exec(f):
-    """Allow a given function to execute in the background.
-    """
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        thr = Thread(target=f, args=args, kwargs=kwargs)
-        thr.start()
-
-    return wrapper
-
-
-@async_exec
-def send_async_email(app, email):
-    """Send an email in the background.
-
-    Args:
-        app (:obj:`flask.Flask`): The current application instance.
-        email (:obj:`flask_mail.Message`): The message to send.
-    """
-    with app.app_context():
-        mail.send(email)
-
-
 def send_email(subject, body, html_body=None, recipient=None):
-    """Organize email contents into a message and send it in the background.
+    """Organize email contents into a message and add it to the outbox.
+
+    The message is saved to the database and sent in the background by the
+    server's :py:class:`dashboard.mailer.MailWorker`, so this never waits on
+    the mail server and is safe to call from any process.
 
     Args:
         subject (str): The subject line.
@@ -71,22 +49,32 @@ def send_email(subject, body, html_body=None, recipient=None):
     email.body = body
     if html_body:
         email.html = html_body
-    send_async_email(current_app._get_current_object(), email)
+    outbox.send(email)
 
 
 def missing_redcap_email(session, study=None, dest_emails=None):
-    """Notify that a session that requires a REDCap survey did not receive one.
+    """Notify that sessions that require a REDCap survey did not receive one.
 
     Args:
-        session (str): A session ID.
-        study (str, optional): The study that the session belongs to.
+        session (str or :obj:`list` of str): A session ID or a list of
+            session IDs.
+        study (str, optional): The study that the session(s) belong to.
         dest_emails (str or :obj:`list` of str, optional): Email address(es) to
             relay the notification to.
     """
     subject = "Missing REDCap Survey"
     if study:
         subject = study + "- " + subject
-    body = "A 'Scan Completed' survey is expected for session '{}' but a " \
-           "survey has not been received. Please remember to fill out the " \
-           "survey or let us know if this email is in error.".format(session)
+    if isinstance(session, list) and len(session) == 1:
+        session = session[0]
+    if isinstance(session, list):
+        body = "A 'Scan Completed' survey is expected for the following " \
+               "sessions but a survey has not been received:\n\n{}\n\n" \
+               "Please remember to fill out the surveys or let us know if " \
+               "this email is in error.".format("\n".join(session))
+    else:
+        body = "A 'Scan Completed' survey is expected for session '{}' but " \
+               "a survey has not been received. Please remember to fill out " \
+               "the survey or let us know if this email is in " \
+               "error.".format(session)
     send_email(subject, body, recipient=dest_emails)
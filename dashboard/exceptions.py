@@ -20,6 +20,12 @@ class SchedulerException(Exception):
     pass
 
 
+class ClaimLostException(Exception):
+    """An exception for background jobs that another worker has taken over.
+    """
+    pass
+
+
 class InvalidUsage(Exception):
     """An exception for incorrect usage of the URL endpoints.
     """
@@ -8,8 +8,10 @@ or avoiding CSRF vulnerabilities.
 
 from flask_wtf import FlaskForm
 from wtforms import (SelectMultipleField, HiddenField, TextAreaField,
-                     TextField)
-from wtforms.validators import DataRequired
+                     TextField, SelectField)
+from wtforms.validators import DataRequired, ValidationError
+
+from .queries import parse_header_predicate
 
 
 class SelectMetricsForm(FlaskForm):
@@ -52,3 +54,27 @@ class AnalysisForm(FlaskForm):
     name = TextField('Brief name', validators=[DataRequired()])
     description = TextAreaField('Description', validators=[DataRequired()])
     software = TextAreaField('Software')
+
+
+class HeaderSearchForm(FlaskForm):
+    """Find a study's scans by the fields in their JSON headers.
+
+    The site and tag choices must be filled in by the view. After validation
+    the parsed tests are in 'parsed'.
+    """
+    site = SelectField('Site', default='')
+    tag = SelectField('Scan type', default='')
+    predicates = TextAreaField(
+        'Header tests',
+        validators=[DataRequired()],
+        description="One per line, e.g. 'RepetitionTime != 2.0' or "
+        "'SliceTiming missing'")
+
+    def validate_predicates(self, field):
+        try:
+            self.parsed = [
+                parse_header_predicate(line)
+                for line in field.data.splitlines() if line.strip()
+            ]
+        except ValueError as e:
+            raise ValidationError(str(e))
@@ -0,0 +1,274 @@
+"""Recompute header diffs for many scans at once.
+
+When a new gold standard is added every scan it applies to needs to be
+compared against it. :py:func:`rediff_scans` does this for a whole study,
+site and tag at once: scan headers are loaded with a single query, compared
+and the results saved with one bulk upsert into 'scan_gold_standard'. Scans
+whose diffs were already made from the same scan and gold standard contents
+and the same settings (see the hashes on
+:py:class:`dashboard.models.ScanGoldStandard`) are skipped, unless their
+bval files are also compared.
+
+:py:func:`sweep_gold_standards` runs periodically on the server to find
+gold standards that haven't been compared against any scans yet. Each one
+is compared by its own :py:func:`compare_gold_standard` job in the
+'headers' lane. That lane runs in worker processes (see
+'SCHEDULER_PROCESS_LANES'), so its size sets how many gold standards are
+compared in parallel. A gold standard is only marked as compared once its
+comparison succeeds. Failed comparisons are retried by later sweeps, up to
+'HEADER_DIFF_MAX_ATTEMPTS' times.
+"""
+import logging
+import datetime
+
+from flask import current_app
+from psycopg2.tz import FixedOffsetTimezone
+from sqlalchemy import and_, or_, select, bindparam
+from sqlalchemy.dialects.postgresql import insert
+
+from datman import header_checks
+
+from dashboard import scheduler, db, TZ_OFFSET
+from .models import (Scan, Timepoint, GoldStandard, ScanGoldStandard,
+                     HeaderBlob, study_timepoints_table)
+from .models.utils import (get_software_version, load_compressed_json,
+                           hash_diff_settings)
+from .datman_utils import get_diff_settings
+
+logger = logging.getLogger(__name__)
+
+
+def rediff_scans(study, site, tag, standard=None, force=False):
+    """Compare every scan of one type from a study site to a gold standard.
+
+    Args:
+        study (str): The study ID.
+        site (str): The site ID.
+        tag (str): The scan tag.
+        standard (:obj:`dashboard.models.GoldStandard`, optional): The gold
+            standard to compare to. Defaults to the newest one for the
+            study, site and tag.
+        force (bool, optional): Compare scans even if their diffs are up to
+            date.
+
+    Returns:
+        int: The number of scans whose diffs were saved.
+    """
+    if standard is None:
+        found = GoldStandard.find(study, site, [tag])[tag]
+        standard = found[0] if found else None
+    if standard is None or not standard.json_contents:
+        return 0
+
+    ignore, tolerance, bvals = get_diff_settings(study, site, tag)
+    settings_hash = hash_diff_settings(ignore, tolerance, bvals)
+
+    query = select([Scan.id, HeaderBlob.contents, HeaderBlob.compressed,
+                    Scan.json_path, Scan.json_hash]) \
+        .select_from(
+            Scan.__table__
+                .join(HeaderBlob.__table__, Scan.json_hash == HeaderBlob.hash)
+                .join(Timepoint.__table__, Scan.timepoint == Timepoint.name)
+                .join(study_timepoints_table,
+                      and_(study_timepoints_table.c.timepoint ==
+                           Timepoint.name,
+                           study_timepoints_table.c.study == study))
+                .outerjoin(ScanGoldStandard.__table__,
+                           and_(ScanGoldStandard.scan_id == Scan.id,
+                                ScanGoldStandard.gold_standard_id ==
+                                standard.id))) \
+        .where(Timepoint.site_id == site) \
+        .where(Scan.tag == tag)
+    if not force and not bvals and standard.json_hash:
+        query = query.where(or_(
+            ScanGoldStandard.scan_hash.is_(None),
+            ScanGoldStandard.scan_hash != Scan.json_hash,
+            ScanGoldStandard.gold_hash.is_(None),
+            ScanGoldStandard.gold_hash != standard.json_hash,
+            ScanGoldStandard.settings_hash.is_(None),
+            ScanGoldStandard.settings_hash != settings_hash))
+    scans = db.session.execute(query).fetchall()
+    if not scans:
+        return 0
+
+    results = _compare_scans(scans,
+                             gs_contents=standard.json_contents,
+                             gs_path=standard.json_path,
+                             ignore=ignore,
+                             tolerance=tolerance,
+                             bvals=bvals)
+    save_diffs(standard, results, settings_hash=settings_hash)
+    return len(results)
+
+
+def save_diffs(standard, results, settings_hash=None):
+    """Insert or update many scans' diffs against one gold standard.
+
+    The scans' header diff status columns are then updated to match their
+    diffs against the newest gold standard they've been compared to, which
+    isn't necessarily 'standard'.
+
+    Args:
+        standard (:obj:`dashboard.models.GoldStandard`): The gold standard
+            the scans were compared to.
+        results (list): A (scan ID, diffs, scan software version, scan
+            contents hash) tuple for each scan.
+        settings_hash (str, optional): A hash of the settings the scans
+            were compared with (see
+            :py:func:`dashboard.models.utils.hash_diff_settings`).
+    """
+    if not results:
+        return
+    now = datetime.datetime.now(FixedOffsetTimezone(offset=TZ_OFFSET))
+    gold_version = get_software_version(standard.json_contents)
+    rows = [{
+        'scan': scan_id,
+        'gold_standard': standard.id,
+        'header_diffs': diffs,
+        'gold_version': gold_version,
+        'scan_version': scan_version,
+        'scan_hash': scan_hash,
+        'gold_hash': standard.json_hash,
+        'settings_hash': settings_hash,
+        'date_added': now
+    } for scan_id, diffs, scan_version, scan_hash in results]
+
+    stmt = insert(ScanGoldStandard.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['scan', 'gold_standard'],
+        set_={
+            'header_diffs': stmt.excluded.header_diffs,
+            'gold_version': stmt.excluded.gold_version,
+            'scan_version': stmt.excluded.scan_version,
+            'scan_hash': stmt.excluded.scan_hash,
+            'gold_hash': stmt.excluded.gold_hash,
+            'settings_hash': stmt.excluded.settings_hash,
+            'date_added': stmt.excluded.date_added
+        })
+
+    scans = Scan.__table__
+    status = scans.update() \
+                  .where(scans.c.id == bindparam('scan_id')) \
+                  .values(has_header_diffs=bindparam('has_diffs'),
+                          diff_field_count=bindparam('count'))
+
+    try:
+        for start in range(0, len(rows), 500):
+            db.session.execute(stmt, rows[start:start + 500])
+            scan_ids = [row['scan'] for row in rows[start:start + 500]]
+            statuses = [{
+                'scan_id': scan_id,
+                'has_diffs': bool(diffs),
+                'count': len(diffs or {})
+            } for scan_id, diffs in _newest_diffs(scan_ids)]
+            db.session.execute(status, statuses)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _newest_diffs(scan_ids):
+    """Get each scan's diffs against its newest gold standard.
+
+    Returns:
+        list: A (scan ID, diffs) tuple for each scan that has diffs.
+    """
+    sgs = ScanGoldStandard.__table__
+    gs = GoldStandard.__table__
+    query = select([sgs.c.scan, sgs.c.header_diffs]) \
+        .select_from(sgs.join(gs, gs.c.id == sgs.c.gold_standard)) \
+        .where(sgs.c.scan.in_(scan_ids)) \
+        .order_by(sgs.c.scan, gs.c.added.desc().nullslast(), gs.c.id.desc()) \
+        .distinct(sgs.c.scan)
+    return db.session.execute(query).fetchall()
+
+
+def sweep_gold_standards():
+    """Compare scans to any gold standards that haven't been used yet.
+
+    This runs periodically on the server. Only the newest gold standard for
+    each study, site and tag is used. It's queued to be compared by
+    :py:func:`compare_gold_standard` and the older ones are just marked as
+    compared. Gold standards that have already failed to compare
+    'HEADER_DIFF_MAX_ATTEMPTS' times are left alone.
+    """
+    attempts = current_app.config.get('HEADER_DIFF_MAX_ATTEMPTS', 3)
+    unused = GoldStandard.query.filter(
+        GoldStandard.compared.is_(None),
+        GoldStandard.compare_failures < attempts).all()
+    groups = {}
+    for standard in unused:
+        key = (standard.study, standard.site, standard.tag)
+        groups.setdefault(key, []).append(standard)
+
+    for (study, site, tag), standards in groups.items():
+        newest = standards[0]
+        for standard in standards[1:]:
+            if (not newest.json_created or
+                    (standard.json_created and
+                     standard.json_created > newest.json_created)):
+                newest = standard
+        for standard in standards:
+            if standard is not newest:
+                standard.mark_compared()
+        db.session.commit()
+
+        try:
+            scheduler.add_job('gold_standard_{}'.format(newest.id),
+                              compare_gold_standard,
+                              trigger='date',
+                              run_date=datetime.datetime.now(),
+                              args=[newest.id],
+                              replace_existing=True)
+        except Exception as e:
+            logger.error("Failed to queue header diffs for {}. Reason - "
+                         "{}".format(newest, e))
+
+
+def compare_gold_standard(standard_id):
+    """Compare every scan a gold standard applies to against it.
+
+    Args:
+        standard_id (int): The ID of a
+            :py:class:`dashboard.models.GoldStandard`.
+    """
+    standard = GoldStandard.query.get(standard_id)
+    if standard is None or standard.compared:
+        return
+    try:
+        count = rediff_scans(standard.study, standard.site, standard.tag,
+                             standard=standard)
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Failed to update header diffs for {}. Reason - "
+                     "{}".format(standard, e))
+        standard.mark_failed()
+    else:
+        logger.info("Updated header diffs for {} scans against {}".format(
+            count, standard))
+        standard.mark_compared()
+    db.session.commit()
+
+
+def _compare_scans(scans, gs_contents, gs_path, ignore, tolerance, bvals):
+    results = []
+    for scan_id, contents, compressed, json_path, scan_hash in scans:
+        try:
+            if compressed is not None:
+                contents = load_compressed_json(compressed)
+            diffs = header_checks.compare_headers(contents,
+                                                  gs_contents,
+                                                  ignore=ignore,
+                                                  tolerance=tolerance)
+            if bvals:
+                result = header_checks.check_bvals(json_path, gs_path)
+                if result:
+                    diffs['bvals'] = result
+        except Exception as e:
+            logger.error("Failed to compare headers for scan {}. Reason - "
+                         "{}".format(scan_id, e))
+            continue
+        results.append((scan_id, diffs, get_software_version(contents),
+                        scan_hash))
+    return results
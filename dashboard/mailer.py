@@ -0,0 +1,214 @@
+"""A background worker that delivers all of the dashboard's email.
+
+Email is sent through a database backed outbox. :py:meth:`MailWorker.send`
+(used by :py:func:`dashboard.emails.send_email`) adds a row to the
+'email_outbox' table and returns immediately, so any process, including
+imported clients and request handlers, can send mail without touching SMTP
+or the scheduler.
+
+On the server (or wherever 'MAIL_OUTBOX_DRAIN' is set) a single worker
+thread drains the outbox. It sends due messages in batches over one SMTP
+connection, which is kept open until there's been nothing to send for
+'MAIL_IDLE_TIMEOUT' seconds. Messages that fail to send are retried with an
+increasing delay. Messages added by the same process are sent right away,
+messages added by other processes are picked up within 'MAIL_POLL_SECONDS'.
+"""
+import os
+import time
+import logging
+import threading
+
+from flask_mail import Message
+
+logger = logging.getLogger(__name__)
+
+
+class MailWorker(object):
+    """Adds messages to the outbox and, if enabled, drains it.
+    """
+
+    def __init__(self, mail, app=None):
+        """Create a worker.
+
+        Args:
+            mail (:obj:`flask_mail.Mail`): The mail extension to send with.
+            app (:obj:`flask.Flask`, optional): The app to configure the worker
+                for. If not given, :py:meth:`init_app` must be called later.
+        """
+        self.mail = mail
+        self.app = None
+        self.drain = False
+        # The number of messages this worker has delivered
+        self.sent = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = app.config.get('MAIL_BATCH_SIZE', 50)
+        self.retry_delay = app.config.get('MAIL_RETRY', 30)
+        self.max_delay = app.config.get('MAIL_MAX_DELAY', 3600)
+        self.max_attempts = app.config.get('MAIL_MAX_ATTEMPTS', 8)
+        self.idle_timeout = app.config.get('MAIL_IDLE_TIMEOUT', 60)
+        self.poll_interval = app.config.get('MAIL_POLL_SECONDS', 30)
+        self.keep_days = app.config.get('MAIL_OUTBOX_KEEP_DAYS', 30)
+        self.drain = app.config.get('MAIL_OUTBOX_DRAIN', False)
+        if self.drain:
+            self._start()
+
+    def send(self, message):
+        """Add a message to the outbox.
+
+        Args:
+            message (:obj:`flask_mail.Message`): The message to send.
+
+        Returns:
+            int: The ID of the outbox entry.
+        """
+        from dashboard.models import OutgoingEmail
+
+        entry = OutgoingEmail.add(message.subject, _address(message.sender),
+                                  [_address(r) for r in message.recipients],
+                                  message.body, html=message.html)
+        if self.drain:
+            self._start()
+            self._wakeup.set()
+        return entry
+
+    def flush(self, conn=None):
+        """Send every message in the outbox that's due.
+
+        This must be run inside an app context.
+
+        Args:
+            conn (:obj:`flask_mail.Connection`, optional): An open connection
+                to send with. One will be opened if needed.
+
+        Returns:
+            :obj:`flask_mail.Connection`: The connection used, or None if it
+            was closed due to an error. The caller must close it when
+            finished.
+        """
+        from dashboard import db
+        from dashboard.models import OutgoingEmail
+
+        while True:
+            batch = OutgoingEmail.claim(self.batch_size, self.max_attempts)
+            if not batch:
+                db.session.commit()
+                return conn
+
+            for entry in batch:
+                try:
+                    if conn is None:
+                        conn = self.mail.connect()
+                        conn.__enter__()
+                    conn.send(_to_message(entry))
+                except Exception as e:
+                    # The connection may have dropped, start a new one for
+                    # the next message
+                    conn = self._close(conn)
+                    self._failed(entry, e)
+                    continue
+                entry.mark_sent()
+                self.sent += 1
+            db.session.commit()
+
+            if len(batch) < self.batch_size:
+                return conn
+
+    def _run(self):
+        conn = None
+        last_send = time.time()
+        last_purge = 0
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            sent = self.sent
+            with self.app.app_context():
+                try:
+                    conn = self.flush(conn)
+                    if time.time() - last_purge > 3600:
+                        self._purge()
+                        last_purge = time.time()
+                except Exception as e:
+                    logger.error("Failed to drain the email outbox. Reason - "
+                                 "{}".format(e))
+                    self._rollback()
+                    conn = self._close(conn)
+
+            if self.sent != sent:
+                last_send = time.time()
+            elif time.time() - last_send > self.idle_timeout:
+                conn = self._close(conn)
+
+    def _failed(self, entry, error):
+        delay = min(self.retry_delay * 2 ** entry.attempts, self.max_delay)
+        entry.mark_failed(str(error), delay)
+        if entry.attempts >= self.max_attempts:
+            logger.error("Giving up on message '{}' to {} after {} attempts. "
+                         "Reason - {}".format(entry.subject, entry.recipients,
+                                              entry.attempts, error))
+            return
+        logger.warning("Failed to send message '{}' to {}, retrying in {}s. "
+                       "Reason - {}".format(entry.subject, entry.recipients,
+                                            delay, error))
+
+    def _purge(self):
+        from dashboard.models import OutgoingEmail
+        if self.keep_days:
+            OutgoingEmail.purge(self.keep_days)
+
+    def _rollback(self):
+        from dashboard import db
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def _start(self):
+        if self._pid != os.getpid():
+            # A forked process doesn't inherit the parent's worker thread
+            self._pid = os.getpid()
+            self._thread = None
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name="mail-worker",
+                                            daemon=True)
+            self._thread.start()
+
+    def __repr__(self):
+        return "<MailWorker drain={}>".format(self.drain)
+
+
+def _address(address):
+    """Flatten a (name, address) pair into a single string.
+    """
+    if isinstance(address, (tuple, list)):
+        return "{} <{}>".format(*address)
+    return address
+
+
+def _to_message(entry):
+    message = Message(entry.subject,
+                      sender=entry.sender,
+                      recipients=entry.recipients)
+    message.body = entry.body
+    message.html = entry.html
+    return message
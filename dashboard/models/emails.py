@@ -82,26 +82,33 @@ def account_rejection_email(user_id, user_email):
     send_email(subject, body, recipient=user_email)
 
 
-def qc_notification_email(user_name, dest_email, study, current_tp,
-                          remain_tp=None):
-    """Notify QCers that there is a new session to review.
+def qc_digest_email(user_name, dest_email, new_timepoints, remaining=None):
+    """Send a QCer a summary of new sessions to review.
 
     Args:
         user_name (:obj:`str`): A user's real name.
         dest_email (:obj:`str`): Email address to contact.
-        study (:obj:`str`): The name of the study that has received data.
-        current_tp (:obj:`str`): The name of the timepoint that needs review.
-        remain_tp (:obj:`list` of :obj:`str`): A list of names of timepoints
-            from this study that are still awaiting quality control.
+        new_timepoints (:obj:`dict`): A dictionary mapping the name of each
+            study the user does QC for to a list of its new timepoints.
+        remaining (:obj:`dict`, optional): A dictionary mapping the same
+            study names to a list of timepoints still awaiting quality
+            control.
     """
-    subject = "{} - New scan, QC needed".format(study)
-    body = "Hi {}, you have been tagged as a QCer for {}".format(
-        user_name, study)
-    body += "\n\nNew scan: {}".format(current_tp)
+    if not remaining:
+        remaining = {}
 
-    if remain_tp:
-        body += "\n\nScans still needing QC:\n"
-        body += "\n".join(remain_tp)
+    total = sum(len(tps) for tps in new_timepoints.values())
+    subject = "{} - {} new scan{}, QC needed".format(
+        ", ".join(sorted(new_timepoints)), total, "" if total == 1 else "s")
+    body = "Hi {}, you have been tagged as a QCer for {}".format(
+        user_name, ", ".join(sorted(new_timepoints)))
+
+    for study in sorted(new_timepoints):
+        body += "\n\n{}\n\nNew scans:\n".format(study)
+        body += "\n".join(new_timepoints[study])
+        if remaining.get(study):
+            body += "\n\nScans still needing QC:\n"
+            body += "\n".join(remaining[study])
 
     body += "\n\nIf you wrongly recieved this email, " \
             "please contact staff at the Kimel Lab"
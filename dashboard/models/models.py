@@ -3,12 +3,16 @@
 import os
 import datetime
 import logging
+import threading
 from random import randint
 
+from flask import current_app, has_app_context
 from flask_login import UserMixin
-from sqlalchemy import and_, or_, exists, func
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import deferred, backref
+from sqlalchemy import and_, or_, exists, func, bindparam, event
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.orm import (deferred, backref, validates,
+                            make_transient_to_detached)
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.schema import UniqueConstraint, ForeignKeyConstraint
 from sqlalchemy.orm.exc import FlushError
 from sqlalchemy.exc import IntegrityError
@@ -21,10 +25,41 @@ from dashboard import db, TZ_OFFSET
 from dashboard.exceptions import InvalidDataException
 from dashboard.models import utils
 from .emails import (account_request_email, account_activation_email,
-                     account_rejection_email, qc_notification_email)
+                     account_rejection_email)
 
 logger = logging.getLogger(__name__)
 
+# The gold standards for each (study, site, tag), newest first. Each entry is
+# stored with the number of gold standards and the newest 'json_created' it
+# was read with, so standards added or removed elsewhere are noticed.
+_gold_standards = {}
+_gold_standards_lock = threading.Lock()
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _clear_prefetched(session):
+    # Gold standards from GoldStandard.find() are only reused until the
+    # transaction ends
+    session.info.pop('gold_standards', None)
+
+
+def _attach(model, values):
+    # Adds a cached record to the session without querying for it
+    record = model.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(record, key, value)
+    make_transient_to_detached(record)
+    return db.session.merge(record, load=False)
+
+
+def _standard_age(standard):
+    # Sorts gold standards oldest first (see header_diffs._newest_diffs)
+    created = standard.json_created if standard else None
+    return (created is not None,
+            created.timestamp() if created else 0,
+            standard.id if standard else 0)
+
 
 ###############################################################################
 # Association tables (i.e. basic many to many relationships)
@@ -61,6 +96,9 @@ class User(UserMixin, db.Model):
     picture = db.Column('picture', db.String(2048))
     dashboard_admin = db.Column('dashboard_admin', db.Boolean, default=False)
     is_active = db.Column('account_active', db.Boolean, default=False)
+    # When the user's access was last reduced. QC page tokens issued before
+    # then are refused (see dashboard.utils.check_qc_token)
+    access_changed = db.Column('access_changed', db.DateTime(timezone=True))
 
     studies = db.relationship(
         'StudyUser',
@@ -109,6 +147,13 @@ class User(UserMixin, db.Model):
         self.dashboard_admin = dashboard_admin
         self.account_active = account_active
 
+    @validates('dashboard_admin', 'is_active')
+    def _check_access_reduced(self, key, value):
+        if getattr(self, key) and not value:
+            self.access_changed = datetime.datetime.now(
+                FixedOffsetTimezone(offset=TZ_OFFSET))
+        return value
+
     def update_username(self, new_name, provider='github'):
         # Make sure the username is globally unique by adding a prefix based on
         # the oauth provider
@@ -255,6 +300,8 @@ class User(UserMixin, db.Model):
                         continue
                     db.session.delete(found[0])
 
+        self.access_changed = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
         try:
             db.session.commit()
         except Exception as e:
@@ -506,12 +553,14 @@ class Study(db.Model):
             raise
 
         if self.email_qc:
-            not_qcd = [t.name for t in self.timepoints.all() if not
-                       t.is_qcd()]
-            _ = [utils.schedule_email(qc_notification_email,
-                                      [str(u), u.email, self.id,
-                                       timepoint.name, not_qcd])
-                 for u in self.get_QCers()]
+            # QCers are sent a digest of all new timepoints periodically
+            db.session.add(TimepointNotification(self.id, timepoint.name))
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Failed to record QC notification for new "
+                             "timepoint {}. Reason: {}".format(timepoint, e))
 
         return timepoint
 
@@ -540,6 +589,8 @@ class Study(db.Model):
                                            "Record already exists "
                                            "in database - {}".format(
                                                gs_file, e))
+        else:
+            GoldStandard.clear_cache(new_gs.study, new_gs.site, new_gs.tag)
         return new_gs
 
     def num_timepoints(self, type=''):
@@ -1150,6 +1201,9 @@ class Session(db.Model):
                                     uselist=False,
                                     cascade='all, delete')
     task_files = db.relationship('TaskFile', cascade='all, delete')
+    monitors = db.relationship('SessionMonitor',
+                               back_populates='session',
+                               cascade='all, delete')
 
     def __init__(self,
                  name,
@@ -1185,6 +1239,102 @@ class Session(db.Model):
                                        "{}".format(name, e))
         return scan
 
+    def add_jsons(self, json_files, timestamps=None, workers=8):
+        """Add the JSON sidecars for many of this session's scans at once.
+
+        Files are read in parallel and every scan is updated in a single
+        transaction. If any file can't be read nothing is saved.
+
+        Args:
+            json_files (dict or list): A dictionary mapping scan names to
+                the full path of their JSON files, or a list of paths. Paths
+                in a list are matched to scans by file name (i.e.
+                '<scan name>_<description>.json').
+            timestamps (dict, optional): Creation times to record, keyed by
+                scan name. Scans not found here use their file's timestamp.
+            workers (int, optional): The number of files to read at a time.
+
+        Raises:
+            InvalidDataException: If a file doesn't belong to a scan in this
+                session, can't be read, or the scans can't be updated.
+
+        Returns:
+            list: The :obj:`Scan` records that were updated.
+        """
+        if not isinstance(json_files, dict):
+            json_files = self._match_jsons(json_files)
+        scans = {scan.name: scan for scan in self.scans}
+        unknown = [name for name in json_files if name not in scans]
+        if unknown:
+            raise InvalidDataException("Scans {} don't belong to session {}"
+                                       "".format(unknown, self))
+
+        found, errors = utils.read_jsons(list(json_files.values()),
+                                         workers=workers)
+        if errors:
+            raise InvalidDataException("Failed to read JSON files for {}. "
+                                       "Reasons: {}".format(self, errors))
+
+        rows = []
+        for name, path in json_files.items():
+            contents, created = found[path]
+            if timestamps and timestamps.get(name):
+                created = timestamps[name]
+            rows.append({
+                'scan_id': scans[name].id,
+                'contents': contents,
+                'path': path,
+                'created': created
+            })
+
+        table = Scan.__table__
+        update = table.update() \
+                      .where(table.c.id == bindparam('scan_id')) \
+                      .values(json_hash=bindparam('hash'),
+                              json_path=bindparam('path'),
+                              json_created=bindparam('created'))
+        try:
+            hashes = HeaderBlob.add_many([row['contents'] for row in rows])
+            for row, blob_hash in zip(rows, hashes):
+                row['hash'] = blob_hash
+                del row['contents']
+            db.session.execute(update, rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise InvalidDataException("Failed to update JSON contents for "
+                                       "{}. Reason: {}".format(self, e))
+        return [scans[name] for name in json_files]
+
+    def prefetch_gold_standards(self):
+        """Find the gold standards for all of this session's scans at once.
+
+        Until the current transaction ends, reading 'gold_standards' (or
+        'active_gold_standard') from any of the session's scans won't need
+        another query. This is only worth calling before working with many
+        of the session's scans (e.g. in
+        :py:func:`dashboard.datman_utils.add_session_jsons`). A single scan
+        already gets its gold standards from the cache in
+        :py:meth:`GoldStandard.find`.
+        """
+        GoldStandard.find(self.get_study().id, self.timepoint.site_id,
+                          [scan.tag for scan in self.scans])
+
+    def _match_jsons(self, json_files):
+        matched = {}
+        names = sorted((scan.name for scan in self.scans), key=len,
+                       reverse=True)
+        for path in json_files:
+            fname = os.path.basename(path)
+            for name in names:
+                if fname.startswith(name + "_") or fname == name + ".json":
+                    matched[name] = path
+                    break
+            else:
+                raise InvalidDataException("Can't find a scan in {} for JSON "
+                                           "file {}".format(self, path))
+        return matched
+
     def delete_scan(self, name):
         match = [scan for scan in self.scans if scan.name == name]
         if not match:
@@ -1399,6 +1549,626 @@ class SessionRedcap(db.Model):
             self.name, self.num, self.record_id)
 
 
+class SessionMonitor(db.Model):
+    """Tracks a session that a periodic monitor sweep needs to check on.
+
+    Each monitor type has one scheduler job that periodically 'sweeps' this
+    table for sessions that are due to be checked, instead of each session
+    getting a scheduler job of its own. Once a sweep has dealt with a session
+    it sets 'handled' (and 'outcome') so it won't be checked again unless it
+    is re-added.
+    """
+    __tablename__ = 'session_monitors'
+
+    REDCAP_IMPORT = 'redcap_import'
+    SCAN_IMPORT = 'scan_import'
+    SCAN_DOWNLOAD = 'scan_download'
+
+    name = db.Column('name', db.String(64), primary_key=True)
+    num = db.Column('num', db.Integer, primary_key=True)
+    monitor = db.Column('monitor', db.String(32), primary_key=True)
+    study = db.Column('study', db.String(32), db.ForeignKey('studies.id'))
+    recipients = db.Column('recipients', JSONB)
+    added = db.Column('added', db.DateTime(timezone=True), nullable=False)
+    due = db.Column('due', db.DateTime(timezone=True), nullable=False)
+    expires = db.Column('expires', db.DateTime(timezone=True))
+    handled = db.Column('handled', db.DateTime(timezone=True))
+    outcome = db.Column('outcome', db.String(32))
+
+    session = db.relationship('Session',
+                              uselist=False,
+                              back_populates='monitors')
+
+    __table_args__ = (
+        ForeignKeyConstraint(['name', 'num'],
+                             ['sessions.name', 'sessions.num'],
+                             ondelete='CASCADE'),
+        db.Index('session_monitors_pending_idx', 'monitor', 'due',
+                 postgresql_where=handled == None),
+    )
+
+    def __init__(self, name, num, monitor, due, study=None, recipients=None,
+                 expires=None):
+        self.name = name
+        self.num = num
+        self.monitor = monitor
+        self.due = due
+        self.study = study
+        self.recipients = recipients
+        self.expires = expires
+        self.added = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+
+    @classmethod
+    def add(cls, name, num, monitor, due, study=None, recipients=None,
+            expires=None):
+        """Start (or restart) monitoring a session.
+
+        If the session already has a monitor of the same type it will be
+        updated and marked as not yet handled.
+        """
+        existing = cls.query.get((name, num, monitor))
+        if existing:
+            existing.due = due
+            existing.study = study
+            existing.recipients = recipients
+            existing.expires = expires
+            existing.handled = None
+            existing.outcome = None
+            entry = existing
+        else:
+            entry = cls(name, num, monitor, due, study=study,
+                        recipients=recipients, expires=expires)
+        try:
+            db.session.add(entry)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise InvalidDataException("Failed to add {} monitor for "
+                                       "{}_{:02d}. Reason: {}".format(
+                                           monitor, name, num, e))
+        return entry
+
+    @classmethod
+    def pending(cls, monitor, now=None):
+        """Get a query for all unhandled monitors of a type that are due.
+        """
+        if not now:
+            now = datetime.datetime.now(FixedOffsetTimezone(offset=TZ_OFFSET))
+        return db.session.query(cls) \
+                         .filter(cls.monitor == monitor) \
+                         .filter(cls.handled == None) \
+                         .filter(cls.due <= now)
+
+    def mark_handled(self, outcome):
+        """Record that a sweep has dealt with this session.
+
+        Changes are not committed, to allow a sweep to save every monitor it
+        handled at once.
+        """
+        self.handled = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        self.outcome = outcome
+        db.session.add(self)
+
+    def __repr__(self):
+        return "<SessionMonitor {} for {}, {}>".format(
+            self.monitor, self.name, self.num)
+
+
+class ClusterJob(db.Model):
+    """A job submitted to the computing cluster on behalf of sessions.
+
+    Each job is an array job with one task per session. Its tasks record
+    which session each array index was run for and the state the cluster
+    last reported for it. The job's own state summarizes its tasks.
+    """
+    __tablename__ = 'cluster_jobs'
+
+    # States set by the dashboard, the rest come from the cluster.
+    SUBMITTING = 'SUBMITTING'
+    SUBMIT_FAILED = 'SUBMIT_FAILED'
+    LOST = 'LOST'
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    COMPLETED = 'COMPLETED'
+    FAILED = 'FAILED'
+
+    # States for work that is done. Any other state (including temporary
+    # cluster states like 'COMPLETING', 'REQUEUE_HOLD' or 'STAGE_OUT') means
+    # the work may still run.
+    FINAL_STATES = (SUBMIT_FAILED, LOST, COMPLETED, FAILED, 'CANCELLED',
+                    'TIMEOUT', 'NODE_FAIL', 'OUT_OF_MEMORY', 'PREEMPTED',
+                    'BOOT_FAIL', 'DEADLINE')
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    script = db.Column('script', db.String(128), nullable=False)
+    study = db.Column('study', db.String(32), db.ForeignKey('studies.id'))
+    submitted = db.Column('submitted',
+                          db.DateTime(timezone=True),
+                          nullable=False)
+    queue_id = db.Column('queue_id', db.String(32))
+    state = db.Column('state', db.String(32), nullable=False)
+    updated = db.Column('updated', db.DateTime(timezone=True))
+    error = db.Column('error', db.Text)
+
+    tasks = db.relationship('ClusterJobTask',
+                            back_populates='job',
+                            order_by='ClusterJobTask.task',
+                            cascade='all, delete')
+
+    def __init__(self, script, study=None):
+        self.script = script
+        self.study = study
+        self.state = self.SUBMITTING
+        self.submitted = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+
+    @classmethod
+    def create(cls, script, sessions, study=None):
+        """Record an array job that is being submitted for a list of sessions.
+
+        Changes are not committed, so the caller can save the job along with
+        any other changes it has made.
+
+        Args:
+            script (str): The name of the script each task runs.
+            sessions (:obj:`list` of :obj:`tuple`): The (name, num) of the
+                session each task is for, in array index order.
+            study (str, optional): The study the job is submitted for.
+
+        Returns:
+            :obj:`ClusterJob`: The new job.
+        """
+        job = cls(script, study=study)
+        for idx, (name, num) in enumerate(sessions):
+            job.tasks.append(ClusterJobTask(idx, name, num))
+        db.session.add(job)
+        return job
+
+    @classmethod
+    def active(cls):
+        """Get a query for all jobs that haven't finished yet.
+        """
+        return cls.query.filter(cls.state.notin_(cls.FINAL_STATES))
+
+    def submitted_as(self, queue_id):
+        """Record the ID the cluster assigned to this job.
+
+        Changes are not committed.
+        """
+        self.queue_id = queue_id
+        for task in self.tasks:
+            task.state = self.PENDING
+        self._set_state(self.PENDING)
+
+    def submit_failed(self, error, state=SUBMIT_FAILED):
+        """Record that this job never made it onto the cluster.
+
+        Changes are not committed.
+        """
+        self.error = error
+        for task in self.tasks:
+            task.state = state
+        self._set_state(state)
+
+    def update_states(self, states):
+        """Update task states from a cluster status report.
+
+        Changes are not committed.
+
+        Args:
+            states (:obj:`dict`): The state of each array task, keyed by
+                array index. A key of None is used for the job as a whole and
+                applies to any task without a state of its own.
+        """
+        for task in self.tasks:
+            state = states.get(task.task, states.get(None))
+            if state:
+                task.state = state
+
+        task_states = set(task.state for task in self.tasks)
+        if task_states - set(self.FINAL_STATES):
+            state = (self.RUNNING if self.RUNNING in task_states
+                     else self.PENDING)
+        elif task_states == {self.COMPLETED}:
+            state = self.COMPLETED
+        else:
+            state = self.FAILED
+        self._set_state(state)
+
+    def _set_state(self, state):
+        self.state = state
+        self.updated = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        db.session.add(self)
+
+    def __repr__(self):
+        return "<ClusterJob {} - {} ({} tasks) {}>".format(
+            self.id, self.script, len(self.tasks), self.state)
+
+
+class ClusterJobTask(db.Model):
+    """A single session handled by one task of a :py:class:`ClusterJob`.
+    """
+    __tablename__ = 'cluster_job_tasks'
+
+    job_id = db.Column('job',
+                       db.Integer,
+                       db.ForeignKey('cluster_jobs.id', ondelete='CASCADE'),
+                       primary_key=True)
+    task = db.Column('task', db.Integer, primary_key=True)
+    name = db.Column('name', db.String(64), nullable=False)
+    num = db.Column('num', db.Integer, nullable=False)
+    state = db.Column('state', db.String(32), nullable=False)
+
+    job = db.relationship('ClusterJob', uselist=False, back_populates='tasks')
+
+    __table_args__ = (
+        ForeignKeyConstraint(['name', 'num'],
+                             ['sessions.name', 'sessions.num'],
+                             ondelete='CASCADE'),
+        db.Index('cluster_job_tasks_session_idx', 'name', 'num'),
+    )
+
+    def __init__(self, task, name, num):
+        self.task = task
+        self.name = name
+        self.num = num
+        self.state = ClusterJob.SUBMITTING
+
+    def __repr__(self):
+        return "<ClusterJobTask {}[{}] for {}, {} - {}>".format(
+            self.job_id, self.task, self.name, self.num, self.state)
+
+
+class TimepointNotification(db.Model):
+    """Records a new timepoint that a study's QCers need to hear about.
+
+    Notifications are collected here as timepoints are added and sent out
+    periodically as a single digest email per QCer (see
+    :py:func:`dashboard.monitors.sweep_qc_notifications`).
+    """
+    __tablename__ = 'timepoint_notifications'
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    study = db.Column('study',
+                      db.String(32),
+                      db.ForeignKey('studies.id'),
+                      nullable=False)
+    timepoint = db.Column('timepoint',
+                          db.String(64),
+                          db.ForeignKey('timepoints.name',
+                                        ondelete='CASCADE'),
+                          nullable=False)
+    added = db.Column('added', db.DateTime(timezone=True), nullable=False)
+    sent = db.Column('sent', db.DateTime(timezone=True))
+
+    __table_args__ = (
+        db.Index('timepoint_notifications_unsent_idx', 'added',
+                 postgresql_where=sent == None),
+    )
+
+    def __init__(self, study, timepoint):
+        self.study = study
+        self.timepoint = timepoint
+        self.added = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+
+    @classmethod
+    def unsent(cls):
+        """Get a query for all notifications that haven't been sent yet.
+        """
+        return cls.query.filter(cls.sent == None).order_by(cls.added)
+
+    def mark_sent(self):
+        """Record that this notification has been included in a digest.
+
+        Changes are not committed.
+        """
+        self.sent = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        db.session.add(self)
+
+    def __repr__(self):
+        return "<TimepointNotification {} - {}>".format(self.study,
+                                                        self.timepoint)
+
+
+class OutgoingEmail(db.Model):
+    """An email message waiting in (or already sent from) the outbox.
+
+    Any process may add messages. They're delivered by the server's
+    :py:class:`dashboard.mailer.MailWorker`.
+    """
+    __tablename__ = 'email_outbox'
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    subject = db.Column('subject', db.Text, nullable=False)
+    sender = db.Column('sender', db.String(256), nullable=False)
+    recipients = db.Column('recipients', JSONB, nullable=False)
+    body = db.Column('body', db.Text)
+    html = db.Column('html', db.Text)
+    added = db.Column('added', db.DateTime(timezone=True), nullable=False)
+    attempts = db.Column('attempts', db.Integer, nullable=False, default=0)
+    next_attempt = db.Column('next_attempt',
+                             db.DateTime(timezone=True),
+                             nullable=False)
+    sent = db.Column('sent', db.DateTime(timezone=True))
+    error = db.Column('error', db.Text)
+
+    __table_args__ = (
+        db.Index('email_outbox_unsent_idx', 'next_attempt',
+                 postgresql_where=sent == None),
+    )
+
+    @classmethod
+    def add(cls, subject, sender, recipients, body, html=None):
+        """Add a message to the outbox.
+
+        The message is saved in a transaction of its own, so it doesn't
+        commit (or get rolled back with) any changes pending in the current
+        database session.
+
+        Returns:
+            int: The ID of the new message.
+        """
+        now = datetime.datetime.now(FixedOffsetTimezone(offset=TZ_OFFSET))
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                cls.__table__.insert().values(subject=subject,
+                                              sender=sender,
+                                              recipients=recipients,
+                                              body=body,
+                                              html=html,
+                                              added=now,
+                                              attempts=0,
+                                              next_attempt=now))
+        return result.inserted_primary_key[0]
+
+    @classmethod
+    def claim(cls, limit, max_attempts):
+        """Lock and return the messages that are due to be sent.
+
+        Rows already locked by another process are skipped, so it's safe to
+        drain the outbox from more than one place. Locks are released when the
+        session is committed.
+        """
+        now = datetime.datetime.now(FixedOffsetTimezone(offset=TZ_OFFSET))
+        return cls.query \
+                  .filter(cls.sent == None) \
+                  .filter(cls.attempts < max_attempts) \
+                  .filter(cls.next_attempt <= now) \
+                  .order_by(cls.id) \
+                  .limit(limit) \
+                  .with_for_update(skip_locked=True) \
+                  .all()
+
+    @classmethod
+    def purge(cls, days):
+        """Delete messages that were sent more than 'days' ago.
+        """
+        cutoff = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET)) - datetime.timedelta(
+                days=days)
+        cls.query.filter(cls.sent < cutoff) \
+                 .delete(synchronize_session=False)
+        db.session.commit()
+
+    def mark_sent(self):
+        """Record that the message was delivered. Changes are not committed.
+        """
+        self.sent = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        self.error = None
+        db.session.add(self)
+
+    def mark_failed(self, error, delay):
+        """Record a failed delivery and when to try again.
+
+        Changes are not committed.
+
+        Args:
+            error (str): The reason delivery failed.
+            delay (int): The number of seconds to wait before retrying.
+        """
+        self.attempts += 1
+        self.error = error
+        self.next_attempt = datetime.datetime.now(FixedOffsetTimezone(
+            offset=TZ_OFFSET)) + datetime.timedelta(seconds=delay)
+        db.session.add(self)
+
+    def __repr__(self):
+        return "<OutgoingEmail {} - '{}' to {}>".format(
+            self.id, self.subject, self.recipients)
+
+
+class DeletionJob(db.Model):
+    """A request to delete a timepoint, session or scan's files from disk.
+
+    The files to remove are worked out when the job is made (while the
+    database records still exist) and deleted later in the background by
+    :py:func:`dashboard.deletions.run_deletion_job`. The job keeps track of
+    its progress and, once finished, an audit record of what was removed.
+    """
+    __tablename__ = 'deletion_jobs'
+
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    COMPLETED = 'COMPLETED'
+    FAILED = 'FAILED'
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    study = db.Column('study',
+                      db.String(32),
+                      db.ForeignKey('studies.id'),
+                      nullable=False)
+    target = db.Column('target', db.String(128), nullable=False)
+    user_id = db.Column('requested_by', db.Integer, db.ForeignKey('users.id'))
+    plan = db.Column('plan', JSONB, nullable=False)
+    state = db.Column('state', db.String(32), nullable=False)
+    total = db.Column('total', db.Integer, nullable=False, default=0)
+    done = db.Column('done', db.Integer, nullable=False, default=0)
+    removed = db.Column('removed', db.Integer, nullable=False, default=0)
+    results = db.Column('results', JSONB)
+    added = db.Column('added', db.DateTime(timezone=True), nullable=False)
+    started = db.Column('started', db.DateTime(timezone=True))
+    finished = db.Column('finished', db.DateTime(timezone=True))
+    updated = db.Column('updated', db.DateTime(timezone=True))
+    # A token identifying the run that currently owns a RUNNING job
+    claimed_by = db.Column('claimed_by', db.String(64))
+
+    user = db.relationship('User', uselist=False)
+
+    __table_args__ = (
+        db.Index('deletion_jobs_queued_idx', 'added',
+                 postgresql_where=state == 'QUEUED'),
+    )
+
+    def __init__(self, study, target, plan, user_id=None):
+        self.study = study
+        self.target = target
+        self.plan = plan
+        self.user_id = user_id
+        self.state = self.QUEUED
+        self.total = len(plan)
+        self.done = 0
+        self.removed = 0
+        self.results = []
+        self.added = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        self.updated = self.added
+
+    @classmethod
+    def queued(cls):
+        """Get a query for all jobs that haven't been started.
+        """
+        return cls.query.filter(cls.state == cls.QUEUED).order_by(cls.added)
+
+    @classmethod
+    def stalled(cls, cutoff):
+        """Get a query for running jobs that haven't changed since 'cutoff'.
+
+        Rows are locked, skipping any that a running job is saving.
+        """
+        return cls.query.filter(cls.state == cls.RUNNING) \
+                        .filter(cls.updated < cutoff) \
+                        .with_for_update(skip_locked=True)
+
+    @classmethod
+    def claim(cls, job_id):
+        """Lock a queued job so that only the caller runs it.
+
+        Returns:
+            :obj:`DeletionJob`: The job or None if it doesn't exist, has
+            already been started or is locked by another process.
+        """
+        return cls.query \
+                  .filter(cls.id == job_id) \
+                  .filter(cls.state == cls.QUEUED) \
+                  .with_for_update(skip_locked=True) \
+                  .first()
+
+    def start(self, token):
+        """Mark the job as running. Changes are not committed.
+
+        Args:
+            token (str): A unique ID for the run taking the job. It must be
+                passed to :py:meth:`is_owner` before saving any changes.
+        """
+        self.state = self.RUNNING
+        self.claimed_by = token
+        self.started = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        self.updated = self.started
+        db.session.add(self)
+
+    def is_owner(self, token):
+        """Lock the job's row and check that a run still owns it.
+
+        This must be called before saving changes to a running job, so that
+        a run whose job was requeued can't overwrite the newer run's
+        progress. The lock is held until the session is committed or rolled
+        back.
+
+        Args:
+            token (str): The token the job was started with.
+
+        Returns:
+            bool: True if the job still belongs to the run with 'token'.
+        """
+        owner = db.session.query(DeletionJob.claimed_by) \
+                          .filter(DeletionJob.id == self.id) \
+                          .with_for_update() \
+                          .scalar()
+        return owner == token
+
+    def requeue(self):
+        """Put a job that stopped part way through back in the queue.
+
+        Results for entries that were deleted are kept, so only the rest of
+        the plan is run again. Changes are not committed.
+        """
+        kept = [item for item in self.results or [] if not item['error']]
+        self.results = kept
+        self.done = len(kept)
+        self.removed = sum(item['removed'] for item in kept)
+        self.state = self.QUEUED
+        self.claimed_by = None
+        self.updated = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        db.session.add(self)
+
+    def add_results(self, results):
+        """Record entries of the plan that have been dealt with.
+
+        Changes are not committed.
+
+        Args:
+            results (:obj:`list` of :obj:`dict`): The results reported by
+                :py:func:`dashboard.datman_utils.run_deletion`.
+        """
+        # The column must be reassigned for the change to be saved
+        self.results = (self.results or []) + list(results)
+        self.done += len(results)
+        self.removed += sum(item['removed'] for item in results)
+        self.updated = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        db.session.add(self)
+
+    def finish(self):
+        """Mark the job as finished. Changes are not committed.
+        """
+        errors = [item for item in self.results or [] if item['error']]
+        self.state = self.FAILED if errors else self.COMPLETED
+        self.claimed_by = None
+        self.finished = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        self.updated = self.finished
+        db.session.add(self)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'study': self.study,
+            'target': self.target,
+            'requested_by': str(self.user) if self.user else None,
+            'state': self.state,
+            'total': self.total,
+            'done': self.done,
+            'removed': self.removed,
+            'errors': [item for item in self.results or [] if item['error']],
+            'added': self.added.isoformat() if self.added else None,
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'updated': self.updated.isoformat() if self.updated else None
+        }
+
+    def __repr__(self):
+        return "<DeletionJob {} - {} {}/{} {}>".format(
+            self.id, self.target, self.done, self.total, self.state)
+
+
 class Scan(db.Model):
     __tablename__ = 'scans'
 
@@ -1414,8 +2184,27 @@ class Scan(db.Model):
                     nullable=False)
     description = db.Column('description', db.String(128))
     conv_errors = db.Column('conversion_errors', db.Text)
+    # Summaries of the scan's problems, kept up to date as header diffs and
+    # conversion errors are saved so problem scans can be found quickly
+    has_header_diffs = db.Column('has_header_diffs',
+                                 db.Boolean,
+                                 nullable=False,
+                                 default=False,
+                                 server_default='false')
+    diff_field_count = db.Column('diff_field_count',
+                                 db.Integer,
+                                 nullable=False,
+                                 default=0,
+                                 server_default='0')
+    has_conversion_error = db.Column('has_conversion_error',
+                                     db.Boolean,
+                                     nullable=False,
+                                     default=False,
+                                     server_default='false')
     json_path = db.Column('json_path', db.String(1028))
-    json_contents = db.Column('json_contents', JSONB)
+    json_hash = db.Column('json_hash',
+                          db.String(64),
+                          db.ForeignKey('header_blobs.hash'))
     json_created = db.Column('json_created', db.DateTime(timezone=True))
     # If a scan is a link, this will hold the id of the source scan
     source_id = db.Column('source_data', db.Integer, db.ForeignKey(id))
@@ -1445,10 +2234,17 @@ class Scan(db.Model):
         cascade='all',
         order_by='desc(ScanGoldStandard.date_added)',
         back_populates='scan')
+    # Not loaded with the scan since most pages listing scans don't need it.
+    # Use joinedload(Scan.header) when json_contents will be read.
+    header = db.relationship('HeaderBlob', uselist=False)
 
     __table_args__ = (ForeignKeyConstraint(['timepoint', 'session'],
                                            ['sessions.name', 'sessions.num']),
-                      UniqueConstraint(name))
+                      UniqueConstraint(name),
+                      db.Index('scans_problems_idx',
+                               'timepoint',
+                               postgresql_where=or_(has_header_diffs,
+                                                    has_conversion_error)))
 
     def __init__(self,
                  name,
@@ -1533,12 +2329,9 @@ class Scan(db.Model):
 
     @property
     def gold_standards(self):
-        found_standards = GoldStandard.query.filter(
-            GoldStandard.study == self.session.get_study().id).filter(
-                GoldStandard.site == self.session.timepoint.site_id).filter(
-                    GoldStandard.tag == self.tag).order_by(
-                        GoldStandard.json_created.desc())
-        return found_standards.all()
+        found = GoldStandard.find(self.session.get_study().id,
+                                  self.session.timepoint.site_id, [self.tag])
+        return list(found[self.tag])
 
     @property
     def active_gold_standard(self):
@@ -1556,7 +2349,20 @@ class Scan(db.Model):
                             standard=None,
                             ignore=None,
                             tolerance=None,
-                            bvals=False):
+                            bvals=False,
+                            commit=True,
+                            force=False):
+        """Compare the scan's JSON sidecar to a gold standard.
+
+        If the diffs were already made from the same scan and gold standard
+        contents with the same settings they're returned as they are, unless
+        'force' is set. Diffs that check bval files are always remade, since
+        those files aren't hashed.
+
+        The scan's header diff status is set from its diffs against the
+        newest gold standard it's been compared to, which isn't necessarily
+        the one given.
+        """
         if not self.json_contents:
             raise InvalidDataException("No JSON data found for series {}"
                                        "".format(self.name))
@@ -1573,6 +2379,16 @@ class Scan(db.Model):
             raise InvalidDataException("No gold standard available for "
                                        "comparison")
 
+        settings_hash = utils.hash_diff_settings(ignore, tolerance, bvals)
+        found = [
+            item for item in self.header_diffs
+            if item.gold_standard_id == gs.id
+        ]
+        if (found and not force and not bvals and
+                found[0].matches(self.json_hash, gs.json_hash,
+                                 settings_hash)):
+            return found[0]
+
         diffs = header_checks.compare_headers(self.json_contents,
                                               gs.json_contents,
                                               ignore=ignore,
@@ -1582,25 +2398,37 @@ class Scan(db.Model):
             if result:
                 diffs['bvals'] = result
 
-        found = False
-        if self.header_diffs:
-            found = [
-                item for item in self.header_diffs
-                if item.gold_standard.id == gs.id
-            ]
-            if found:
-                new_diffs = found[0]
-                new_diffs.diffs = diffs
-
-        if not found:
-            new_diffs = ScanGoldStandard(
-                self.id,
-                gs.id,
-                diffs,
-                gold_version=utils.get_software_version(gs.json_contents),
-                scan_version=utils.get_software_version(self.json_contents))
+        gold_version = utils.get_software_version(gs.json_contents)
+        scan_version = utils.get_software_version(self.json_contents)
+        if found:
+            new_diffs = found[0]
+            new_diffs.diffs = diffs
+            new_diffs.gold_version = gold_version
+            new_diffs.scan_version = scan_version
+            new_diffs.date_added = datetime.datetime.now(
+                FixedOffsetTimezone(offset=TZ_OFFSET))
+        else:
+            new_diffs = ScanGoldStandard(self.id,
+                                         gs.id,
+                                         diffs,
+                                         gold_version=gold_version,
+                                         scan_version=scan_version)
+        new_diffs.scan_hash = self.json_hash
+        new_diffs.gold_hash = gs.json_hash
+        new_diffs.settings_hash = settings_hash
+        db.session.add(new_diffs)
+
+        compared = [(item.gold_standard, item.diffs)
+                    for item in self.header_diffs
+                    if item.gold_standard_id != gs.id]
+        compared.append((gs, diffs))
+        newest = max(compared, key=lambda item: _standard_age(item[0]))[1]
+        self.has_header_diffs = bool(newest)
+        self.diff_field_count = len(newest or {})
+
+        if not commit:
+            return new_diffs
         try:
-            db.session.add(new_diffs)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
@@ -1613,6 +2441,17 @@ class Scan(db.Model):
             return {}
         return self.header_diffs[0].diffs
 
+    @property
+    def json_contents(self):
+        if self.header is None:
+            return None
+        return self.header.read()
+
+    @json_contents.setter
+    def json_contents(self, contents):
+        self.header = HeaderBlob.add(contents)
+        self.json_hash = self.header.hash if self.header else None
+
     def add_json(self, json_file, timestamp=None):
         self.json_contents = utils.read_json(json_file)
         self.json_path = json_file
@@ -1630,6 +2469,11 @@ class Scan(db.Model):
                                        "contents from file {}. Reason: "
                                        "{}".format(self, json_file, e))
 
+    @validates('conv_errors')
+    def _set_error_status(self, key, error_message):
+        self.has_conversion_error = bool(error_message)
+        return error_message
+
     def add_error(self, error_message):
         self.conv_errors = error_message
         try:
@@ -1734,6 +2578,82 @@ class Scantype(db.Model):
         return "<Scantype {}>".format(self.tag)
 
 
+class HeaderBlob(db.Model):
+    """A JSON header, stored once however many scans or gold standards use it.
+
+    Blobs are keyed by the hash of their contents (see
+    :py:func:`dashboard.models.utils.hash_json`). Headers longer than
+    'HEADER_BLOB_COMPRESS_SIZE' are stored zlib compressed instead of as
+    JSONB, which saves space but leaves them out of header searches.
+    """
+    __tablename__ = 'header_blobs'
+
+    hash = db.Column('hash', db.String(64), primary_key=True)
+    contents = db.Column('contents', JSONB)
+    compressed = db.Column('compressed', db.LargeBinary)
+
+    __table_args__ = (
+        # Speeds up header searches (see
+        # dashboard.queries.find_scans_by_header)
+        db.Index('header_blobs_contents_idx',
+                 contents,
+                 postgresql_using='gin',
+                 postgresql_ops={'contents': 'jsonb_path_ops'}), )
+
+    def read(self):
+        """Get the header's contents, decompressing them if needed.
+        """
+        if self.compressed is not None:
+            return utils.load_compressed_json(self.compressed)
+        return self.contents
+
+    @classmethod
+    def add(cls, contents):
+        """Get the blob for a header, adding it if it's not stored yet.
+
+        Returns:
+            :obj:`HeaderBlob`: The blob, or None if 'contents' is None.
+        """
+        if contents is None:
+            return None
+        blob_hash = cls.add_many([contents])[0]
+        return cls.query.get(blob_hash)
+
+    @classmethod
+    def add_many(cls, headers):
+        """Store many headers at once, skipping any that already exist.
+
+        The blobs are added in the current transaction, the caller must
+        commit.
+
+        Args:
+            headers (list): The JSON contents of each header.
+
+        Returns:
+            list: The hash of each header, in the same order.
+        """
+        size = None
+        if has_app_context():
+            size = current_app.config.get('HEADER_BLOB_COMPRESS_SIZE')
+        blobs = [utils.make_header_blob(item, size) for item in headers]
+        if blobs:
+            unique = {blob['hash']: blob for blob in blobs}
+            stmt = insert(cls.__table__).on_conflict_do_nothing(
+                index_elements=['hash'])
+            db.session.execute(stmt, list(unique.values()))
+        return [blob['hash'] for blob in blobs]
+
+    def _get_values(self):
+        return {
+            'hash': self.hash,
+            'contents': self.contents,
+            'compressed': self.compressed
+        }
+
+    def __repr__(self):
+        return "<HeaderBlob {}>".format(self.hash)
+
+
 class GoldStandard(db.Model):
     __tablename__ = 'gold_standards'
 
@@ -1742,8 +2662,19 @@ class GoldStandard(db.Model):
     site = db.Column('site', db.String(32), nullable=False)
     tag = db.Column('scantype', db.String(64), nullable=False)
     json_created = db.Column('added', db.DateTime(timezone=True))
-    json_contents = db.Column('contents', JSONB)
+    json_hash = db.Column('contents_hash',
+                          db.String(64),
+                          db.ForeignKey('header_blobs.hash'))
     json_path = db.Column('json_path', db.String(1028))
+    # When scans were last compared to this gold standard in bulk (see
+    # dashboard.header_diffs.sweep_gold_standards)
+    compared = db.Column('compared', db.DateTime(timezone=True))
+    # How many bulk comparisons against this gold standard have failed
+    compare_failures = db.Column('compare_failures',
+                                 db.Integer,
+                                 nullable=False,
+                                 default=0,
+                                 server_default='0')
 
     study_site = db.relationship('StudySite',
                                  uselist=False,
@@ -1754,6 +2685,9 @@ class GoldStandard(db.Model):
                                      back_populates='standards',
                                      viewonly=True)
     scans = association_proxy('scan_gold_standard', 'scan')
+    # Gold standards are always loaded to be compared against, so their
+    # contents come with them
+    header = db.relationship('HeaderBlob', uselist=False, lazy='joined')
 
     __table_args__ = (
         ForeignKeyConstraint(
@@ -1762,7 +2696,9 @@ class GoldStandard(db.Model):
         ForeignKeyConstraint(
             ['study', 'site'],
             ['study_sites.study', 'study_sites.site']),
-        UniqueConstraint(json_path, json_contents))
+        UniqueConstraint(json_path,
+                         json_hash,
+                         name='gold_standards_json_path_contents_constraint'))
 
     def __init__(self, study, gs_json):
         try:
@@ -1778,6 +2714,135 @@ class GoldStandard(db.Model):
         self.json_contents = utils.read_json(gs_json)
         self.json_path = gs_json
 
+    @classmethod
+    def find(cls, study, site, tags):
+        """Find the gold standards for several scan types at once.
+
+        Results are kept until the current transaction ends. Their contents
+        are also cached between transactions, so they're only read again
+        after a gold standard is added or removed for the study, site and
+        tag.
+
+        Args:
+            study (str): The study ID.
+            site (str): The site ID.
+            tags (list): The scan tags to find gold standards for.
+
+        Returns:
+            dict: Each tag mapped to a list of its gold standards, newest
+            first.
+        """
+        prefetched = db.session.info.setdefault('gold_standards', {})
+        found = {}
+        for tag in set(tags):
+            if (study, site, tag) in prefetched:
+                found[tag] = prefetched[(study, site, tag)]
+        missing = [tag for tag in set(tags) if tag not in found]
+        if not missing:
+            return found
+
+        stamps = db.session.query(cls.tag,
+                                  func.count(cls.id),
+                                  func.max(cls.json_created)) \
+                           .filter(cls.study == study) \
+                           .filter(cls.site == site) \
+                           .filter(cls.tag.in_(missing)) \
+                           .group_by(cls.tag) \
+                           .all()
+        stamps = {tag: (count, newest) for tag, count, newest in stamps}
+
+        cached = {}
+        with _gold_standards_lock:
+            for tag in missing:
+                entry = _gold_standards.get((study, site, tag))
+                if entry and entry[0] == stamps.get(tag):
+                    cached[tag] = entry[1]
+
+        stale = [tag for tag in missing if tag in stamps and tag not in cached]
+        loaded = {tag: [] for tag in stale}
+        if stale:
+            for standard in cls.query.filter(cls.study == study) \
+                                     .filter(cls.site == site) \
+                                     .filter(cls.tag.in_(stale)) \
+                                     .order_by(cls.json_created.desc()):
+                loaded[standard.tag].append(standard)
+            with _gold_standards_lock:
+                for tag, standards in loaded.items():
+                    _gold_standards[(study, site, tag)] = (
+                        cls._get_stamp(standards),
+                        [(item._get_values(), item.header._get_values()
+                          if item.header else None)
+                         for item in standards])
+
+        for tag in missing:
+            if tag in loaded:
+                found[tag] = loaded[tag]
+            else:
+                found[tag] = [cls._attach_cached(values, header)
+                              for values, header in cached.get(tag, [])]
+            prefetched[(study, site, tag)] = found[tag]
+        return found
+
+    @staticmethod
+    def clear_cache(study, site, tag):
+        """Forget the cached gold standards for a study, site and tag.
+        """
+        with _gold_standards_lock:
+            _gold_standards.pop((study, site, tag), None)
+        db.session.info.get('gold_standards', {}).pop((study, site, tag),
+                                                      None)
+
+    def mark_compared(self):
+        """Record that scans have been compared to this gold standard.
+
+        Changes are not committed.
+        """
+        self.compared = datetime.datetime.now(
+            FixedOffsetTimezone(offset=TZ_OFFSET))
+        db.session.add(self)
+
+    def mark_failed(self):
+        """Record that comparing scans to this gold standard failed.
+
+        Changes are not committed.
+        """
+        self.compare_failures = (self.compare_failures or 0) + 1
+        db.session.add(self)
+
+    @staticmethod
+    def _get_stamp(standards):
+        # Must match the (count, newest) pairs queried in find()
+        dates = [item.json_created for item in standards if item.json_created]
+        return (len(standards), max(dates) if dates else None)
+
+    def _get_values(self):
+        return {
+            'id': self.id,
+            'study': self.study,
+            'site': self.site,
+            'tag': self.tag,
+            'json_created': self.json_created,
+            'json_hash': self.json_hash,
+            'json_path': self.json_path
+        }
+
+    @classmethod
+    def _attach_cached(cls, values, header=None):
+        values = dict(values)
+        values['header'] = _attach(HeaderBlob, header) if header else None
+        return _attach(cls, values)
+
+    @property
+    def json_contents(self):
+        if self.header is None:
+            return None
+        return self.header.read()
+
+    @json_contents.setter
+    def json_contents(self, contents):
+        self.header = HeaderBlob.add(contents)
+        self.json_hash = self.header.hash if self.header else None
+
     def __repr__(self):
         return "<GoldStandard {} for {}, {} - {}>".format(
             self.id, self.study, self.site, self.tag)
@@ -2074,6 +3139,10 @@ class ScanGoldStandard(db.Model):
                            server_default=func.now())
     gold_version = db.Column('gold_version', db.String(128))
     scan_version = db.Column('scan_version', db.String(128))
+    # Hashes of the contents and settings the diffs were made from
+    scan_hash = db.Column('scan_hash', db.String(64))
+    gold_hash = db.Column('gold_hash', db.String(64))
+    settings_hash = db.Column('settings_hash', db.String(64))
 
     scan = db.relationship('Scan',
                            back_populates='header_diffs',
@@ -2100,6 +3169,14 @@ class ScanGoldStandard(db.Model):
     def timestamp(self):
         return self.date_added.strftime('%I:%M %p, %Y-%m-%d')
 
+    def matches(self, scan_hash, gold_hash, settings_hash):
+        """Check whether these diffs were made from the given contents and
+        settings.
+        """
+        hashes = (scan_hash, gold_hash, settings_hash)
+        return (None not in hashes and
+                (self.scan_hash, self.gold_hash, self.settings_hash) == hashes)
+
     def __repr__(self):
         return "<HeaderDiffs for Scan {} and GS {}>".format(
             self.scan_id, self.gold_standard_id)
@@ -2,17 +2,15 @@
 """
 
 import os
+import zlib
 import operator
 import json
+import hashlib
 import time
 import logging
-from uuid import uuid4
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from sqlalchemy.orm.collections import MappedCollection, collection
-import flask_apscheduler
-
-from dashboard import scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +43,89 @@ def read_json(json_file):
     return contents
 
 
+def dump_json(contents):
+    """Serialize JSON contents so equal contents always give the same text.
+    """
+    return json.dumps(contents, sort_keys=True, separators=(',', ':'))
+
+
+def hash_json(contents):
+    """Get a stable hash of JSON contents.
+
+    Keys are sorted first, so equal contents always give the same hash no
+    matter how they were read or stored.
+
+    Returns:
+        str: A hex SHA-256 digest, or None if there are no contents.
+    """
+    if contents is None:
+        return None
+    return hashlib.sha256(dump_json(contents).encode('utf-8')).hexdigest()
+
+
+def hash_diff_settings(ignore, tolerance, bvals):
+    """Get a stable hash of the settings header diffs were made with.
+    """
+    return hash_json({'ignore': ignore, 'tolerance': tolerance,
+                      'bvals': bvals})
+
+
+def make_header_blob(contents, compress_size=None):
+    """Make a row for the 'header_blobs' table.
+
+    Args:
+        contents (dict): The JSON contents to store.
+        compress_size (int, optional): Contents longer than this (as JSON
+            text) are zlib compressed instead of stored as JSONB.
+
+    Returns:
+        dict: The 'hash' (from :py:func:`hash_json`), 'contents' and
+        'compressed' values. Only one of 'contents' or 'compressed' is set.
+    """
+    blob = {'hash': hash_json(contents), 'contents': contents,
+            'compressed': None}
+    if compress_size:
+        text = dump_json(contents)
+        if len(text) > compress_size:
+            blob['compressed'] = zlib.compress(text.encode('utf-8'))
+            blob['contents'] = None
+    return blob
+
+
+def load_compressed_json(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def read_jsons(json_files, workers=8):
+    """Read many JSON files at once, along with their timestamps.
+
+    Args:
+        json_files (list): The full paths of the files to read.
+        workers (int, optional): The number of files to read at a time.
+
+    Returns:
+        tuple: A dictionary mapping each path that was read to its
+        (contents, timestamp) and a dictionary mapping each path that
+        couldn't be read to the exception raised.
+    """
+    def read(path):
+        try:
+            return path, (read_json(path), file_timestamp(path)), None
+        except Exception as e:
+            return path, None, e
+
+    found = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(json_files)),
+                                            1)) as pool:
+        for path, result, error in pool.map(read, json_files):
+            if error:
+                errors[path] = error
+            else:
+                found[path] = result
+    return found, errors
+
+
 def file_timestamp(file_path):
     epoch_time = os.path.getctime(file_path)
     return time.ctime(epoch_time)
@@ -65,19 +146,9 @@ def get_software_version(json_contents):
 def schedule_email(email_func, input_args, input_kwargs=None):
     """Send an email from the server side.
 
-    If an automated email is fired from code that may be run on the client
-    side then it should be wrapped by this function. This will add a scheduler
-    job that fires instantly to ensure it executes server side (or just send it
-    if it's already server side).
-
-    NOTE: We're using scheduler.add_job directly and not
-    dashboard.monitors.add_monitor because monitors often need classes from
-    the models and using add_monitor would introduce circular dependencies.
+    All email is now delivered by the server from the outbox table (see
+    :py:mod:`dashboard.mailer`), so email functions can be called directly
+    from either side. This is kept so that existing callers don't need to
+    change.
     """
-    if isinstance(scheduler, flask_apscheduler.APScheduler):
-        # You're already executing on the server side so just send the email
-        email_func(*input_args)
-        return
-    scheduler.add_job(uuid4().hex, email_func, trigger='date',
-                      run_date=datetime.now(), args=input_args,
-                      kwargs=input_kwargs)
+    email_func(*input_args, **(input_kwargs or {}))
@@ -13,6 +13,14 @@ function to verify that the scheduled task still makes sense to run at the
 time it is executed. i.e. make sure data hasn't been deleted, notifications are
 still relevant, etc.
 
+Monitors that would otherwise add one job per session (e.g.
+:py:func:`monitor_redcap_import`) should instead record the session in the
+:py:class:`dashboard.models.SessionMonitor` table and be handled by a 'sweep'
+function. A sweep is a check function that runs periodically (see
+'SCHEDULER_JOBS' in the scheduler config), finds every session it is
+responsible for with a single query and sends batched notifications. Sweeps
+should always mark the sessions they've dealt with as handled.
+
 .. warning:: Any inputs submitted to the scheduler must be
     `JSON serializable. <https://docs.python.org/3/library/json.html#json.JSONEncoder>`_
     Check functions, therefore, must only accept these types as input.
@@ -20,11 +28,16 @@ still relevant, etc.
 """  # noqa: E501
 import logging
 from uuid import uuid4
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_
 
-from dashboard import scheduler
-from .models import Session
+from dashboard import scheduler, db
+from .models import (Session, SessionMonitor, SessionRedcap,
+                     TimepointNotification)
+from .models.emails import qc_digest_email
 from .emails import missing_redcap_email
+from .queries import get_unreviewed_timepoints, get_qcers
 from .exceptions import MonitorException
 
 logger = logging.getLogger(__name__)
@@ -106,11 +119,12 @@ def get_emails(users):
 
 
 def monitor_redcap_import(name, num, users=None, study=None):
-    """Add a scheduled job to run :py:func:`check_redcap`.
+    """Monitor a session to ensure it receives a redcap record.
 
-    This adds a scheduled job that will run :obj:`check_redcap` two days
-    after job submission and notify either the given list of users or all staff
-    contacts and study RAs if a redcap record has not found at that time.
+    This adds the session to the redcap import monitors.
+    :py:func:`sweep_redcap_imports` will check on it two days after it is
+    added and notify either the given list of users or all staff contacts and
+    study RAs if a redcap record has not been found by then.
 
     Args:
         name (:obj:`str`): A session name
@@ -124,8 +138,8 @@ def monitor_redcap_import(name, num, users=None, study=None):
         :obj:`dashboard.exceptions.MonitorException`: If the 'users' argument
             was not set and no users are set as a staff contact or RA for the
             session's study
-        :obj:`dashboard.exceptions.SchedulerException`: If the job cannot
-            be added to the server
+        :obj:`dashboard.exceptions.InvalidDataException`: If the monitor
+            can't be saved to the database
     """
     session = Session.query.get((name, num))
 
@@ -151,14 +165,107 @@ def monitor_redcap_import(name, num, users=None, study=None):
                                "address configured. Cannot send redcap import "
                                "notifications for {}".format(users, session))
 
-    args = [session.name, session.num]
-    kwargs = {'recipients': recipients}
-    add_monitor(check_redcap, args, input_kwargs=kwargs, days=2)
+    SessionMonitor.add(session.name,
+                       session.num,
+                       SessionMonitor.REDCAP_IMPORT,
+                       datetime.now(timezone.utc) + timedelta(days=2),
+                       study=db_study.id,
+                       recipients=recipients)
+
+
+def sweep_redcap_imports():
+    """Notify users about all overdue sessions that are missing redcap records.
+
+    This runs periodically on the server. Sessions that have received a
+    redcap record since they were added are marked resolved, the rest are
+    grouped so that each set of recipients receives one email per study.
+    """
+    found = SessionMonitor.pending(SessionMonitor.REDCAP_IMPORT) \
+        .outerjoin(SessionRedcap,
+                   and_(SessionRedcap.name == SessionMonitor.name,
+                        SessionRedcap.num == SessionMonitor.num)) \
+        .add_columns(SessionRedcap.name) \
+        .all()
+
+    if not found:
+        return
+
+    missing = []
+    for monitor, redcap_name in found:
+        if redcap_name is not None:
+            monitor.mark_handled('resolved')
+            continue
+        missing.append(monitor)
+        monitor.mark_handled('notified')
+
+    for (study, recipients), sessions in group_notifications(missing).items():
+        missing_redcap_email(sessions, study, dest_emails=list(recipients))
+
+    db.session.commit()
+
+
+def sweep_qc_notifications():
+    """Send each QCer one digest of all timepoints added since the last sweep.
+
+    This runs periodically on the server. Each user hears about every new
+    timepoint in all of the studies they QC for, along with each study's
+    full list of timepoints still needing review.
+    """
+    pending = TimepointNotification.unsent().all()
+    if not pending:
+        return
+
+    new_timepoints = {}
+    for notification in pending:
+        found = new_timepoints.setdefault(notification.study, [])
+        if notification.timepoint not in found:
+            found.append(notification.timepoint)
+        notification.mark_sent()
+
+    studies = list(new_timepoints)
+    remaining = get_unreviewed_timepoints(studies)
+
+    digests = {}
+    for study, users in get_qcers(studies).items():
+        for user in users:
+            if not user.email:
+                continue
+            digests.setdefault(user, {})[study] = new_timepoints[study]
+
+    for user, user_timepoints in digests.items():
+        qc_digest_email(str(user), user.email, user_timepoints,
+                        {study: remaining.get(study, [])
+                         for study in user_timepoints})
+
+    db.session.commit()
+
+
+def group_notifications(monitors):
+    """Group monitored sessions by the study and recipients to notify.
+
+    Args:
+        monitors (:obj:`list` of :obj:`dashboard.models.SessionMonitor`): The
+            monitors a sweep needs to send notifications for.
+
+    Returns:
+        dict: A dictionary mapping a (study ID, recipient tuple) pair to
+        the list of session names to include in the notification.
+    """
+    grouped = {}
+    for monitor in monitors:
+        recipients = tuple(sorted(monitor.recipients or []))
+        session = "{}_{:02d}".format(monitor.name, monitor.num)
+        grouped.setdefault((monitor.study, recipients), []).append(session)
+    return grouped
 
 
 def check_redcap(name, num, recipients=None):
     """Emails a notification if the given session doesnt have a redcap record.
 
+    .. note:: New redcap import monitors are handled by
+        :py:func:`sweep_redcap_imports`. This is kept so jobs that were
+        scheduled before the switch can still run.
+
     Args:
         name (:obj:`str`): A session name
         num (int): A session number
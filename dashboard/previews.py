@@ -0,0 +1,303 @@
+"""Build small preview images of scans for quick review.
+
+Each scan gets two PNG previews, stored beside its QC outputs (see
+:py:func:`dashboard.datman_utils.get_preview_path`):
+
+    - A 'mosaic' with one row each of evenly spaced axial, coronal and
+      sagittal slices.
+    - A 'thumb' with the middle slice of each orientation side by side.
+
+Both are made from a single read of the NIfTI file (only the middle volume
+of a 4D series is read). Previews are built in the background by
+:py:func:`build_previews`, either when a scan's page asks for one that's
+missing or by the periodic :py:func:`sweep_previews`.
+
+.. note:: Reading NIfTI files requires nibabel. Without it previews are
+    never built and the scan page only offers the full viewer.
+"""
+import os
+import math
+import zlib
+import struct
+import logging
+import threading
+from datetime import datetime
+
+import numpy as np
+from flask import current_app
+
+from dashboard import scheduler
+from .models import Scan
+from .datman_utils import get_nifti_path, get_preview_path
+
+try:
+    import nibabel
+except ImportError:
+    nibabel = None
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_KINDS = ('mosaic', 'thumb')
+
+# The newest scan ID and 'json_created' time seen by the last preview sweep
+_last_sweep = {'id': None, 'created': None}
+_last_sweep_lock = threading.Lock()
+
+
+def queue_previews(scan_ids, job_id=None):
+    """Build previews for a list of scans in the background.
+
+    Args:
+        scan_ids (:obj:`list` of int): The IDs of scans that need previews.
+        job_id (str, optional): An ID for the scheduler job. A job that's
+            already waiting with the same ID is replaced.
+
+    Returns:
+        bool: True if the previews were queued.
+    """
+    if nibabel is None or not scan_ids:
+        return False
+    try:
+        scheduler.add_job(job_id or 'previews_{}'.format(scan_ids[0]),
+                          build_previews,
+                          trigger='date',
+                          run_date=datetime.now(),
+                          args=[list(scan_ids)],
+                          replace_existing=True)
+    except Exception as e:
+        logger.error("Failed to queue previews for scans {}. Reason - "
+                     "{}".format(scan_ids, e))
+        return False
+    return True
+
+
+def build_previews(scan_ids, force=False):
+    """Build any missing or out of date previews for a list of scans.
+
+    Args:
+        scan_ids (:obj:`list` of int): The IDs of the scans to build
+            previews for.
+        force (bool, optional): Rebuild previews even if they're up to date.
+    """
+    for scan in Scan.query.filter(Scan.id.in_(scan_ids)).all():
+        try:
+            build_scan_previews(scan, force=force)
+        except Exception as e:
+            logger.error("Failed to build previews for {}. Reason - "
+                         "{}".format(scan, e))
+
+
+def sweep_previews():
+    """Build previews for scans added or updated since the last sweep.
+
+    This runs periodically on the server. Only unreviewed scans that are
+    newer than the last sweep, or whose headers were updated since it, are
+    checked. The first sweep after the server starts checks the most recent
+    'PREVIEW_SWEEP_LIMIT' unreviewed scans instead. At most
+    'PREVIEW_SWEEP_LIMIT' scans are checked per sweep, the rest are picked
+    up by the next one.
+    """
+    if nibabel is None:
+        return
+    limit = current_app.config.get('PREVIEW_SWEEP_LIMIT', 200)
+    with _last_sweep_lock:
+        last_id = _last_sweep['id']
+        last_created = _last_sweep['created']
+
+    unreviewed = Scan.query.filter(~Scan.qc_review.has())
+    if last_id is None:
+        scans = unreviewed.order_by(Scan.id.desc()).limit(limit).all()
+        created = [scan.json_created for scan in scans if scan.json_created]
+        last_id = max([scan.id for scan in scans] + [0])
+        last_created = max(created) if created else None
+    else:
+        scans = []
+        if last_created is not None:
+            # Older scans that have been updated, oldest update first so
+            # that any left over are still newer than the saved time
+            scans = unreviewed.filter(Scan.id <= last_id) \
+                              .filter(Scan.json_created > last_created) \
+                              .order_by(Scan.json_created) \
+                              .limit(limit) \
+                              .all()
+            if scans:
+                last_created = scans[-1].json_created
+        added = unreviewed.filter(Scan.id > last_id) \
+                          .order_by(Scan.id) \
+                          .limit(limit - len(scans)) \
+                          .all()
+        if added:
+            # Every updated scan was checked if there was room for these
+            last_id = added[-1].id
+            created = [scan.json_created for scan in added
+                       if scan.json_created]
+            if last_created is not None:
+                created.append(last_created)
+            last_created = max(created) if created else None
+        scans.extend(added)
+
+    with _last_sweep_lock:
+        _last_sweep['id'] = last_id
+        _last_sweep['created'] = last_created
+
+    for scan in scans:
+        try:
+            build_scan_previews(scan)
+        except Exception as e:
+            logger.error("Failed to build previews for {}. Reason - "
+                         "{}".format(scan, e))
+
+
+def needs_previews(scan):
+    """Check whether a scan is missing previews or has out of date ones.
+    """
+    try:
+        source = os.stat(get_nifti_path(scan)).st_mtime
+    except (OSError, TypeError):
+        return False
+    for kind in PREVIEW_KINDS:
+        path = get_preview_path(scan, kind)
+        if not path:
+            return False
+        try:
+            if os.stat(path).st_mtime < source:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def build_scan_previews(scan, force=False):
+    """Build the previews for a single scan.
+
+    Returns:
+        bool: True if previews were written.
+    """
+    if nibabel is None:
+        return False
+    if not force and not needs_previews(scan):
+        return False
+
+    config = current_app.config
+    volume = read_volume(get_nifti_path(scan))
+    images = {
+        'mosaic': make_mosaic(volume,
+                              slices=config.get('PREVIEW_SLICES', 6),
+                              size=config.get('PREVIEW_SIZE', 128)),
+        'thumb': make_mosaic(volume,
+                             slices=1,
+                             size=config.get('PREVIEW_THUMB_SIZE', 64),
+                             rows=False)
+    }
+    for kind, image in images.items():
+        write_png(get_preview_path(scan, kind), image)
+    return True
+
+
+def read_volume(path):
+    """Read a scan as a 3D array in RAS+ orientation.
+
+    Only the middle volume of a 4D (or higher) image is read.
+    """
+    image = nibabel.load(path)
+    shape = image.shape
+    if len(shape) > 3:
+        index = (slice(None),) * 3 + (shape[3] // 2,) + (0,) * (len(shape) - 4)
+        data = np.asanyarray(image.dataobj[index])
+    else:
+        data = np.asanyarray(image.dataobj)
+        while data.ndim < 3:
+            data = data[..., np.newaxis]
+
+    ornt = nibabel.orientations.io_orientation(image.affine)
+    return nibabel.orientations.apply_orientation(data, ornt)
+
+
+def make_mosaic(volume, slices=6, size=128, rows=True):
+    """Tile downsampled slices of a volume into one 8-bit image.
+
+    Args:
+        volume (:obj:`numpy.ndarray`): A 3D array in RAS+ orientation.
+        slices (int, optional): The number of evenly spaced slices to take
+            from each orientation.
+        size (int, optional): The width and height of each tile in pixels.
+        rows (bool, optional): Give each orientation a row of its own. If
+            False all tiles are put in a single row.
+
+    Returns:
+        :obj:`numpy.ndarray`: A 2D uint8 array.
+    """
+    step = max(1, int(math.ceil(max(volume.shape) / float(size))))
+    small = volume[::step, ::step, ::step]
+    low, high = _intensity_range(small)
+
+    tiles = []
+    for axis in (2, 1, 0):
+        row = []
+        for idx in _slice_indices(small.shape[axis], slices):
+            tile = np.rot90(np.take(small, idx, axis=axis))
+            row.append(_pad(_scale(tile, low, high), size))
+        tiles.append(np.hstack(row))
+
+    if rows:
+        return np.vstack(tiles)
+    return np.hstack(tiles)
+
+
+def write_png(path, image):
+    """Write a 2D uint8 array as a greyscale PNG.
+
+    The file is written to a temporary name first, so a preview is never
+    seen half written.
+    """
+    height, width = image.shape
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    # The first byte of each row is its filter type (0 = none)
+    raw[:, 1:] = image
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'wb') as out:
+        out.write(b'\x89PNG\r\n\x1a\n')
+        out.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                                  8, 0, 0, 0, 0)))
+        out.write(_png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        out.write(_png_chunk(b'IEND', b''))
+    os.replace(temp, path)
+
+
+def _png_chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data +
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+
+def _intensity_range(volume):
+    values = volume[np.isfinite(volume)]
+    if not values.size:
+        return 0.0, 1.0
+    low, high = np.percentile(values, (1, 99))
+    if high <= low:
+        high = low + 1
+    return float(low), float(high)
+
+
+def _slice_indices(length, count):
+    if count == 1:
+        return [length // 2]
+    # Skip the outer edges, they're rarely anything but background
+    return [int(round(length * (i + 1) / float(count + 1)))
+            for i in range(count)]
+
+
+def _scale(tile, low, high):
+    tile = np.nan_to_num(tile.astype(np.float32))
+    tile = (np.clip(tile, low, high) - low) * (255.0 / (high - low))
+    return tile.astype(np.uint8)
+
+
+def _pad(tile, size):
+    padded = np.zeros((size, size), dtype=np.uint8)
+    height, width = min(tile.shape[0], size), min(tile.shape[1], size)
+    top, left = (size - height) // 2, (size - width) // 2
+    padded[top:top + height, left:left + width] = tile[:height, :width]
+    return padded
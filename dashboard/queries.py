@@ -1,17 +1,27 @@
 """Reusable database queries.
 """
+import re
+import json
 import logging
 
-from sqlalchemy import and_, func
+from sqlalchemy import and_, or_, func, select, case, Numeric
 
 from dashboard import db
 from .models import (Timepoint, Session, Scan, Study, Site, Metrictype,
                      MetricValue, Scantype, StudySite, AltStudyCode, User,
-                     study_timepoints_table)
+                     StudyUser, HeaderBlob, study_timepoints_table)
 import datman.scanid as scanid
 
 logger = logging.getLogger(__name__)
 
+# The tests that can be made against a field of a scan's JSON header
+HEADER_OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'exists', 'missing')
+
+_HEADER_PREDICATE = re.compile(
+    r'^\s*(?P<field>[^\s=!<>]+)\s*'
+    r'(?:(?P<op>!=|<=|>=|=|<|>)\s*(?P<value>.+?)|\s(?P<test>exists|missing))'
+    r'\s*$')
+
 
 def get_study(name=None, tag=None, site=None):
     """Retrieve a study from the database.
@@ -113,6 +123,64 @@ def get_study_timepoints(study, site=None, phantoms=False):
     return [s.name for s in timepoints]
 
 
+def get_unreviewed_timepoints(study_ids):
+    """Find the timepoints in each study that still need quality control.
+
+    A timepoint needs QC if it isn't a phantom and at least one of its
+    sessions hasn't been signed off. This gives the same result as calling
+    'Timepoint.is_qcd()' on every timepoint, but uses a single query.
+
+    Args:
+        study_ids (:obj:`list` of :obj:`str`): The IDs of studies to check.
+
+    Returns:
+        dict: A dictionary mapping each study ID to a sorted list of the
+        names of its timepoints still needing QC. Studies with nothing to
+        review are left out.
+    """
+    stc = study_timepoints_table.c
+    found = db.session.query(stc.study, Timepoint.name) \
+        .select_from(study_timepoints_table) \
+        .join(Timepoint, Timepoint.name == stc.timepoint) \
+        .join(Session, Session.name == Timepoint.name) \
+        .filter(stc.study.in_(study_ids)) \
+        .filter(Timepoint.is_phantom.is_(False)) \
+        .filter(Session.signed_off.isnot(True)) \
+        .group_by(stc.study, Timepoint.name) \
+        .order_by(stc.study, Timepoint.name) \
+        .all()
+
+    timepoints = {}
+    for study, timepoint in found:
+        timepoints.setdefault(study, []).append(timepoint)
+    return timepoints
+
+
+def get_qcers(study_ids):
+    """Find the users who do quality control for each of a list of studies.
+
+    Args:
+        study_ids (:obj:`list` of :obj:`str`): The IDs of studies to check.
+
+    Returns:
+        dict: A dictionary mapping each study ID to a list of
+        :obj:`dashboard.models.User` records.
+    """
+    found = db.session.query(StudyUser.study_id, User) \
+        .join(User, User.id == StudyUser.user_id) \
+        .filter(StudyUser.study_id.in_(study_ids)) \
+        .filter(StudyUser.does_qc.is_(True)) \
+        .all()
+
+    qcers = {}
+    for study, user in found:
+        users = qcers.setdefault(study, [])
+        # Users with access to multiple sites will be found more than once
+        if user not in users:
+            users.append(user)
+    return qcers
+
+
 def find_sessions(search_str):
     """
     Used by the dashboard's search bar and so must work around fuzzy user
@@ -211,6 +279,148 @@ def find_scans(search_str):
     return query.all()
 
 
+def find_scans_by_header(study, predicates, sites=None, tag=None):
+    """Find a study's scans whose JSON headers match a set of predicates.
+
+    Equality tests are made with JSONB containment, so they can use the GIN
+    index on 'header_blobs.contents'. The other tests are applied to the rows
+    left by the equality tests and the study, site and tag filters. Headers
+    stored compressed (see :py:class:`dashboard.models.HeaderBlob`) are
+    never matched.
+
+    Args:
+        study (str): The study ID.
+        predicates (list): (field, operator, value) tuples that must all be
+            true. The operator must be one of HEADER_OPERATORS. Values are
+            ignored for 'exists' and 'missing'. '!=' and the ordering tests
+            only match scans that have the field.
+        sites (list, optional): Only search scans from these sites.
+        tag (str, optional): Only search scans with this tag.
+
+    Raises:
+        ValueError: If a predicate has an unknown operator or an ordering
+            test is given a value that isn't a number.
+
+    Returns:
+        :obj:`sqlalchemy.sql.expression.Select`: A query for the ID, name,
+        site and tag of each matching scan, followed by the value of each
+        field tested. Results are ordered by scan name.
+    """
+    fields = []
+    for field, _, _ in predicates:
+        if field not in fields:
+            fields.append(field)
+
+    query = select(
+        [Scan.id.label('scan_id'), Scan.name.label('scan'),
+         Timepoint.site_id.label('site'), Scan.tag] +
+        [HeaderBlob.contents[field].astext.label(field) for field in fields]) \
+        .select_from(
+            Scan.__table__
+                .join(HeaderBlob.__table__, Scan.json_hash == HeaderBlob.hash)
+                .join(Timepoint.__table__, Scan.timepoint == Timepoint.name)
+                .join(study_timepoints_table,
+                      and_(study_timepoints_table.c.timepoint ==
+                           Timepoint.name,
+                           study_timepoints_table.c.study == study))) \
+        .where(HeaderBlob.contents.isnot(None)) \
+        .order_by(Scan.name)
+    if sites is not None:
+        query = query.where(Timepoint.site_id.in_(sites))
+    if tag:
+        query = query.where(Scan.tag == tag)
+    for field, op, value in predicates:
+        query = query.where(_header_filter(field, op, value))
+    return query
+
+
+def find_problem_scans(study, sites=None):
+    """Find a study's scans that have header diffs or conversion errors.
+
+    Only the scans' status columns are read (see
+    :py:class:`dashboard.models.Scan`), so this stays quick for large
+    studies.
+
+    Args:
+        study (str): The study ID.
+        sites (list, optional): Only search scans from these sites.
+
+    Returns:
+        list: A row for each scan with its 'id', 'name', 'site', 'tag',
+        'has_header_diffs', 'diff_field_count' and 'has_conversion_error',
+        ordered by scan name.
+    """
+    query = select([
+        Scan.id, Scan.name,
+        Timepoint.site_id.label('site'), Scan.tag, Scan.has_header_diffs,
+        Scan.diff_field_count, Scan.has_conversion_error
+    ]).select_from(
+        Scan.__table__
+            .join(Timepoint.__table__, Scan.timepoint == Timepoint.name)
+            .join(study_timepoints_table,
+                  and_(study_timepoints_table.c.timepoint == Timepoint.name,
+                       study_timepoints_table.c.study == study))) \
+        .where(or_(Scan.has_header_diffs, Scan.has_conversion_error)) \
+        .order_by(Scan.name)
+    if sites is not None:
+        query = query.where(Timepoint.site_id.in_(sites))
+    return db.session.execute(query).fetchall()
+
+
+def parse_header_predicate(text):
+    """Parse a predicate for :py:func:`find_scans_by_header`.
+
+    Predicates look like 'RepetitionTime != 2.0' or 'SliceTiming exists'.
+    Values are read as JSON where possible and as plain strings otherwise.
+
+    Raises:
+        ValueError: If the text isn't a valid predicate.
+
+    Returns:
+        tuple: The (field, operator, value).
+    """
+    match = _HEADER_PREDICATE.match(text)
+    if not match:
+        raise ValueError("Can't parse header predicate '{}'".format(text))
+    if match.group('test'):
+        return match.group('field'), match.group('test'), None
+    value = match.group('value')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return match.group('field'), match.group('op'), value
+
+
+def _header_filter(field, op, value):
+    contents = HeaderBlob.contents
+    if op == 'exists':
+        return contents.has_key(field)
+    if op == 'missing':
+        return ~contents.has_key(field)
+    if op == '=':
+        return contents.contains({field: value})
+    if op == '!=':
+        return and_(contents.has_key(field),
+                    ~contents.contains({field: value}))
+    if op not in HEADER_OPERATORS:
+        raise ValueError("Unknown header operator '{}'".format(op))
+
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("Header field '{}' can only be compared to a "
+                         "number with '{}'".format(field, op))
+    # Non-numeric values become NULL instead of failing the cast
+    number = case([(func.jsonb_typeof(contents[field]) == 'number',
+                    contents[field].astext.cast(Numeric))])
+    if op == '<':
+        return number < value
+    if op == '<=':
+        return number <= value
+    if op == '>':
+        return number > value
+    return number >= value
+
+
 def get_user(username):
     query = User.query.filter(
         func.lower(User._username).contains(func.lower(username)))
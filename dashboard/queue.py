@@ -1,13 +1,29 @@
 """Code used to interact with computing clusters.
+
+Jobs started with :py:func:`start_array_job` are tracked in the database as
+:py:class:`dashboard.models.ClusterJob` records and submitted by
+:py:func:`submit_cluster_job` in the scheduler's 'cluster' lane.
+:py:func:`poll_jobs` runs periodically on the server to update the state of
+every unfinished job with a single status query.
 """
+import re
+import logging
 from os.path import join
+from datetime import datetime, timedelta, timezone
 from subprocess import run, PIPE, CalledProcessError
-import logging
 
 from flask import current_app
 
+from dashboard import scheduler, db
+from dashboard.models import ClusterJob
+
 logger = logging.getLogger(__name__)
 
+# Matches the job IDs reported by sacct (e.g. '1234', '1234_5' or
+# '1234_[6-10%2]')
+REPORTED_ID = re.compile(r"^(\d+)(?:_(\d+|\[[^\]]*\]))?$")
+
+
 def submit_job(script, input_args=None):
     """Attempt to submit a job to the configured computing cluster.
 
@@ -16,16 +32,225 @@ def submit_job(script, input_args=None):
         input_args (:obj:`list`, optional): A list of input arguments to give
             the job script.
     """
+    cmd = _base_command()
+    cmd.append(join(current_app.config["SUBMIT_SCRIPTS"], script))
+
+    if input_args:
+        cmd.extend(input_args)
+
+    return _run(cmd, script, input_args)
+
+
+def submit_array_job(script, task_args):
+    """Submit one array job that runs a script once for each set of inputs.
+
+    The job runs queue_jobs/array_job.sh, which looks up its array index
+    and runs 'script' with the matching inputs. Jobs are limited to
+    'SUBMIT_ARRAY_SIZE' tasks, so larger lists should be split up by the
+    caller. This waits for the cluster to accept the job.
+
+    Args:
+        script (str): The name of a script in the SUBMIT_SCRIPTS folder.
+        task_args (:obj:`list` of :obj:`list`): The input arguments for each
+            task, in array index order. Arguments may not contain whitespace.
+
+    Returns:
+        str: The ID the cluster assigned to the job.
+    """
+    if not task_args:
+        return None
+
+    cmd = _array_command(script, task_args)
+    cmd.insert(1, "--parsable")
+    stdout, _ = _run(cmd, script, task_args)
+    # Parsable output is either 'job_id' or 'job_id;cluster'
+    return stdout.decode().strip().split(";")[0]
+
+
+def start_array_job(script, sessions, study):
+    """Record an array job and submit it to the cluster in the background.
+
+    The job's record is committed and then submitted by
+    :py:func:`submit_cluster_job` in the scheduler's 'cluster' lane. If the
+    scheduler can't be reached the job is marked as failed to submit.
+
+    Args:
+        script (str): The name of a script in the SUBMIT_SCRIPTS folder. Each
+            task runs it with the study and a session's name.
+        sessions (:obj:`list` of :obj:`tuple`): The (name, num) of the
+            session for each task.
+        study (str): The ID of the study the sessions belong to.
+
+    Returns:
+        :obj:`dashboard.models.ClusterJob`: The (committed) job record.
+    """
+    _check_size(len(sessions))
+
+    job = ClusterJob.create(script, sessions, study=study)
+    db.session.commit()
+
+    try:
+        scheduler.add_job('cluster_job_{}'.format(job.id),
+                          submit_cluster_job,
+                          trigger='date',
+                          run_date=datetime.now(),
+                          args=[job.id])
+    except Exception as e:
+        logger.error("Failed to schedule submission of cluster job {} for "
+                     "{}. Reason - {}".format(job.id, study, e))
+        job.submit_failed("Submission couldn't be scheduled - {}".format(e))
+        db.session.commit()
+    return job
+
+
+def submit_cluster_job(job_id):
+    """Submit a recorded array job to the cluster and save its ID.
+
+    The submission is waited on, so the ID the cluster assigns is saved by
+    the same job that received it. Jobs that have already been submitted
+    are skipped.
+
+    Args:
+        job_id (int): The ID of a :py:class:`dashboard.models.ClusterJob`.
+    """
+    job = ClusterJob.query.get(job_id)
+    if not job or job.state != ClusterJob.SUBMITTING:
+        return
+
+    task_args = [[job.study, "{}_{:02d}".format(task.name, task.num)]
+                 for task in job.tasks]
+    try:
+        queue_id = submit_array_job(job.script, task_args)
+    except Exception as e:
+        logger.error("Failed to submit cluster job '{}' for {}. Reason: "
+                     "{}".format(job.script, job.study, e))
+        stderr = getattr(e, 'stderr', None)
+        job.submit_failed(stderr.decode() if stderr else str(e))
+    else:
+        job.submitted_as(queue_id)
+    db.session.commit()
+
+
+def poll_jobs():
+    """Update the state of all unfinished cluster jobs.
+
+    This runs periodically on the server. The cluster is asked about every
+    active job at once. Jobs that never got an ID from the cluster (e.g.
+    because the server restarted during submission) are marked lost.
+    """
+    jobs = ClusterJob.active().all()
+    if not jobs:
+        return
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=1)
+    queued = {}
+    for job in jobs:
+        if job.queue_id:
+            queued[job.queue_id] = job
+        elif job.submitted < cutoff:
+            job.submit_failed("No job ID was received from the cluster",
+                              state=ClusterJob.LOST)
+
+    if queued:
+        try:
+            states = get_states(list(queued))
+        except Exception as e:
+            logger.error("Failed to get cluster job states. Reason: "
+                         "{}".format(e))
+            states = {}
+        for queue_id, job_states in states.items():
+            queued[queue_id].update_states(job_states)
+
+    db.session.commit()
+
+
+def get_states(queue_ids):
+    """Ask the cluster for the state of a list of jobs.
+
+    Args:
+        queue_ids (:obj:`list` of :obj:`str`): Cluster job IDs.
+
+    Returns:
+        dict: A dictionary mapping each job ID found to a dictionary of the
+        states of its array tasks (see
+        :py:meth:`dashboard.models.ClusterJob.update_states`).
+    """
+    cmd = [current_app.config["STATUS_COMMAND"], "--noheader", "--parsable2",
+           "--allocations", "--format=JobID,State",
+           "--jobs=" + ",".join(queue_ids)]
+    result = run(cmd, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    result.check_returncode()
+    return parse_states(result.stdout)
+
+
+def parse_states(output):
+    """Parse the 'JobID|State' lines that sacct reports.
+    """
+    states = {}
+    for line in output.splitlines():
+        try:
+            reported, state = line.strip().split("|")[:2]
+        except ValueError:
+            continue
+        match = REPORTED_ID.match(reported)
+        if not match or not state:
+            continue
+        queue_id, tasks = match.groups()
+        # e.g. 'CANCELLED by 1234' should just be 'CANCELLED'
+        state = state.split()[0].rstrip("+")
+        job_states = states.setdefault(queue_id, {})
+        for task in _expand_tasks(tasks):
+            job_states[task] = state
+    return states
+
+
+def _expand_tasks(tasks):
+    """Get the array indices from a sacct task string (e.g. '[1,3-5%2]').
+    """
+    if tasks is None:
+        return [None]
+    if not tasks.startswith("["):
+        return [int(tasks)]
+    indices = []
+    for part in tasks.strip("[]").split("%")[0].split(","):
+        start, _, end = part.partition("-")
+        indices.extend(range(int(start), int(end or start) + 1))
+    return indices
+
+
+def _check_size(num_tasks):
+    max_size = current_app.config["SUBMIT_ARRAY_SIZE"]
+    if num_tasks > max_size:
+        raise ValueError("Can't submit {} tasks, array jobs are limited to "
+                         "{}".format(num_tasks, max_size))
+
+
+def _array_command(script, task_args):
+    _check_size(len(task_args))
+
+    array = "--array=0-{}".format(len(task_args) - 1)
+    if current_app.config["SUBMIT_ARRAY_LIMIT"]:
+        array += "%{}".format(current_app.config["SUBMIT_ARRAY_LIMIT"])
+
+    scripts = current_app.config["SUBMIT_SCRIPTS"]
+    cmd = _base_command()
+    cmd.append(array)
+    cmd.append(join(scripts, "array_job.sh"))
+    cmd.append(join(scripts, script))
+    cmd.extend(" ".join(args) for args in task_args)
+    return cmd
+
+
+def _base_command():
     cmd = [current_app.config["SUBMIT_COMMAND"]]
 
     if current_app.config["SUBMIT_OPTIONS"]:
         cmd.append(current_app.config["SUBMIT_OPTIONS"])
 
-    cmd.append(join(current_app.config["SUBMIT_SCRIPTS"], script))
+    return cmd
 
-    if input_args:
-        cmd.extend(input_args)
 
+def _run(cmd, script, input_args):
     try:
         # capture_output=True can be used only for python > 3.5
         result = run(cmd, stdout=PIPE, stderr=PIPE)
@@ -0,0 +1,22 @@
+#!/bin/bash -l
+#
+#SBATCH --job-name=dashboard_array
+#SBATCH --ntasks=1
+#SBATCH --cores=1
+#SBATCH --time=01:00:00
+#
+# Runs one task of an array job submitted by dashboard.queue.submit_array_job
+#
+# Usage: array_job.sh <script> <task 0 args> <task 1 args> ...
+#
+# Each task's args are given as one space separated argument. The task
+# matching this job's array index is run by passing its args to <script>.
+
+script="$1"
+shift
+tasks=("$@")
+
+# Split the task's args on whitespace only (no glob expansion)
+read -r -a args <<< "${tasks[$SLURM_ARRAY_TASK_ID]}"
+
+bash -l "${script}" "${args[@]}"
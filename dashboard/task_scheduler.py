@@ -1,58 +1,490 @@
 #!/usr/bin/env python
 
+import os
 import json
+import time
+import atexit
+import sqlite3
 import logging
-import requests
-from requests import ConnectionError
+import threading
+import multiprocessing
+import concurrent.futures
+from collections import deque
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
 
-from apscheduler.executors.pool import ThreadPoolExecutor
+import requests
+from requests import ConnectionError, RequestException, Timeout
+from requests.adapters import HTTPAdapter
+from flask import current_app, request
+from flask_apscheduler import APScheduler
+from flask_apscheduler.json import jsonify
+from apscheduler.executors.pool import BasePoolExecutor, ThreadPoolExecutor
+from apscheduler.events import (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR,
+                                EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES)
 from apscheduler.executors.base import run_job
+from apscheduler.jobstores.base import ConflictingIdError
+from apscheduler.util import obj_to_ref
+from sqlalchemy import exc, func, select
+from sqlalchemy.event import listens_for
+from sqlalchemy.pool import Pool
 
 from .exceptions import SchedulerException
 
 logger = logging.getLogger(__name__)
 
 
-class ContextThreadExecutor(ThreadPoolExecutor):
-    """Runs all scheduler jobs within the app context.
+class DashboardScheduler(APScheduler):
+    """The scheduler used by the dashboard's scheduler server.
 
-    By default ThreadPoolExecutor does not propagate the app context correctly
-    when it submits jobs to its pool to execute. This class fixes the problem
-    by replacing the 'run_job' function submitted to the thread pool with
-    the 'context_run' wrapper which ensures a context has been pushed before
-    'run_job' executes.
+    This is Flask-APScheduler's scheduler with the '/jobs' POST endpoint
+    replaced by :py:func:`add_jobs`, which accepts a list of jobs as well as
+    a single job, so clients can submit many jobs with one request.
+
+    Jobs that don't name an executor are also routed to one of the executor
+    'lanes' in 'SCHEDULER_EXECUTORS' based on the function they run (see
+    'SCHEDULER_JOB_LANES'), so that slow jobs of one kind can't hold up
+    everything else.
+
+    Statistics on how promptly and how long jobs run are collected in
+    :py:attr:`telemetry` and, when the API is enabled, served from
+    '/scheduler/telemetry'.
     """
 
-    def _do_submit_job(self, job, run_times):
-        """Submits a job to the thread pool.
+    def __init__(self, scheduler=None, app=None):
+        self.telemetry = SchedulerTelemetry()
+        super(DashboardScheduler, self).__init__(scheduler=scheduler, app=app)
+        # Executors find the telemetry through the scheduler they belong to
+        self._scheduler.telemetry = self.telemetry
+        self._scheduler.add_listener(self._job_skipped,
+                                     EVENT_JOB_MAX_INSTANCES)
+
+    def add_job(self, id, func, **kwargs):
+        kwargs.setdefault('executor', self.get_lane(func))
+        return super(DashboardScheduler, self).add_job(id, func, **kwargs)
+
+    def get_lane(self, func):
+        """Find the name of the executor a job function should run in.
 
-        This function is almost identical to BasePoolExecutor._do_submit_job
-        from apscheduler.executors.pool as of version 3.6.3. The only change
-        (aside from fixing line lengths) is to the call to self._pool.submit,
-        where run_job has been replaced with context_run and the app has
-        been added as an argument.
+        'SCHEDULER_JOB_LANES' is checked for the function's full reference
+        (e.g. 'dashboard.monitors:sweep_redcap_imports') first and then its
+        module. Functions with no lane, or whose lane has no executor, use
+        the 'default' executor.
+
+        Args:
+            func (callable or str): The job function or a textual reference
+                to it.
+
+        Returns:
+            str: The executor alias to use.
+        """
+        lanes = self.app.config.get('SCHEDULER_JOB_LANES') or {}
+        executors = self.app.config.get('SCHEDULER_EXECUTORS') or {}
+        ref = func if isinstance(func, str) else obj_to_ref(func)
+        lane = lanes.get(ref) or lanes.get(ref.split(':')[0])
+        if lane in executors:
+            return lane
+        return 'default'
+
+    def count_jobs(self):
+        """Count the jobs in each job store.
+
+        Returns:
+            dict: The number of jobs in each job store (keyed by alias) and
+            how many of them are overdue (i.e. should have run already but
+            haven't been picked up yet).
         """
+        now = datetime.now(timezone.utc)
+        counts = {}
+        for alias, store in list(self._scheduler._jobstores.items()):
+            if hasattr(store, 'jobs_t'):
+                # Count SQLAlchemyJobStore jobs without unpickling them all
+                table = store.jobs_t
+                with store.engine.connect() as conn:
+                    total = conn.execute(
+                        select([func.count()]).select_from(table)).scalar()
+                    overdue = conn.execute(
+                        select([func.count()]).select_from(table).where(
+                            table.c.next_run_time <= now.timestamp())
+                    ).scalar()
+            else:
+                jobs = store.get_all_jobs()
+                total = len(jobs)
+                overdue = len([job for job in jobs
+                               if job.next_run_time and
+                               job.next_run_time <= now])
+            counts[alias] = {'pending': total, 'overdue': overdue}
+        return counts
+
+    def _job_skipped(self, event):
+        job = self._scheduler.get_job(event.job_id, event.jobstore)
+        self.telemetry.job_skipped(job.func_ref if job else event.job_id)
+
+    def _load_api(self):
+        super(DashboardScheduler, self)._load_api()
+        self._add_url_route('get_telemetry', '/telemetry', get_telemetry,
+                            'GET')
+
+    def _add_url_route(self, endpoint, rule, view_func, method):
+        if endpoint == 'add_job':
+            view_func = add_jobs
+        super(DashboardScheduler, self)._add_url_route(
+            endpoint, rule, view_func, method)
+
+
+def add_jobs():
+    """Add one or more jobs to the scheduler.
+
+    The request body may be a single job dictionary (in which case this
+    behaves exactly like Flask-APScheduler's original endpoint) or a list of
+    them. For a list, the reply holds one entry per job in the same order,
+    each with the job's 'id', a 'status' code and, if the job couldn't be
+    added, an 'error_message'.
+    """
+    data = request.get_json(force=True)
+    if isinstance(data, dict):
+        result = _add_job(data)
+        if 'job' in result:
+            return jsonify(result['job'])
+        return jsonify(dict(error_message=result['error_message']),
+                       status=result['status'])
+
+    if not isinstance(data, list):
+        return jsonify(dict(error_message='Expected a job or a list of '
+                                          'jobs.'), status=400)
+
+    return jsonify([_add_job(job) for job in data])
+
+
+def get_telemetry():
+    """Report job timing statistics, executor use and job store sizes.
+    """
+    scheduler = current_app.apscheduler
+    stats = scheduler.telemetry.report()
+    stats['jobstores'] = scheduler.count_jobs()
+    return jsonify(stats)
+
+
+def _add_job(data):
+    try:
+        job = current_app.apscheduler.add_job(**data)
+    except ConflictingIdError:
+        return dict(id=data.get('id'), status=409,
+                    error_message='Job {} already exists.'.format(
+                        data.get('id')))
+    except Exception as e:
+        return dict(id=data.get('id'), status=500, error_message=str(e))
+    return dict(id=job.id, status=200, job=job)
+
+
+class InstrumentedExecutor(object):
+    """Job submission shared by the dashboard's pool executors.
+
+    Finished jobs are reported to the scheduler's
+    :py:class:`SchedulerTelemetry` (if it has one) along with when they were
+    submitted, started and finished. Subclasses should submit a function
+    that returns the result of :py:func:`timed_run` via :py:meth:`_submit`.
+    """
+
+    def start(self, scheduler, alias):
+        super(InstrumentedExecutor, self).start(scheduler, alias)
+        self._alias = alias
+        self._telemetry = getattr(scheduler, 'telemetry', None)
+        if self._telemetry is not None:
+            self._telemetry.add_lane(alias, self._pool._max_workers)
+
+    def _submit(self, job, run_func, *args):
+        telemetry = getattr(self, '_telemetry', None)
+        submitted = time.time()
+        if telemetry is not None:
+            telemetry.job_submitted(self._alias)
+
         def callback(f):
             exc, tb = (
                 f.exception_info() if hasattr(f, 'exception_info') else
                 (f.exception(), getattr(f.exception(), '__traceback__', None))
             )
             if exc:
+                if telemetry is not None:
+                    telemetry.job_failed(self._alias, job)
                 self._run_job_error(job.id, exc, tb)
-            else:
-                self._run_job_success(job.id, f.result())
+                return
+            started, finished, events = f.result()
+            if telemetry is not None:
+                telemetry.job_finished(self._alias, job, submitted, started,
+                                       finished, events)
+            self._run_job_success(job.id, events)
 
-        f = self._pool.submit(
-            context_run, self._scheduler.app, job, job._jobstore_alias,
-            run_times, self._logger.name)
+        f = self._pool.submit(run_func, *args)
         f.add_done_callback(callback)
 
 
+class ContextThreadExecutor(InstrumentedExecutor, ThreadPoolExecutor):
+    """Runs all scheduler jobs within the app context.
+
+    By default ThreadPoolExecutor does not propagate the app context correctly
+    when it submits jobs to its pool to execute. This class fixes the problem
+    by replacing the 'run_job' function submitted to the thread pool with
+    the 'context_run' wrapper (via 'timed_run') which ensures a context has
+    been pushed before 'run_job' executes.
+    """
+
+    def _do_submit_job(self, job, run_times):
+        """Submits a job to the thread pool.
+
+        This replaces BasePoolExecutor._do_submit_job from
+        apscheduler.executors.pool as of version 3.6.3. The only change is
+        that 'timed_run' is submitted instead of 'run_job', with the app added
+        as an argument.
+        """
+        self._submit(job, timed_run, self._scheduler.app, job,
+                     job._jobstore_alias, run_times, self._logger.name)
+
+
+class ContextProcessExecutor(InstrumentedExecutor, BasePoolExecutor):
+    """Runs scheduler jobs in a pool of processes, within the app context.
+
+    This is useful for jobs that are CPU heavy enough to hold the GIL for
+    long stretches. Worker processes are forked from the scheduler server,
+    so they inherit its app and use it (via 'process_run') to push a context
+    before each job. The app itself can't be pickled, so it can't be sent
+    along with the job like ContextThreadExecutor does.
+
+    All of the workers are forked as soon as the executor starts, which
+    happens once the app is fully built and before the scheduler (or any
+    request) has started a thread. A child forked later from a busy thread
+    could inherit a lock (e.g. a logging or connection pool lock) that some
+    other thread held at that moment and would never be released. Database
+    connections inherited from the server are never reused or closed by a
+    worker (see :py:func:`_check_connection_pid`).
+
+    Jobs sent to this executor must be picklable, which all jobs in the
+    dashboard's job store already are.
+    """
+
+    def __init__(self, max_workers=2):
+        # Forking is required so workers inherit the configured app (and
+        # never build and start a scheduler of their own)
+        self._max_workers = int(max_workers)
+        pool = concurrent.futures.ProcessPoolExecutor(
+            self._max_workers, mp_context=multiprocessing.get_context('fork'))
+        super(ContextProcessExecutor, self).__init__(pool)
+
+    def start(self, scheduler, alias):
+        super(ContextProcessExecutor, self).start(scheduler, alias)
+        # A fork context pool starts every worker on its first submission
+        started = [self._pool.submit(os.getpid)
+                   for _ in range(self._max_workers)]
+        for future in started:
+            future.result()
+
+    def _do_submit_job(self, job, run_times):
+        self._submit(job, process_run, job, job._jobstore_alias, run_times,
+                     self._logger.name)
+
+
 def context_run(app, job, jobstore_alias, run_times, logger_name):
     with app.app_context():
         return run_job(job, jobstore_alias, run_times, logger_name)
 
 
+def timed_run(app, job, jobstore_alias, run_times, logger_name):
+    """Run a job with 'context_run', noting when it started and finished.
+
+    Returns:
+        tuple: The start time, end time (both as unix timestamps) and the list
+        of events returned by 'run_job'.
+    """
+    started = time.time()
+    events = context_run(app, job, jobstore_alias, run_times, logger_name)
+    return started, time.time(), events
+
+
+_worker_app = None
+
+
+def process_run(job, jobstore_alias, run_times, logger_name):
+    """Run a job inside a ContextProcessExecutor's worker process.
+    """
+    global _worker_app
+    if _worker_app is None:
+        from dashboard import scheduler
+        _worker_app = scheduler.app
+    return timed_run(_worker_app, job, jobstore_alias, run_times,
+                     logger_name)
+
+
+@listens_for(Pool, 'connect')
+def _record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@listens_for(Pool, 'checkout')
+def _check_connection_pid(dbapi_connection, connection_record,
+                          connection_proxy):
+    """Stop forked processes from using connections they inherited.
+
+    The connection is dropped from the child's pool without being closed,
+    since closing it would also close the socket the parent is still using.
+    The pool then opens a new connection for the child.
+    """
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, attempting to check out in "
+            "pid {}".format(connection_record.info['pid'], pid))
+
+
+class SchedulerTelemetry(object):
+    """Collects statistics on the jobs the scheduler runs.
+
+    For each job function this records how many times it ran, raised an
+    exception, misfired (i.e. started too late, outside its
+    'misfire_grace_time', and so was skipped) or was skipped because a
+    previous run hadn't finished. For the most recent runs it also keeps:
+
+    * latency: seconds between when a job was scheduled to run and when it
+      actually started.
+    * wait: seconds a job spent queued in its executor before a worker was
+      free. High waits mean the executor's lane is too small.
+    * duration: seconds the job function took.
+
+    The number of jobs each executor lane has queued or running is tracked
+    too.
+    """
+
+    def __init__(self, window=500):
+        """Create an empty set of statistics.
+
+        Args:
+            window (int, optional): The number of recent runs of each job
+                function to keep timings for.
+        """
+        self.window = window
+        self.since = datetime.now(timezone.utc)
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._lanes = {}
+
+    def add_lane(self, lane, workers):
+        with self._lock:
+            self._lanes[lane] = {'workers': workers, 'in_flight': 0}
+
+    def job_submitted(self, lane):
+        with self._lock:
+            self._lane(lane)['in_flight'] += 1
+
+    def job_failed(self, lane, job):
+        """Record a job that couldn't be run at all.
+        """
+        with self._lock:
+            self._lane(lane)['in_flight'] -= 1
+            self._function(job.func_ref)['errors'] += 1
+
+    def job_skipped(self, func_ref):
+        with self._lock:
+            self._function(func_ref)['skipped'] += 1
+
+    def job_finished(self, lane, job, submitted, started, finished, events):
+        """Record the outcome of a job the executor ran.
+
+        Args:
+            lane (str): The alias of the executor the job ran in.
+            job (:obj:`apscheduler.job.Job`): The job.
+            submitted (float): When the job was given to the executor, as a
+                unix timestamp.
+            started (float): When a worker began running the job.
+            finished (float): When the worker finished running the job.
+            events (list): The events 'run_job' returned.
+        """
+        with self._lock:
+            self._lane(lane)['in_flight'] -= 1
+            stats = self._function(job.func_ref)
+            for event in events:
+                if event.code == EVENT_JOB_MISSED:
+                    stats['misfires'] += 1
+                    continue
+                if event.code == EVENT_JOB_ERROR:
+                    stats['errors'] += 1
+                elif event.code == EVENT_JOB_EXECUTED:
+                    stats['runs'] += 1
+                stats['latency'].append(
+                    started - event.scheduled_run_time.timestamp())
+                stats['wait'].append(started - submitted)
+                stats['duration'].append(finished - started)
+                stats['last_run'] = started
+
+    def report(self):
+        """Summarize the statistics gathered so far.
+
+        Returns:
+            dict: A JSON serializable summary.
+        """
+        with self._lock:
+            functions = {}
+            for func_ref, stats in self._functions.items():
+                summary = {key: stats[key] for key in
+                           ('runs', 'errors', 'misfires', 'skipped')}
+                for key in ('latency', 'wait', 'duration'):
+                    summary[key] = _summarize(stats[key])
+                summary['last_run'] = _isoformat(stats['last_run'])
+                functions[func_ref] = summary
+
+            lanes = {}
+            for lane, stats in self._lanes.items():
+                lanes[lane] = dict(stats)
+                lanes[lane]['queued'] = max(
+                    stats['in_flight'] - stats['workers'], 0)
+
+        return {
+            'since': self.since.isoformat(),
+            'functions': functions,
+            'executors': lanes
+        }
+
+    def _lane(self, lane):
+        return self._lanes.setdefault(lane, {'workers': None, 'in_flight': 0})
+
+    def _function(self, func_ref):
+        try:
+            return self._functions[func_ref]
+        except KeyError:
+            pass
+        stats = {
+            'runs': 0,
+            'errors': 0,
+            'misfires': 0,
+            'skipped': 0,
+            'latency': deque(maxlen=self.window),
+            'wait': deque(maxlen=self.window),
+            'duration': deque(maxlen=self.window),
+            'last_run': None
+        }
+        self._functions[func_ref] = stats
+        return stats
+
+
+def _summarize(values):
+    """Get the mean, median, 95th percentile and max of a list of timings.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'mean': sum(values) / len(values),
+        'p50': values[(len(values) - 1) // 2],
+        'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+        'max': values[-1]
+    }
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
 class RemoteScheduler(object):
     """A client scheduler that submits jobs to a scheduler server's API.
 
@@ -61,16 +493,31 @@ class RemoteScheduler(object):
     all jobs run from the server side only and never from an instance
     of the dashboard that has been imported.
 
+    All requests share one pooled HTTP session, so connections to the server
+    are kept alive and reused. Code that adds many jobs can wrap the calls in
+    :py:meth:`batch` to submit them with one request per 'SCHEDULER_BATCH_SIZE'
+    jobs instead of one request per job. Requests give up after
+    'SCHEDULER_CONNECT_TIMEOUT' and 'SCHEDULER_READ_TIMEOUT' seconds.
+
+    If 'SCHEDULER_SPOOL' is set, jobs are written to a local
+    :py:class:`JobSpool` instead and delivered by a background thread, so
+    callers never wait on (or fail because of) the server.
+
     If more of the scheduler API needs to be exposed a list of all built in end
     points can found in flask_apscheduler/scheduler.py in
     'APScheduler._load_api'
     """
 
     def __init__(self, app=None):
+        self._local = threading.local()
+        self.batch_size = 100
+        self.timeout = (5, 30)
+        self.spool = None
         if app is None:
             # Delay init
             self.auth = (None, None)
             self.url = "N/A"
+            self._http = None
             return
         self.init_app(app)
 
@@ -79,19 +526,119 @@ class RemoteScheduler(object):
             logger.error("Can't submit job {}, scheduler URL not set".format(
                 job_id))
             return
+        job = format_job(job_id, job_function, **extra_args)
+
+        pending = getattr(self._local, 'batch', None)
+        if pending is not None:
+            pending.append(job)
+            if len(pending) >= self.batch_size:
+                self._local.batch = []
+                self.add_jobs(pending)
+            return
+
+        if self.spool is not None:
+            self.spool.put([job])
+            return
+
+        response = self._post(job)
+
+        # If we later intend to do anything with the jobs this should
+        # be updated to return a proper apscheduler.Job instance (like the
+        # 'real' scheduler), but for now its fine to return the string
+        # formatted dictionary the server gives us
+        return response.content
+
+    def add_jobs(self, jobs):
+        """Submit a list of formatted jobs in as few requests as possible.
+
+        Args:
+            jobs (:obj:`list` of :obj:`dict`): Jobs formatted by
+                :py:func:`format_job`.
+
+        Raises:
+            :obj:`dashboard.exceptions.SchedulerException`: If the server
+                can't be reached or any of the jobs were rejected. Jobs that
+                already exist on the server are not treated as errors.
+
+        Returns:
+            list: The server's reply for each job. If jobs are being spooled
+            the list is empty, as nothing has been sent yet.
+        """
+        if not self.url:
+            logger.error("Can't submit {} jobs, scheduler URL not set".format(
+                len(jobs)))
+            return []
+
+        if self.spool is not None:
+            self.spool.put(jobs)
+            return []
+
+        results = self.deliver(jobs)
+        failed = [item for item in results
+                  if item.get('status') not in (200, 409)]
+        if failed:
+            raise SchedulerException("Server rejected {} of {} jobs. Errors: "
+                                     "{}".format(len(failed), len(results),
+                                                 failed))
+        return results
+
+    def deliver(self, jobs):
+        """Send formatted jobs to the server and return its reply for each.
+
+        Unlike :py:meth:`add_jobs` this does not raise if individual jobs are
+        rejected, it's up to the caller to check each job's 'status'.
+        """
+        results = []
+        for start in range(0, len(jobs), self.batch_size):
+            response = self._post(jobs[start:start + self.batch_size])
+            try:
+                results.extend(response.json())
+            except ValueError:
+                raise SchedulerException("Scheduler API gave an unreadable "
+                                         "response: {}".format(
+                                             response.content))
+        return results
+
+    @contextmanager
+    def batch(self):
+        """Collect jobs added in this block and submit them together.
+
+        Example:
+            .. code-block:: python
+
+                with scheduler.batch():
+                    for session in sessions:
+                        monitor_something(session)
+        """
+        if getattr(self._local, 'batch', None) is not None:
+            # Already batching, let the outer block submit.
+            yield self
+            return
+
+        self._local.batch = []
+        try:
+            yield self
+        finally:
+            pending = self._local.batch
+            self._local.batch = None
+            if pending:
+                self.add_jobs(pending)
+
+    def _post(self, payload):
         api_url = self.url + "/jobs"
-        job_str = format_job_function(job_function)
-        extra_args['id'] = job_id
-        extra_args['run_date'] = str(extra_args['run_date'])
-        extra_args['func'] = job_str
-        json_payload = json.dumps(extra_args)
         try:
-            response = requests.post(api_url,
-                                     data=json_payload,
-                                     auth=self.auth)
+            response = self._http.post(api_url,
+                                       data=json.dumps(payload),
+                                       timeout=self.timeout)
         except ConnectionError:
             raise SchedulerException("Scheduler API is not available at {}"
                                      "".format(self.url))
+        except Timeout:
+            raise SchedulerException("Scheduler API at {} timed out"
+                                     "".format(self.url))
+        except RequestException as e:
+            raise SchedulerException("Failed to reach scheduler API at {}. "
+                                     "Reason - {}".format(self.url, e))
         if response.status_code == 401:
             raise SchedulerException("Can't submit job, access denied. Check "
                                      "that username and password are "
@@ -101,12 +648,7 @@ class RemoteScheduler(object):
                                      "Received status code {} and response "
                                      "{}".format(response.status_code,
                                                  response.content))
-
-        # If we later intend to do anything with the jobs this should
-        # be updated to return a proper apscheduler.Job instance (like the
-        # 'real' scheduler), but for now its fine to return the string
-        # formatted dictionary the server gives us
-        return response.content
+        return response
 
     def init_app(self, app):
         user = app.config['SCHEDULER_USER']
@@ -114,6 +656,11 @@ class RemoteScheduler(object):
         scheduler_server = app.config['SCHEDULER_SERVER_URL']
 
         self.auth = (user, password)
+        self.batch_size = app.config.get('SCHEDULER_BATCH_SIZE',
+                                         self.batch_size)
+        self.timeout = (
+            app.config.get('SCHEDULER_CONNECT_TIMEOUT', self.timeout[0]),
+            app.config.get('SCHEDULER_READ_TIMEOUT', self.timeout[1]))
         if scheduler_server:
             if not (scheduler_server.startswith("https://") or
                     scheduler_server.startswith("http://")):
@@ -121,6 +668,27 @@ class RemoteScheduler(object):
             self.url = scheduler_server + "/scheduler"
         else:
             self.url = ""
+
+        self._http = requests.Session()
+        self._http.auth = self.auth
+        self._http.headers['Content-Type'] = 'application/json'
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=app.config.get(
+                                  'SCHEDULER_POOL_SIZE', 4))
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+
+        spool_path = app.config.get('SCHEDULER_SPOOL')
+        if spool_path and self.url:
+            self.spool = JobSpool(
+                spool_path, self.deliver,
+                batch_size=self.batch_size,
+                retry_delay=app.config.get('SCHEDULER_SPOOL_RETRY', 5),
+                max_delay=app.config.get('SCHEDULER_SPOOL_MAX_DELAY', 600),
+                max_attempts=app.config.get('SCHEDULER_SPOOL_MAX_ATTEMPTS',
+                                            10),
+                exit_timeout=app.config.get('SCHEDULER_SPOOL_EXIT_TIMEOUT',
+                                            10))
         return
 
     def start(self):
@@ -131,5 +699,232 @@ class RemoteScheduler(object):
         return "<RemoteScheduler for {}>".format(self.url)
 
 
+class JobSpool(object):
+    """A durable, local queue of jobs waiting to be sent to the server.
+
+    Jobs are stored in an SQLite database keyed by job ID, so adding a job
+    that's already waiting replaces it instead of sending it twice. A daemon
+    thread delivers waiting jobs in batches. If the server can't be reached
+    it backs off (doubling the delay each time, up to 'max_delay') and tries
+    again later. Jobs the server rejects are retried on the same schedule
+    until they've failed 'max_attempts' times, after which they're left in
+    the spool (with the last error) for someone to look at.
+
+    Jobs still waiting when the process exits get one last delivery attempt,
+    anything left after that is sent by the next process to use the spool.
+    """
+
+    def __init__(self, path, deliver, batch_size=100, retry_delay=5,
+                 max_delay=600, max_attempts=10, exit_timeout=10):
+        """Open (or create) a spool.
+
+        Args:
+            path (str): The full path to the SQLite database to use.
+            deliver (callable): A function that takes a list of formatted
+                jobs, sends them to the server and returns the server's reply
+                for each job (see :py:meth:`RemoteScheduler.deliver`). It
+                should raise :obj:`dashboard.exceptions.SchedulerException`
+                if the server couldn't be reached.
+            batch_size (int, optional): The max number of jobs to hand to
+                'deliver' at once.
+            retry_delay (int, optional): Seconds to wait before the first
+                retry.
+            max_delay (int, optional): The longest to ever wait (in seconds)
+                between retries.
+            max_attempts (int, optional): The number of times the server may
+                reject a job before it's no longer retried.
+            exit_timeout (int, optional): The max number of seconds to spend
+                delivering waiting jobs when the process exits.
+        """
+        self.path = path
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.exit_timeout = exit_timeout
+
+        # Consecutive failures to reach the server, and when to next try it
+        self._outages = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self._create()
+        atexit.register(self.close)
+        if self.waiting():
+            self._start()
+
+    def put(self, jobs):
+        """Add formatted jobs to the spool and wake up the delivery thread.
+        """
+        now = time.time()
+        rows = [(job['id'], json.dumps(job), now, now) for job in jobs]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO jobs "
+                "(id, payload, added, attempts, next_attempt) "
+                "VALUES (?, ?, ?, 0, ?)", rows)
+        self._start()
+        self._wakeup.set()
+
+    def waiting(self):
+        """Return the number of jobs that will still be delivered.
+        """
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE attempts < ?",
+                (self.max_attempts,)).fetchone()[0]
+
+    def flush(self):
+        """Deliver all jobs that are due.
+
+        Returns:
+            float: The number of seconds until the next job is due, or None
+            if nothing is waiting.
+        """
+        with self._lock:
+            if time.time() < self._retry_at:
+                # Still backing off after failing to reach the server
+                return self._retry_at - time.time()
+
+            while True:
+                with closing(self._connect()) as conn:
+                    rows = conn.execute(
+                        "SELECT rowid, id, payload, attempts FROM jobs "
+                        "WHERE attempts < ? AND next_attempt <= ? "
+                        "ORDER BY added LIMIT ?",
+                        (self.max_attempts, time.time(), self.batch_size)
+                    ).fetchall()
+                if not rows:
+                    break
+
+                try:
+                    results = self.deliver([json.loads(row[2])
+                                            for row in rows])
+                except SchedulerException as e:
+                    self._outages += 1
+                    delay = self._backoff(self._outages)
+                    self._retry_at = time.time() + delay
+                    logger.warning("Failed to deliver {} spooled jobs, "
+                                   "retrying in {}s. Reason - {}".format(
+                                       len(rows), delay, e))
+                    return delay
+                self._outages = 0
+                self._record(rows, results)
+
+                if len(rows) < self.batch_size:
+                    break
+
+            with closing(self._connect()) as conn:
+                next_due = conn.execute(
+                    "SELECT MIN(next_attempt) FROM jobs WHERE attempts < ?",
+                    (self.max_attempts,)).fetchone()[0]
+        if next_due is None:
+            return None
+        return max(next_due - time.time(), 0)
+
+    def close(self):
+        """Stop the delivery thread, giving it a last chance to send jobs.
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._retry_at = 0
+        self._wakeup.set()
+        self._thread.join(self.exit_timeout)
+        remaining = self.waiting()
+        if remaining:
+            logger.warning("{} scheduler jobs are still waiting in {}. They "
+                           "will be sent the next time the spool is used."
+                           "".format(remaining, self.path))
+
+    def _record(self, rows, results):
+        """Remove delivered jobs and reschedule any the server rejected.
+        """
+        delivered = []
+        rejected = []
+        now = time.time()
+        for row, result in zip(rows, results):
+            rowid, job_id, _, attempts = row
+            # A 409 means the server already has the job
+            if result.get('status') in (200, 409):
+                delivered.append((rowid,))
+                continue
+            attempts += 1
+            error = result.get('error_message')
+            if attempts >= self.max_attempts:
+                logger.error("Giving up on scheduler job {} after {} "
+                             "attempts. Reason - {}".format(
+                                 job_id, attempts, error))
+            rejected.append((attempts, now + self._backoff(attempts), error,
+                             rowid))
+
+        # Rows are matched by rowid (not job ID) so that a job replaced while
+        # it was being sent isn't mistaken for the version that was sent.
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM jobs WHERE rowid = ?", delivered)
+            conn.executemany(
+                "UPDATE jobs SET attempts = ?, next_attempt = ?, "
+                "last_error = ? WHERE rowid = ?", rejected)
+
+    def _backoff(self, failures):
+        return min(self.retry_delay * 2 ** (failures - 1), self.max_delay)
+
+    def _run(self):
+        while True:
+            try:
+                delay = self.flush()
+            except Exception as e:
+                logger.error("Scheduler job spool failed - {}".format(e))
+                delay = self.max_delay
+            if self._stopping.is_set():
+                return
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name="scheduler-spool",
+                                            daemon=True)
+            self._thread.start()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _create(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, "
+                "payload TEXT NOT NULL, "
+                "added REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt REAL NOT NULL, "
+                "last_error TEXT)")
+
+    def __repr__(self):
+        return "<JobSpool {}>".format(self.path)
+
+
+def format_job(job_id, job_function, **extra_args):
+    """Format a job as the JSON serializable dictionary the server expects.
+    """
+    job = dict(extra_args)
+    job['id'] = job_id
+    if 'run_date' in job:
+        job['run_date'] = str(job['run_date'])
+    job['func'] = format_job_function(job_function)
+    return job
+
+
 def format_job_function(job_function):
     return job_function.__module__ + ":" + job_function.__name__
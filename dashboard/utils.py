@@ -2,18 +2,30 @@
 """Helper functions for views.
 
 """
+import io
+import os
+import csv
 import logging
+import posixpath
+import mimetypes
+from datetime import timezone
 from functools import wraps
 
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse, urljoin, quote
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 from flask_login import current_user
-from flask import flash, url_for, request, redirect
+from flask import (current_app, flash, url_for, request, redirect,
+                   send_file, stream_with_context)
+from sqlalchemy.orm import joinedload
 from werkzeug.routing import RequestRedirect
 
 from .models import Timepoint, Scan
 
 logger = logging.getLogger(__name__)
 
+# The cookie holding a QC page's image token, see issue_qc_token()
+QC_TOKEN_COOKIE = 'qc_token'
+
 
 def report_form_errors(form):
     for field_name, errors in form.errors.items():
@@ -57,7 +69,8 @@ def get_scan(scan_id, study_id, current_user, fail_url=None):
     if not fail_url:
         fail_url = url_for('main.index')
 
-    scan = Scan.query.get(scan_id)
+    # Scan pages read the header, so load it in the same query
+    scan = Scan.query.options(joinedload(Scan.header)).get(scan_id)
 
     if scan is None:
         logger.error("User {} attempted to retrieve scan with ID {}. "
@@ -118,3 +131,212 @@ def is_safe_url(target):
     test_url = urlparse(urljoin(request.host_url, target))
     return (test_url.scheme in ('http', 'https')
             and ref_url.netloc == test_url.netloc)
+
+
+def get_static_page(study_id, timepoint_id):
+    """Get the path to a timepoint's static QC page, if the user may see it.
+
+    Raises:
+        :obj:`werkzeug.routing.RequestRedirect`: If the timepoint doesn't
+            exist or the user doesn't have access to it.
+
+    Returns:
+        str: The full path to the page, or None if the timepoint doesn't
+        have one.
+    """
+    return get_timepoint(study_id, timepoint_id, current_user).static_page
+
+
+def issue_qc_token(response, study_id, timepoint_id, qc_dir):
+    """Let the user fetch a QC page's images without checking access again.
+
+    A QC page loads many images and each one would need the same access
+    check. So once the page itself has been checked, a signed cookie that
+    names the user and the page's folder is set on the response. It's only
+    sent with requests beneath the page's URL and is accepted by
+    :py:func:`check_qc_token` for 'QC_IMAGE_TOKEN_SECONDS'.
+
+    Args:
+        response (:obj:`flask.Response`): The response for the QC page.
+        study_id (str): The study the page was requested through.
+        timepoint_id (str): The name of the page's timepoint.
+        qc_dir (str): The folder holding the page and its images.
+    """
+    token = _qc_serializer().dumps(
+        [current_user.get_id(), study_id, timepoint_id, qc_dir])
+    response.set_cookie(QC_TOKEN_COOKIE,
+                        token,
+                        max_age=current_app.config.get(
+                            'QC_IMAGE_TOKEN_SECONDS', 3600),
+                        path=posixpath.dirname(request.path) + '/',
+                        secure=request.is_secure,
+                        httponly=True,
+                        samesite='Lax')
+
+
+def check_qc_token(study_id, timepoint_id):
+    """Check the cookie set by :py:func:`issue_qc_token` for a QC page.
+
+    The token must have been issued to the current user for the same page,
+    not be older than 'QC_IMAGE_TOKEN_SECONDS' and not be older than the
+    last time the user's access was reduced (see
+    :py:attr:`dashboard.models.User.access_changed`). No queries are made.
+
+    Returns:
+        str: The page's folder, or None if the token is missing or can no
+        longer be used.
+    """
+    token = request.cookies.get(QC_TOKEN_COOKIE)
+    if not token:
+        return None
+    try:
+        values, issued = _qc_serializer().loads(
+            token,
+            max_age=current_app.config.get('QC_IMAGE_TOKEN_SECONDS', 3600),
+            return_timestamp=True)
+        user_id, token_study, token_timepoint, qc_dir = values
+    except (BadSignature, TypeError, ValueError):
+        return None
+    if (user_id != current_user.get_id() or token_study != study_id or
+            token_timepoint != timepoint_id):
+        return None
+    changed = current_user.access_changed
+    if changed:
+        if issued.tzinfo is None:
+            issued = issued.replace(tzinfo=timezone.utc)
+        if issued <= changed:
+            return None
+    return qc_dir
+
+
+def _qc_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='qc-page')
+
+
+def stream_csv(result, file_name, batch_size=500):
+    """Send the rows of a query result as a CSV file as they're read.
+
+    Args:
+        result (:obj:`sqlalchemy.engine.ResultProxy`): The rows to send. The
+            column names are used as the header row. Executing the query
+            with 'stream_results' lets the rows be fetched in batches too.
+        file_name (str): The name to give the downloaded file.
+        batch_size (int, optional): The number of rows to send at a time.
+
+    Returns:
+        :obj:`flask.Response`: A streaming response.
+    """
+    def generate():
+        out = io.StringIO()
+        writer = csv.writer(out)
+        try:
+            writer.writerow(result.keys())
+            while True:
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+        finally:
+            result.close()
+
+    response = current_app.response_class(stream_with_context(generate()),
+                                          mimetype='text/csv')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={}'.format(file_name)
+    return response
+
+
+def send_data_file(path, attachment_filename=None, mimetype=None,
+                   max_age=None):
+    """Send a file from the data archive to an authorized user.
+
+    Responses support byte range requests and have an ETag (from the file's
+    size and modification time), so browsers can download part of a file or
+    revalidate a cached copy without the whole file being sent again. If
+    'DATA_FILE_OFFLOAD' is set the web server sends the file contents
+    instead.
+
+    This does not check permissions. Callers must do that first.
+
+    Args:
+        path (str): The full path to the file.
+        attachment_filename (str, optional): The file name to send the file
+            as. If given, the file is sent as an attachment.
+        mimetype (str, optional): The file's mimetype. Guessed from the
+            file name if not given.
+        max_age (int, optional): The number of seconds browsers may cache
+            the file for. Defaults to 'DATA_FILE_MAX_AGE'.
+
+    Raises:
+        IOError: If the file doesn't exist or can't be read.
+
+    Returns:
+        :obj:`flask.Response`: The response to send.
+    """
+    stat = os.stat(path)
+    config = current_app.config
+    offload = config.get('DATA_FILE_OFFLOAD')
+    accel_path = None
+    if offload == 'x-accel-redirect':
+        accel_path = _get_accel_path(path)
+    offloaded = accel_path or offload == 'x-sendfile'
+
+    if offloaded:
+        # The web server handles range requests, so only the conditional
+        # (304) response is made here
+        response = current_app.response_class(
+            None, mimetype=mimetype or _guess_mimetype(path))
+        if accel_path:
+            response.headers['X-Accel-Redirect'] = accel_path
+        else:
+            response.headers['X-Sendfile'] = path
+        if attachment_filename:
+            response.headers.add('Content-Disposition', 'attachment',
+                                 filename=attachment_filename)
+    else:
+        response = send_file(path,
+                             mimetype=mimetype,
+                             as_attachment=attachment_filename is not None,
+                             attachment_filename=attachment_filename,
+                             add_etags=False,
+                             conditional=False)
+
+    response.last_modified = stat.st_mtime
+    response.set_etag("{:x}-{:x}".format(stat.st_size, stat.st_mtime_ns))
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if max_age is None:
+        max_age = config.get('DATA_FILE_MAX_AGE', 3600)
+    response.cache_control.max_age = max_age
+    response.expires = None
+
+    if offloaded:
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers.pop('X-Accel-Redirect', None)
+            response.headers.pop('X-Sendfile', None)
+        return response
+
+    return response.make_conditional(request,
+                                     accept_ranges=True,
+                                     complete_length=stat.st_size)
+
+
+def _get_accel_path(path):
+    """Find the nginx internal location a file is served from, if any.
+    """
+    path = os.path.realpath(path)
+    roots = current_app.config.get('DATA_FILE_ACCEL_ROOTS') or {}
+    for root, location in roots.items():
+        root = os.path.realpath(root)
+        if os.path.commonpath([root, path]) != root:
+            continue
+        return location.rstrip('/') + '/' + quote(os.path.relpath(path, root))
+    return None
+
+
+def _guess_mimetype(path):
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
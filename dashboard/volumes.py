@@ -0,0 +1,416 @@
+"""Store scans in a multi-resolution, chunked form for fast viewing.
+
+A browser must download and inflate a whole NIfTI before it can show any of
+it. Instead, each scan can be converted once into a set of levels, each
+saved as an uncompressed .npy file that's memory mapped when read:
+
+    - Level 0 holds the full resolution data.
+    - Each following level halves the resolution of the one before, down to
+      a coarse level small enough to fit in a single chunk.
+
+Every level is stored in RAS+ orientation with shape (t, z, y, x) so that a
+chunk of one volume is read from a few contiguous runs of the file. The
+'manifest.json' beside the levels describes their shapes, the affine and a
+suggested display range, so a viewer could fetch the coarse level first and
+then refine the chunks it's showing from the full resolution data.
+
+This is the server side only. The scans blueprint serves manifests and
+chunks, but no page in the dashboard requests them yet, so volumes are only
+built when something calls those endpoints directly.
+
+Volumes are built on request by :py:func:`build_volumes` in the scheduler's
+'preview' lane, since they're only worth the disk space for scans that are
+actually being viewed. Reading a volume updates its manifest's modification
+time (at most once every 'USE_INTERVAL' seconds) to record when it was last
+used. :py:func:`sweep_volumes` runs periodically to delete volumes that
+haven't been used in 'VOLUME_MAX_DAYS' and then the least recently used
+ones until all volumes fit in 'VOLUME_MAX_BYTES'.
+
+.. note:: Reading NIfTI files requires nibabel. Without it volumes are never
+    built.
+"""
+import os
+import glob
+import json
+import time
+import errno
+import shutil
+import logging
+import itertools
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+import numpy as np
+from flask import current_app
+
+from dashboard import scheduler
+from .models import Scan, Study
+from .datman_utils import get_nifti_path, get_volume_folder, get_study_path
+
+try:
+    import nibabel
+except ImportError:
+    nibabel = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+# The most memory mapped levels to keep open at once
+OPEN_LEVELS = 32
+
+# How often (in seconds) a volume's last use is recorded while it's read
+USE_INTERVAL = 3600
+
+_levels = OrderedDict()
+_levels_lock = threading.Lock()
+
+
+def queue_volumes(scan_ids, job_id=None):
+    """Build multi-resolution volumes for a list of scans in the background.
+
+    Args:
+        scan_ids (:obj:`list` of int): The IDs of the scans to build.
+        job_id (str, optional): An ID for the scheduler job. A job that's
+            already waiting with the same ID is replaced.
+    """
+    if nibabel is None or not scan_ids:
+        return
+    try:
+        scheduler.add_job(job_id or 'volumes_{}'.format(scan_ids[0]),
+                          build_volumes,
+                          trigger='date',
+                          run_date=datetime.now(),
+                          args=[list(scan_ids)],
+                          replace_existing=True)
+    except Exception as e:
+        logger.error("Failed to queue volumes for scans {}. Reason - "
+                     "{}".format(scan_ids, e))
+
+
+def build_volumes(scan_ids, force=False):
+    """Build any missing or out of date volumes for a list of scans.
+
+    Args:
+        scan_ids (:obj:`list` of int): The IDs of the scans to build.
+        force (bool, optional): Rebuild volumes even if they're up to date.
+    """
+    for scan in Scan.query.filter(Scan.id.in_(scan_ids)).all():
+        try:
+            build_scan_volume(scan, force=force)
+        except Exception as e:
+            logger.error("Failed to build volume for {}. Reason - "
+                         "{}".format(scan, e))
+
+
+def get_manifest(scan):
+    """Read the manifest for a scan's volume.
+
+    Returns:
+        dict: The manifest, or None if the volume hasn't been built or is
+        out of date.
+    """
+    folder = get_volume_folder(scan)
+    if not folder:
+        return None
+    manifest = _read_manifest(folder)
+    try:
+        source = os.stat(get_nifti_path(scan)).st_mtime
+    except (OSError, TypeError):
+        return None
+    if manifest is None or manifest.get('source_mtime') != source:
+        return None
+    _mark_used(folder)
+    return manifest
+
+
+def sweep_volumes():
+    """Delete volumes to keep them within their disk space budget.
+
+    Volumes that haven't been used in 'VOLUME_MAX_DAYS' are deleted first.
+    If the rest still take up more than 'VOLUME_MAX_BYTES' the least
+    recently used are deleted until they fit. Volumes are rebuilt the next
+    time they're requested.
+    """
+    max_bytes = current_app.config.get('VOLUME_MAX_BYTES', 50 * 1024**3)
+    max_days = current_app.config.get('VOLUME_MAX_DAYS', 30)
+    cutoff = time.time() - max_days * 24 * 60 * 60
+
+    found = []
+    for study in Study.query.all():
+        qc_folder = get_study_path(study.id, folder='qc')
+        if not qc_folder:
+            continue
+        for manifest in glob.glob(
+                os.path.join(qc_folder, '*', 'volumes', '*', MANIFEST)):
+            folder = os.path.dirname(manifest)
+            if folder.endswith(('.tmp', '.old')):
+                # Still being written or replaced
+                continue
+            try:
+                used = os.stat(manifest).st_mtime
+            except OSError:
+                continue
+            found.append((used, _folder_size(folder), folder))
+
+    found.sort()
+    total = sum(size for _, size, _ in found)
+    for used, size, folder in found:
+        if used >= cutoff and total <= max_bytes:
+            break
+        shutil.rmtree(folder, ignore_errors=True)
+        total -= size
+        logger.info("Deleted unused volume {}".format(folder))
+
+
+def build_scan_volume(scan, force=False):
+    """Build the multi-resolution volume for a single scan.
+
+    Returns:
+        bool: True if the volume was written.
+    """
+    if nibabel is None:
+        return False
+    if not force and get_manifest(scan) is not None:
+        return False
+
+    source = get_nifti_path(scan)
+    folder = get_volume_folder(scan)
+    chunk = current_app.config.get('VOLUME_CHUNK_SIZE', 64)
+    write_volume(source, folder, chunk)
+    return True
+
+
+def write_volume(source, folder, chunk=64):
+    """Convert a NIfTI file into a multi-resolution volume folder.
+
+    The levels are written to a temporary folder that then replaces
+    'folder' (see :py:func:`_replace_folder`), so readers never see a partly
+    written volume. Only one volume
+    of the series is held in memory at a time. Level 0 is read from the
+    NIfTI volume by volume and each following level is read from the one
+    before it.
+
+    Args:
+        source (str): The full path to the NIfTI file.
+        folder (str): The folder to write the volume to.
+        chunk (int, optional): The width of the (cubic) chunks that level
+            data will be requested in.
+
+    Returns:
+        dict: The manifest.
+    """
+    mtime = os.stat(source).st_mtime
+    read, count, affine, zooms = read_series(source)
+
+    temp = '{}.{}.tmp'.format(folder, os.getpid())
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+
+    first = read(0)
+    volumes = itertools.chain([first], (read(t) for t in range(1, count)))
+    levels = [_write_level(temp, 0, 1, (count,) + first.shape, first.dtype,
+                           volumes, chunk)]
+    while max(levels[-1]['shape'][1:]) > chunk:
+        prev = np.load(os.path.join(temp, levels[-1]['file']), mmap_mode='r')
+        halved = prev[:, ::2, ::2, ::2]
+        volumes = (halved[t] for t in range(count))
+        levels.append(_write_level(temp, len(levels), levels[-1]['step'] * 2,
+                                   halved.shape, first.dtype, volumes, chunk))
+        del prev, halved
+
+    coarse = np.load(os.path.join(temp, levels[-1]['file']))
+    manifest = {
+        'source_mtime': mtime,
+        'shape': levels[0]['shape'],
+        'dtype': first.dtype.str,
+        'affine': np.asarray(affine).tolist(),
+        'zooms': [float(item) for item in zooms],
+        'chunk': chunk,
+        'range': _display_range(coarse),
+        'levels': levels
+    }
+    with open(os.path.join(temp, MANIFEST), 'w') as out:
+        json.dump(manifest, out)
+
+    _replace_folder(temp, folder, mtime)
+    return manifest
+
+
+def read_series(path):
+    """Open a scan to be read one volume at a time in RAS+ orientation.
+
+    Returns:
+        tuple: A function that reads the volume at a given index as a
+        (z, y, x) little endian array, the number of volumes, the affine
+        for the reoriented voxel grid and the voxel sizes (x, y, z).
+    """
+    image = nibabel.load(path)
+    spatial = min(len(image.shape), 3)
+    # Any dimensions past the fourth are flattened into the volume index
+    extra = image.shape[3:]
+    count = int(np.prod(extra))
+
+    ornt = nibabel.orientations.io_orientation(image.affine)
+    affine = image.affine.dot(
+        nibabel.orientations.inv_ornt_aff(ornt, image.shape[:3]))
+    zooms = np.abs(nibabel.affines.voxel_sizes(affine))
+
+    def read(index):
+        position = np.unravel_index(index, extra) if extra else ()
+        data = np.asanyarray(
+            image.dataobj[(slice(None),) * spatial + tuple(position)])
+        while data.ndim < 3:
+            data = data[..., np.newaxis]
+        data = nibabel.orientations.apply_orientation(data, ornt)
+        if data.dtype.kind not in 'iu' or data.dtype.itemsize > 2:
+            data = data.astype(np.float32)
+        data = data.astype(data.dtype.newbyteorder('<'), copy=False)
+        return data.transpose(2, 1, 0)
+
+    return read, count, affine, zooms
+
+
+def read_chunk(scan, level, volume, z, y, x):
+    """Read one chunk of a scan's volume.
+
+    Args:
+        scan (:obj:`dashboard.models.Scan`): The scan to read.
+        level (int): The resolution level to read from (0 is full
+            resolution).
+        volume (int): The index of the volume in the series.
+        z (int): The chunk index along the z (inferior to superior) axis.
+        y (int): The chunk index along the y (posterior to anterior) axis.
+        x (int): The chunk index along the x (left to right) axis.
+
+    Raises:
+        IndexError: If the level, volume or chunk doesn't exist.
+        IOError: If the scan's volume hasn't been built.
+
+    Returns:
+        tuple: The chunk as a (z, y, x) numpy array and the manifest.
+    """
+    manifest = get_manifest(scan)
+    if manifest is None:
+        raise IOError("No volume has been built for {}".format(scan))
+    info = manifest['levels'][level]
+    if not 0 <= volume < info['shape'][0]:
+        raise IndexError("Volume {} is out of range".format(volume))
+    for idx, count in zip((z, y, x), info['chunks']):
+        if not 0 <= idx < count:
+            raise IndexError("Chunk {} is out of range".format((z, y, x)))
+
+    data = _open_level(os.path.join(get_volume_folder(scan), info['file']))
+    size = manifest['chunk']
+    chunk = data[volume,
+                 z * size:(z + 1) * size,
+                 y * size:(y + 1) * size,
+                 x * size:(x + 1) * size]
+    return np.ascontiguousarray(chunk), manifest
+
+
+def _open_level(path):
+    key = (path, os.stat(path).st_mtime_ns)
+    with _levels_lock:
+        try:
+            _levels.move_to_end(key)
+            return _levels[key]
+        except KeyError:
+            pass
+    data = np.load(path, mmap_mode='r')
+    with _levels_lock:
+        _levels[key] = data
+        while len(_levels) > OPEN_LEVELS:
+            _levels.popitem(last=False)
+    return data
+
+
+def _replace_folder(temp, folder, mtime):
+    """Move a newly written volume folder into place.
+
+    Any existing volume is renamed aside before the new one is moved in and
+    is only deleted afterwards. If another build already put a volume made
+    from the same source in place, that one is kept and 'temp' is deleted.
+    """
+    aside = '{}.{}.old'.format(folder, os.getpid())
+    while True:
+        existing = _read_manifest(folder)
+        if existing and existing.get('source_mtime') == mtime:
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+        try:
+            os.rename(folder, aside)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(temp, folder)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # Another build finished between the renames, check it again
+            continue
+        finally:
+            shutil.rmtree(aside, ignore_errors=True)
+        return
+
+
+def _mark_used(folder):
+    path = os.path.join(folder, MANIFEST)
+    now = time.time()
+    try:
+        if now - os.stat(path).st_mtime > USE_INTERVAL:
+            os.utime(path, (now, now))
+    except OSError as e:
+        logger.debug("Failed to record use of volume {}. Reason - {}".format(
+            folder, e))
+
+
+def _folder_size(folder):
+    size = 0
+    try:
+        for entry in os.scandir(folder):
+            if entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return size
+
+
+def _read_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _write_level(folder, level, step, shape, dtype, volumes, chunk):
+    name = 'level_{}.npy'.format(level)
+    out = np.lib.format.open_memmap(os.path.join(folder, name),
+                                    mode='w+',
+                                    dtype=dtype,
+                                    shape=shape)
+    for idx, volume in enumerate(volumes):
+        out[idx] = volume
+    out.flush()
+    del out
+    return {
+        'level': level,
+        'step': step,
+        'shape': list(shape),
+        'chunks': [_count_chunks(dim, chunk) for dim in shape[1:]],
+        'file': name
+    }
+
+
+def _count_chunks(length, chunk):
+    return -(-length // chunk)
+
+
+def _display_range(data):
+    values = data[np.isfinite(data)]
+    if not values.size:
+        return [0.0, 1.0]
+    low, high = np.percentile(values, (1, 99))
+    return [float(low), float(max(high, low + 1))]
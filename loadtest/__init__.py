@@ -0,0 +1,4 @@
+"""Tools for load testing the dashboard on a development machine.
+
+Nothing in here should ever be imported by the dashboard itself.
+"""
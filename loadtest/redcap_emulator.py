@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""A local stand-in for a REDCap server's API.
+
+Serves just enough of the REDCap API (project metadata, version, events, arms
+and record exports) for :py:func:`dashboard.blueprints.redcap.utils.create_from_request`
+to run end to end without contacting a real REDCap server. Records are read
+from a fixtures folder and any record ID not found there can optionally be
+generated from a session ID template, so load tests can use as many distinct
+records as they need.
+
+Usage:
+    python loadtest/redcap_emulator.py [options]
+
+Options:
+    --port PORT         Port to listen on (default: 5001)
+    --fixtures DIR      Folder holding 'metadata.json' and 'records.json'
+                        (default: loadtest/fixtures)
+    --id-template STR   A session ID template used to generate records that
+                        are not in the fixtures (e.g. 'SPN01_CMH_{:04d}_01_01').
+                        The record ID is substituted into the template.
+    --latency SECONDS   Artificial delay added to every API response, to mimic
+                        a slow or distant REDCap server (default: 0)
+    --version STR       The REDCap version to report (default: 9.1.0)
+
+The dashboard's 'REDCAP_TOKEN' can be set to anything, the emulator doesn't
+check tokens.
+"""  # noqa: E501
+import os
+import json
+import time
+import logging
+import argparse
+import datetime
+
+from flask import Flask, Response, request, jsonify
+
+logger = logging.getLogger(__name__)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        'fixtures')
+
+
+class RecordStore(object):
+    """Holds the fixture records served by the emulator.
+    """
+
+    def __init__(self, fixture_dir, id_template=None):
+        self.metadata = _read_fixture(fixture_dir, 'metadata.json')
+        self.records = {
+            str(item['record_id']): item
+            for item in _read_fixture(fixture_dir, 'records.json')
+        }
+        self.id_template = id_template
+
+    def get(self, record_id):
+        """Find a record, generating one from the template if needed.
+
+        Args:
+            record_id (str): The REDCap record ID to look up.
+
+        Returns:
+            dict: The record's fields or None if the record doesn't exist
+            and can't be generated.
+        """
+        record_id = str(record_id)
+        try:
+            return self.records[record_id]
+        except KeyError:
+            pass
+
+        if not self.id_template:
+            return None
+
+        try:
+            session = self.id_template.format(int(record_id))
+        except ValueError:
+            session = self.id_template.format(record_id)
+
+        return {
+            'record_id': record_id,
+            'par_id': session,
+            'date': datetime.date.today().isoformat(),
+            'ra_id': '1',
+            'cmts': '',
+            'scan_completed_complete': '2'
+        }
+
+
+def _read_fixture(fixture_dir, name):
+    with open(os.path.join(fixture_dir, name), 'r') as fh:
+        return json.load(fh)
+
+
+def _requested_records(form):
+    """Get the list of record IDs from an 'export_records' call.
+
+    Different REDCap clients encode the list as either repeated 'records' keys
+    or as 'records[0]', 'records[1]', etc.
+    """
+    records = form.getlist('records')
+    for key in sorted(form.keys()):
+        if key.startswith('records['):
+            records.append(form[key])
+    return records
+
+
+def create_emulator(store, version='9.1.0', latency=0):
+    """Build the Flask app that answers REDCap API calls.
+
+    Args:
+        store (:obj:`RecordStore`): The records to serve.
+        version (str, optional): The REDCap version to report.
+        latency (float, optional): A number of seconds to delay each response
+            by.
+
+    Returns:
+        :obj:`flask.Flask`: The emulator app.
+    """
+    app = Flask(__name__)
+
+    @app.route('/api/', methods=['POST'])
+    def api():
+        if latency:
+            time.sleep(latency)
+
+        content = request.form.get('content')
+
+        if content == 'metadata':
+            return jsonify(store.metadata)
+
+        if content == 'version':
+            return Response(version, mimetype='text/plain')
+
+        if content in ('event', 'arm'):
+            # A classic (non-longitudinal) project
+            return jsonify({'error': 'You cannot export {}s for classic '
+                                     'projects'.format(content)}), 400
+
+        if content == 'exportFieldNames':
+            return jsonify([{'original_field_name': item['field_name'],
+                             'choice_value': '',
+                             'export_field_name': item['field_name']}
+                            for item in store.metadata])
+
+        if content == 'record':
+            found = []
+            for record_id in _requested_records(request.form):
+                record = store.get(record_id)
+                if record is not None:
+                    found.append(record)
+            return jsonify(found)
+
+        return jsonify({'error': 'Unsupported content type {}'.format(
+            content)}), 400
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a fake REDCap API from local fixtures.")
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--fixtures', default=FIXTURES)
+    parser.add_argument('--id-template')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--version', default='9.1.0')
+    args = parser.parse_args()
+
+    store = RecordStore(args.fixtures, id_template=args.id_template)
+    app = create_emulator(store, version=args.version, latency=args.latency)
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
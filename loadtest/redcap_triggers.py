@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""Fire concurrent REDCap data entry triggers at a dashboard instance.
+
+Each request mimics the POST a REDCap server sends to the dashboard's
+'/redcap' endpoint when a 'Scan Completed' survey is saved. The dashboard will
+then ask the REDCap server for the record, so point '--redcap' at an instance
+of loadtest/redcap_emulator.py rather than a real server.
+
+When the run ends, latency percentiles, throughput and error counts are
+printed so that changes to the ingestion path can be compared before they
+reach production.
+
+Usage:
+    python loadtest/redcap_triggers.py [options]
+
+Options:
+    --dashboard URL     Base URL of the dashboard to test
+                        (default: http://localhost:5000)
+    --redcap URL        Base URL of the REDCap server the dashboard should
+                        query. Must end with a '/'
+                        (default: http://localhost:5001/)
+    --requests N        Total number of triggers to send (default: 100)
+    --concurrency N     Number of triggers in flight at once (default: 10)
+    --start N           First record ID to use. Each trigger uses the next
+                        record ID (default: 1)
+    --repeat            Re-send the same record ID for every trigger instead
+                        of using a new one each time.
+    --project-id N      REDCap project ID to report (default: 1)
+    --instrument NAME   Instrument name to report (default: scan_completed)
+    --version STR       REDCap version to embed in the project URL
+                        (default: 9.1.0)
+    --timeout SECONDS   Per request timeout (default: 60)
+"""
+import math
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def build_trigger(record, redcap_url, project_id, instrument, version):
+    """Build the form data REDCap sends with a data entry trigger.
+    """
+    return {
+        'record': str(record),
+        'project_id': str(project_id),
+        'redcap_url': redcap_url,
+        'instrument': instrument,
+        'project_url': '{}redcap_v{}/index.php?pid={}'.format(
+            redcap_url, version, project_id),
+        instrument + '_complete': '2'
+    }
+
+
+def send_trigger(http, url, payload, timeout):
+    """Send one trigger and time it.
+
+    Returns:
+        tuple: The elapsed time in seconds and either the response status code
+        or the name of the exception that was raised.
+    """
+    start = time.perf_counter()
+    try:
+        response = http.post(url, data=payload, timeout=timeout)
+    except requests.RequestException as e:
+        return time.perf_counter() - start, type(e).__name__
+    return time.perf_counter() - start, response.status_code
+
+
+def percentile(values, pct):
+    """Return the given percentile of a sorted list (nearest rank method).
+    """
+    if not values:
+        return 0.0
+    rank = max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run(args):
+    url = args.dashboard.rstrip('/') + '/redcap'
+    if args.repeat:
+        records = [args.start] * args.requests
+    else:
+        records = range(args.start, args.start + args.requests)
+
+    payloads = [
+        build_trigger(record, args.redcap, args.project_id, args.instrument,
+                      args.version)
+        for record in records
+    ]
+
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=args.concurrency)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(
+            lambda payload: send_trigger(http, url, payload, args.timeout),
+            payloads))
+    elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+
+def report(results, elapsed):
+    latencies = sorted(item[0] for item in results)
+    outcomes = Counter(item[1] for item in results)
+    errors = sum(count for outcome, count in outcomes.items()
+                 if not (isinstance(outcome, int) and outcome < 400))
+
+    print("Requests:    {}".format(len(results)))
+    print("Elapsed:     {:.2f}s".format(elapsed))
+    print("Throughput:  {:.2f} req/s".format(
+        len(results) / elapsed if elapsed else 0))
+    print("Latency p50: {:.1f}ms".format(percentile(latencies, 50) * 1000))
+    print("Latency p99: {:.1f}ms".format(percentile(latencies, 99) * 1000))
+    print("Latency max: {:.1f}ms".format(
+        (latencies[-1] if latencies else 0) * 1000))
+    print("Errors:      {}".format(errors))
+    for outcome, count in sorted(outcomes.items(), key=lambda x: str(x[0])):
+        print("    {}: {}".format(outcome, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the dashboard's REDCap trigger endpoint.")
+    parser.add_argument('--dashboard', default='http://localhost:5000')
+    parser.add_argument('--redcap', default='http://localhost:5001/')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--start', type=int, default=1)
+    parser.add_argument('--repeat', action='store_true')
+    parser.add_argument('--project-id', type=int, default=1)
+    parser.add_argument('--instrument', default='scan_completed')
+    parser.add_argument('--version', default='9.1.0')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    if not args.redcap.endswith('/'):
+        parser.error("--redcap must end with a '/'")
+
+    results, elapsed = run(args)
+    report(results, elapsed)
+
+
+if __name__ == '__main__':
+    main()
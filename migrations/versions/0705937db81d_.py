@@ -0,0 +1,58 @@
+"""Track whether each scan has header diffs or conversion errors.
+
+The new columns are filled in from each scan's conversion errors and its
+most recent header diffs.
+
+Revision ID: 0705937db81d
+Revises: cfd8cf8b6029
+Create Date: 2026-10-21 15:03:44.570218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0705937db81d'
+down_revision = 'cfd8cf8b6029'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scans',
+                  sa.Column('has_header_diffs', sa.Boolean(),
+                            server_default='false', nullable=False))
+    op.add_column('scans',
+                  sa.Column('diff_field_count', sa.Integer(),
+                            server_default='0', nullable=False))
+    op.add_column('scans',
+                  sa.Column('has_conversion_error', sa.Boolean(),
+                            server_default='false', nullable=False))
+
+    op.execute("UPDATE scans SET has_conversion_error = true "
+               "WHERE conversion_errors IS NOT NULL "
+               "AND conversion_errors != ''")
+    op.execute("UPDATE scans "
+               "SET diff_field_count = latest.count, "
+               "    has_header_diffs = latest.count > 0 "
+               "FROM (SELECT DISTINCT ON (scan) scan, "
+               "        (SELECT count(*) "
+               "         FROM jsonb_object_keys(header_diffs)) AS count "
+               "      FROM scan_gold_standard "
+               "      WHERE jsonb_typeof(header_diffs) = 'object' "
+               "      ORDER BY scan, date_added DESC) AS latest "
+               "WHERE scans.id = latest.scan")
+
+    op.create_index('scans_problems_idx',
+                    'scans', ['timepoint'],
+                    unique=False,
+                    postgresql_where=sa.text(
+                        'has_header_diffs OR has_conversion_error'))
+
+
+def downgrade():
+    op.drop_index('scans_problems_idx', table_name='scans')
+    op.drop_column('scans', 'has_conversion_error')
+    op.drop_column('scans', 'diff_field_count')
+    op.drop_column('scans', 'has_header_diffs')
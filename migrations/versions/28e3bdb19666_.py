@@ -0,0 +1,83 @@
+"""Store hashes of scan and gold standard JSON contents.
+
+The hashes of the contents each scan's header diffs were made from are also
+stored, so unchanged diffs don't have to be recomputed. Existing diffs are
+left without hashes, since it's not known what contents they were made from,
+and will be recomputed the next time they're updated.
+
+Revision ID: 28e3bdb19666
+Revises: e81b4c6f2a97
+Create Date: 2026-10-20 09:41:06.318532
+
+"""
+import json
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '28e3bdb19666'
+down_revision = 'e81b4c6f2a97'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    op.add_column('scans',
+                  sa.Column('json_hash', sa.String(length=64), nullable=True))
+    op.add_column('gold_standards',
+                  sa.Column('contents_hash', sa.String(length=64),
+                            nullable=True))
+    op.add_column('scan_gold_standard',
+                  sa.Column('scan_hash', sa.String(length=64), nullable=True))
+    op.add_column('scan_gold_standard',
+                  sa.Column('gold_hash', sa.String(length=64), nullable=True))
+
+    backfill('scans', 'json_contents', 'json_hash')
+    backfill('gold_standards', 'contents', 'contents_hash')
+
+
+def downgrade():
+    op.drop_column('scan_gold_standard', 'gold_hash')
+    op.drop_column('scan_gold_standard', 'scan_hash')
+    op.drop_column('gold_standards', 'contents_hash')
+    op.drop_column('scans', 'json_hash')
+
+
+def backfill(table_name, contents, hash_column):
+    conn = op.get_bind()
+    table = sa.table(table_name,
+                     sa.column('id', sa.Integer),
+                     sa.column(contents),
+                     sa.column(hash_column, sa.String))
+    update = table.update() \
+                  .where(table.c.id == sa.bindparam('row_id')) \
+                  .values({hash_column: sa.bindparam('hash')})
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select([table.c.id, table.c[contents]])
+              .where(table.c.id > last_id)
+              .where(table.c[contents].isnot(None))
+              .order_by(table.c.id)
+              .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{
+            'row_id': row_id,
+            'hash': hash_json(value)
+        } for row_id, value in rows])
+        last_id = rows[-1][0]
+
+
+def hash_json(contents):
+    # Must match dashboard.models.utils.hash_json
+    if isinstance(contents, str):
+        contents = json.loads(contents)
+    text = json.dumps(contents, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
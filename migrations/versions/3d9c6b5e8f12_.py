@@ -0,0 +1,29 @@
+"""Record when each user's access was last reduced.
+
+Tokens that let a user load a QC page's images are refused if they were
+issued before this time.
+
+Revision ID: 3d9c6b5e8f12
+Revises: 6e2b7f41d0a8
+Create Date: 2026-10-18 12:05:48.920317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d9c6b5e8f12'
+down_revision = '6e2b7f41d0a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users',
+                  sa.Column('access_changed', sa.DateTime(timezone=True),
+                            nullable=True))
+
+
+def downgrade():
+    op.drop_column('users', 'access_changed')
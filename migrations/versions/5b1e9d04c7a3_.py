@@ -0,0 +1,29 @@
+"""Record the settings each scan's header diffs were made with.
+
+Existing diffs are left without a settings hash, so they're remade the next
+time their scan is compared.
+
+Revision ID: 5b1e9d04c7a3
+Revises: 0705937db81d
+Create Date: 2026-10-22 10:12:37.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e9d04c7a3'
+down_revision = '0705937db81d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scan_gold_standard',
+                  sa.Column('settings_hash', sa.String(length=64),
+                            nullable=True))
+
+
+def downgrade():
+    op.drop_column('scan_gold_standard', 'settings_hash')
@@ -0,0 +1,50 @@
+"""Add tables to record array jobs submitted to the cluster for sessions.
+
+Revision ID: 5d1c7b9a2e4f
+Revises: cea8fef37003
+Create Date: 2026-10-18 22:10:07.318254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1c7b9a2e4f'
+down_revision = 'cea8fef37003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cluster_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('script', sa.String(length=128), nullable=False),
+        sa.Column('study', sa.String(length=32), nullable=True),
+        sa.Column('submitted', sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(['study'], ['studies.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'cluster_job_tasks',
+        sa.Column('job', sa.Integer(), nullable=False),
+        sa.Column('task', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('num', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['job'], ['cluster_jobs.id'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['name', 'num'],
+                                ['sessions.name', 'sessions.num'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('job', 'task')
+    )
+    op.create_index('cluster_job_tasks_session_idx', 'cluster_job_tasks',
+                    ['name', 'num'], unique=False)
+
+
+def downgrade():
+    op.drop_index('cluster_job_tasks_session_idx',
+                  table_name='cluster_job_tasks')
+    op.drop_table('cluster_job_tasks')
+    op.drop_table('cluster_jobs')
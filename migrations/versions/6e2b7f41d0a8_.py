@@ -0,0 +1,26 @@
+"""Record which run owns each running deletion job.
+
+Revision ID: 6e2b7f41d0a8
+Revises: a83d5e07c4f9
+Create Date: 2026-10-18 11:20:36.114592
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2b7f41d0a8'
+down_revision = 'a83d5e07c4f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('deletion_jobs',
+                  sa.Column('claimed_by', sa.String(length=64),
+                            nullable=True))
+
+
+def downgrade():
+    op.drop_column('deletion_jobs', 'claimed_by')
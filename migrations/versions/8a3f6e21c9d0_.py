@@ -0,0 +1,45 @@
+"""Track the cluster's job ID and state for submitted cluster jobs.
+
+Revision ID: 8a3f6e21c9d0
+Revises: 5d1c7b9a2e4f
+Create Date: 2026-10-18 22:31:52.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a3f6e21c9d0'
+down_revision = '5d1c7b9a2e4f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('cluster_jobs',
+                  sa.Column('queue_id', sa.String(length=32), nullable=True))
+    # Jobs recorded before this point were submitted synchronously, so
+    # whatever happened to them is unknown.
+    op.add_column('cluster_jobs',
+                  sa.Column('state', sa.String(length=32), nullable=False,
+                            server_default='LOST'))
+    op.add_column('cluster_jobs',
+                  sa.Column('updated', sa.DateTime(timezone=True),
+                            nullable=True))
+    op.add_column('cluster_jobs', sa.Column('error', sa.Text(),
+                                            nullable=True))
+    op.alter_column('cluster_jobs', 'state', server_default=None)
+
+    op.add_column('cluster_job_tasks',
+                  sa.Column('state', sa.String(length=32), nullable=False,
+                            server_default='LOST'))
+    op.alter_column('cluster_job_tasks', 'state', server_default=None)
+
+
+def downgrade():
+    op.drop_column('cluster_job_tasks', 'state')
+    op.drop_column('cluster_jobs', 'error')
+    op.drop_column('cluster_jobs', 'updated')
+    op.drop_column('cluster_jobs', 'state')
+    op.drop_column('cluster_jobs', 'queue_id')
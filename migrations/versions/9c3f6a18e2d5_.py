@@ -0,0 +1,31 @@
+"""Record when each deletion job last changed.
+
+Running jobs that stop updating are put back in the queue by the deletion
+sweep.
+
+Revision ID: 9c3f6a18e2d5
+Revises: 5b1e9d04c7a3
+Create Date: 2026-10-22 13:40:09.881326
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3f6a18e2d5'
+down_revision = '5b1e9d04c7a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('deletion_jobs',
+                  sa.Column('updated', sa.DateTime(timezone=True),
+                            nullable=True))
+    op.execute("UPDATE deletion_jobs "
+               "SET updated = COALESCE(finished, started, added)")
+
+
+def downgrade():
+    op.drop_column('deletion_jobs', 'updated')
@@ -0,0 +1,26 @@
+"""Count failed bulk comparisons against each gold standard.
+
+Revision ID: a83d5e07c4f9
+Revises: f4a2c87d3b61
+Create Date: 2026-10-18 10:42:17.583104
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83d5e07c4f9'
+down_revision = 'f4a2c87d3b61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('gold_standards',
+                  sa.Column('compare_failures', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+
+def downgrade():
+    op.drop_column('gold_standards', 'compare_failures')
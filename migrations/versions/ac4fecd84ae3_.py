@@ -0,0 +1,27 @@
+"""Index scan JSON headers so they can be searched.
+
+Revision ID: ac4fecd84ae3
+Revises: 28e3bdb19666
+Create Date: 2026-10-20 14:12:51.904317
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'ac4fecd84ae3'
+down_revision = '28e3bdb19666'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('scans_json_contents_idx',
+                    'scans', ['json_contents'],
+                    unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'json_contents': 'jsonb_path_ops'})
+
+
+def downgrade():
+    op.drop_index('scans_json_contents_idx', table_name='scans')
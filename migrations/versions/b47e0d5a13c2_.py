@@ -0,0 +1,44 @@
+"""Add a table to collect new timepoint notifications for QC digests.
+
+Revision ID: b47e0d5a13c2
+Revises: 8a3f6e21c9d0
+Create Date: 2026-10-18 22:58:14.227409
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b47e0d5a13c2'
+down_revision = '8a3f6e21c9d0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'timepoint_notifications',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('study', sa.String(length=32), nullable=False),
+        sa.Column('timepoint', sa.String(length=64), nullable=False),
+        sa.Column('added', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('sent', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['study'], ['studies.id'], ),
+        sa.ForeignKeyConstraint(['timepoint'], ['timepoints.name'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'timepoint_notifications_unsent_idx',
+        'timepoint_notifications',
+        ['added'],
+        unique=False,
+        postgresql_where=sa.text('sent IS NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('timepoint_notifications_unsent_idx',
+                  table_name='timepoint_notifications')
+    op.drop_table('timepoint_notifications')
@@ -0,0 +1,52 @@
+"""Add a table to track sessions handled by the periodic monitor sweeps.
+
+Revision ID: cea8fef37003
+Revises: 442e3abe5587
+Create Date: 2026-10-18 09:12:41.503821
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'cea8fef37003'
+down_revision = '442e3abe5587'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'session_monitors',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('num', sa.Integer(), nullable=False),
+        sa.Column('monitor', sa.String(length=32), nullable=False),
+        sa.Column('study', sa.String(length=32), nullable=True),
+        sa.Column('recipients', postgresql.JSONB(astext_type=sa.Text()),
+                  nullable=True),
+        sa.Column('added', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('due', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('expires', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('handled', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('outcome', sa.String(length=32), nullable=True),
+        sa.ForeignKeyConstraint(['name', 'num'],
+                                ['sessions.name', 'sessions.num'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['study'], ['studies.id'], ),
+        sa.PrimaryKeyConstraint('name', 'num', 'monitor')
+    )
+    op.create_index(
+        'session_monitors_pending_idx',
+        'session_monitors',
+        ['monitor', 'due'],
+        unique=False,
+        postgresql_where=sa.text('handled IS NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('session_monitors_pending_idx',
+                  table_name='session_monitors')
+    op.drop_table('session_monitors')
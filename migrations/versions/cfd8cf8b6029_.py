@@ -0,0 +1,170 @@
+"""Store scan and gold standard headers once in a shared table.
+
+Each distinct JSON header is moved to 'header_blobs', keyed by the content
+hash added in 28e3bdb19666, and scans and gold standards now reference it
+instead of holding their own copy. The GIN index used by header searches
+moves to the new table.
+
+Revision ID: cfd8cf8b6029
+Revises: ac4fecd84ae3
+Create Date: 2026-10-21 10:27:39.118406
+
+"""
+import json
+import zlib
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'cfd8cf8b6029'
+down_revision = 'ac4fecd84ae3'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    op.create_table(
+        'header_blobs',
+        sa.Column('hash', sa.String(length=64), nullable=False),
+        sa.Column('contents', postgresql.JSONB(astext_type=sa.Text()),
+                  nullable=True),
+        sa.Column('compressed', sa.LargeBinary(), nullable=True),
+        sa.PrimaryKeyConstraint('hash'))
+
+    # Catch any headers that were added without a hash
+    backfill('scans', 'json_contents', 'json_hash')
+    backfill('gold_standards', 'contents', 'contents_hash')
+
+    op.execute("INSERT INTO header_blobs (hash, contents) "
+               "SELECT DISTINCT ON (json_hash) json_hash, json_contents "
+               "FROM scans WHERE json_hash IS NOT NULL "
+               "ON CONFLICT DO NOTHING")
+    op.execute("INSERT INTO header_blobs (hash, contents) "
+               "SELECT DISTINCT ON (contents_hash) contents_hash, contents "
+               "FROM gold_standards WHERE contents_hash IS NOT NULL "
+               "ON CONFLICT DO NOTHING")
+
+    op.create_foreign_key('scans_json_hash_fkey', 'scans', 'header_blobs',
+                          ['json_hash'], ['hash'])
+    op.create_foreign_key('gold_standards_contents_hash_fkey',
+                          'gold_standards', 'header_blobs',
+                          ['contents_hash'], ['hash'])
+
+    op.drop_index('scans_json_contents_idx', table_name='scans')
+    op.drop_constraint('gold_standards_json_path_contents_key',
+                       'gold_standards',
+                       type_='unique')
+    op.create_unique_constraint(
+        'gold_standards_json_path_contents_constraint', 'gold_standards',
+        ['json_path', 'contents_hash'])
+    op.drop_column('scans', 'json_contents')
+    op.drop_column('gold_standards', 'contents')
+
+    op.create_index('header_blobs_contents_idx',
+                    'header_blobs', ['contents'],
+                    unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'contents': 'jsonb_path_ops'})
+
+
+def downgrade():
+    op.add_column('scans',
+                  sa.Column('json_contents',
+                            postgresql.JSONB(astext_type=sa.Text()),
+                            nullable=True))
+    op.add_column('gold_standards',
+                  sa.Column('contents',
+                            postgresql.JSONB(astext_type=sa.Text()),
+                            nullable=True))
+
+    op.execute("UPDATE scans SET json_contents = header_blobs.contents "
+               "FROM header_blobs WHERE scans.json_hash = header_blobs.hash")
+    op.execute("UPDATE gold_standards SET contents = header_blobs.contents "
+               "FROM header_blobs "
+               "WHERE gold_standards.contents_hash = header_blobs.hash")
+    restore_compressed()
+
+    op.drop_constraint('gold_standards_json_path_contents_constraint',
+                       'gold_standards',
+                       type_='unique')
+    op.create_unique_constraint('gold_standards_json_path_contents_key',
+                                'gold_standards', ['json_path', 'contents'])
+    op.create_index('scans_json_contents_idx',
+                    'scans', ['json_contents'],
+                    unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'json_contents': 'jsonb_path_ops'})
+
+    op.drop_constraint('gold_standards_contents_hash_fkey',
+                       'gold_standards',
+                       type_='foreignkey')
+    op.drop_constraint('scans_json_hash_fkey', 'scans', type_='foreignkey')
+    op.drop_index('header_blobs_contents_idx', table_name='header_blobs')
+    op.drop_table('header_blobs')
+
+
+def backfill(table_name, contents, hash_column):
+    conn = op.get_bind()
+    table = sa.table(table_name,
+                     sa.column('id', sa.Integer),
+                     sa.column(contents),
+                     sa.column(hash_column, sa.String))
+    update = table.update() \
+                  .where(table.c.id == sa.bindparam('row_id')) \
+                  .values({hash_column: sa.bindparam('hash')})
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select([table.c.id, table.c[contents]])
+              .where(table.c.id > last_id)
+              .where(table.c[contents].isnot(None))
+              .where(table.c[hash_column].is_(None))
+              .order_by(table.c.id)
+              .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{
+            'row_id': row_id,
+            'hash': hash_json(value)
+        } for row_id, value in rows])
+        last_id = rows[-1][0]
+
+
+def restore_compressed():
+    conn = op.get_bind()
+    blobs = sa.table('header_blobs',
+                     sa.column('hash', sa.String),
+                     sa.column('compressed', sa.LargeBinary))
+    targets = [('scans', 'json_contents', 'json_hash'),
+               ('gold_standards', 'contents', 'contents_hash')]
+
+    rows = conn.execute(
+        sa.select([blobs.c.hash, blobs.c.compressed])
+          .where(blobs.c.compressed.isnot(None))).fetchall()
+    for table_name, contents, hash_column in targets:
+        table = sa.table(table_name,
+                         sa.column(contents, postgresql.JSONB),
+                         sa.column(hash_column, sa.String))
+        update = table.update() \
+                      .where(table.c[hash_column] == sa.bindparam('blob')) \
+                      .values({contents: sa.bindparam('contents')})
+        for blob_hash, data in rows:
+            conn.execute(update, {
+                'blob': blob_hash,
+                'contents': json.loads(zlib.decompress(data).decode('utf-8'))
+            })
+
+
+def hash_json(contents):
+    # Must match dashboard.models.utils.hash_json
+    if isinstance(contents, str):
+        contents = json.loads(contents)
+    text = json.dumps(contents, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
@@ -0,0 +1,49 @@
+"""Add an outbox table that all outgoing email is sent through.
+
+Revision ID: d2c95f7b0e18
+Revises: b47e0d5a13c2
+Create Date: 2026-10-18 23:24:40.918362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2c95f7b0e18'
+down_revision = 'b47e0d5a13c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'email_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('subject', sa.Text(), nullable=False),
+        sa.Column('sender', sa.String(length=256), nullable=False),
+        sa.Column('recipients', postgresql.JSONB(astext_type=sa.Text()),
+                  nullable=False),
+        sa.Column('body', sa.Text(), nullable=True),
+        sa.Column('html', sa.Text(), nullable=True),
+        sa.Column('added', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt', sa.DateTime(timezone=True),
+                  nullable=False),
+        sa.Column('sent', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'email_outbox_unsent_idx',
+        'email_outbox',
+        ['next_attempt'],
+        unique=False,
+        postgresql_where=sa.text('sent IS NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('email_outbox_unsent_idx', table_name='email_outbox')
+    op.drop_table('email_outbox')
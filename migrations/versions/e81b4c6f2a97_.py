@@ -0,0 +1,53 @@
+"""Add a table to track background deletion of raw data.
+
+Revision ID: e81b4c6f2a97
+Revises: d2c95f7b0e18
+Create Date: 2026-10-19 10:02:17.644205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81b4c6f2a97'
+down_revision = 'd2c95f7b0e18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'deletion_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('study', sa.String(length=32), nullable=False),
+        sa.Column('target', sa.String(length=128), nullable=False),
+        sa.Column('requested_by', sa.Integer(), nullable=True),
+        sa.Column('plan', postgresql.JSONB(astext_type=sa.Text()),
+                  nullable=False),
+        sa.Column('state', sa.String(length=32), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('done', sa.Integer(), nullable=False),
+        sa.Column('removed', sa.Integer(), nullable=False),
+        sa.Column('results', postgresql.JSONB(astext_type=sa.Text()),
+                  nullable=True),
+        sa.Column('added', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('started', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('finished', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['requested_by'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['study'], ['studies.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'deletion_jobs_queued_idx',
+        'deletion_jobs',
+        ['added'],
+        unique=False,
+        postgresql_where=sa.text("state = 'QUEUED'")
+    )
+
+
+def downgrade():
+    op.drop_index('deletion_jobs_queued_idx', table_name='deletion_jobs')
+    op.drop_table('deletion_jobs')
@@ -0,0 +1,32 @@
+"""Record when scans were last compared to each gold standard in bulk.
+
+Gold standards that already have header diffs are marked as compared, so
+the sweep only picks up the rest.
+
+Revision ID: f4a2c87d3b61
+Revises: 9c3f6a18e2d5
+Create Date: 2026-10-22 16:25:51.310472
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a2c87d3b61'
+down_revision = '9c3f6a18e2d5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('gold_standards',
+                  sa.Column('compared', sa.DateTime(timezone=True),
+                            nullable=True))
+    op.execute("UPDATE gold_standards SET compared = now() "
+               "WHERE EXISTS (SELECT 1 FROM scan_gold_standard "
+               "              WHERE gold_standard = gold_standards.id)")
+
+
+def downgrade():
+    op.drop_column('gold_standards', 'compared')